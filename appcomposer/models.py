@@ -349,6 +349,7 @@ class TranslationBundle(db.Model):
     target = db.Column(db.Unicode(20), index = True)
     translation_url = relation("TranslationUrl", backref="bundles")
     from_developer = db.Column(db.Boolean, index = True)
+    contents_hash = db.Column(db.Unicode(255)) # order-independent hash of the active messages (see appcomposer.translator.ops)
 
     def __init__(self, language, target, translation_url, from_developer = False):
         self.language = language
@@ -437,6 +438,52 @@ class ActiveTranslationMessage(db.Model):
             self.category = self.namespace
 
 
+class TranslationNamespaceIndex(db.Model):
+    """A copy of the active messages which have a namespace, with the language, target and author.
+    It is maintained together with ActiveTranslationMessage (see translator.ops) so finding the same
+    (namespace, key) in the bundles of other apps does not require joining all the messages."""
+    __tablename__ = 'TranslationNamespaceIndex'
+    __table_args__ = (UniqueConstraint('bundle_id', 'key'), Index('ix_TranslationNamespaceIndex_lookup', 'language', 'target', 'namespace', 'key'))
+
+    id = db.Column(db.Integer, primary_key = True)
+    namespace = db.Column(db.Unicode(255), index = True)
+    key = db.Column(db.Unicode(255), index = True)
+    language = db.Column(db.Unicode(20), index = True)
+    target = db.Column(db.Unicode(20), index = True)
+    bundle_id = db.Column(db.Integer, ForeignKey('TranslationBundles.id', ondelete = 'CASCADE'), index = True)
+    translation_url_id = db.Column(db.Integer, ForeignKey('TranslationUrls.id'), index = True)
+    value = db.Column(db.UnicodeText)
+    taken_from_default = db.Column(db.Boolean, index = True)
+    from_developer = db.Column(db.Boolean)
+    user_id = db.Column(db.Integer, ForeignKey('GoLabOAuthUsers.id'))
+
+
+class TranslationBundleStats(db.Model):
+    """The translation statistics of each bundle (translated messages of the same tool, and first and
+    last date). It is maintained together with ActiveTranslationMessage (see translator.ops) so
+    retrieve_translations_stats does not need to count the messages of every bundle of the app."""
+    __tablename__ = 'TranslationBundleStats'
+
+    id = db.Column(db.Integer, primary_key = True)
+    bundle_id = db.Column(db.Integer, ForeignKey('TranslationBundles.id', ondelete = 'CASCADE'), unique = True)
+    translation_url_id = db.Column(db.Integer, ForeignKey('TranslationUrls.id'), index = True)
+    language = db.Column(db.Unicode(20))
+    target = db.Column(db.Unicode(20))
+    translated = db.Column(db.Integer)
+    creation_date = db.Column(db.DateTime)
+    modification_date = db.Column(db.DateTime)
+
+class TranslationBundleTool(db.Model):
+    """The tools whose messages (same_tool) are provided by each bundle, maintained together with
+    TranslationBundleStats."""
+    __tablename__ = 'TranslationBundleTools'
+    __table_args__ = (UniqueConstraint('bundle_id', 'tool_id'), )
+
+    id = db.Column(db.Integer, primary_key = True)
+    bundle_id = db.Column(db.Integer, ForeignKey('TranslationBundles.id', ondelete = 'CASCADE'), index = True)
+    tool_id = db.Column(db.Unicode(255), index = True)
+
+
 class TranslationKeySuggestion(db.Model):
     __tablename__ = 'TranslationKeySuggestions'
 
@@ -471,6 +518,20 @@ class TranslationValueSuggestion(db.Model):
         self.value = value
         self.number = number
 
+class TranslationSuggestionFlush(db.Model):
+    """Each batch of suggestion counters added to TranslationKeySuggestion and TranslationValueSuggestion
+    (see translator.ops.flush_suggestion_counters). It is stored in the same transaction, so a batch
+    is never added twice."""
+    __tablename__ = 'TranslationSuggestionFlushes'
+
+    id = db.Column(db.Integer, primary_key = True)
+    batch = db.Column(db.Unicode(64), unique = True)
+    datetime = db.Column(db.DateTime, index = True)
+
+    def __init__(self, batch, datetime):
+        self.batch = batch
+        self.datetime = datetime
+
 class TranslationExternalSuggestion(db.Model):
     __tablename__ = 'TranslationExternalSuggestions'
     __table_args__ = (UniqueConstraint('engine', 'human_key_hash', 'language'), )
@@ -0,0 +1,68 @@
+import json
+
+from mock import patch
+
+from appcomposer import db, redis_store
+from appcomposer.tests.utils import ComposerTest
+from appcomposer.models import GoLabOAuthUser
+from appcomposer.translator.ops import retrieve_stored
+from appcomposer.tests.translator.test_ops import TRANSLATOR, app_url, translation_url, original_messages
+
+UPDATE_MESSAGES_URL = '/translator/api/apps/bundles/es_ALL/ALL/updateMessages?app_url={0}'.format(app_url('app1'))
+
+class UpdateMessagesTest(ComposerTest):
+    def setUp(self):
+        super(UpdateMessagesTest, self).setUp()
+        redis_store.flushall()
+        db.session.add(GoLabOAuthUser(email = TRANSLATOR, display_name = u'translator'))
+        db.session.commit()
+
+        with self.client.session_transaction() as session:
+            session['golab_logged_in'] = True
+            session['golab_email'] = TRANSLATOR
+
+        self.originals = original_messages({ u'hello' : u'Hello', u'bye' : u'Bye' })
+        patchers = [
+            patch("appcomposer.views.api.extract_local_translations_url", return_value = (translation_url('app1'), self.originals, {})),
+            patch("appcomposer.translator.tasks.schedule_single_app_synchronization"),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def update(self, messages):
+        response = self.client.post(UPDATE_MESSAGES_URL, data = json.dumps({ 'messages' : messages }))
+        return json.loads(response.data)
+
+    def stored(self):
+        return retrieve_stored(translation_url('app1'), u'es_ALL', u'ALL')[0]
+
+    def test_update(self):
+        result = self.update([ { 'key' : u'hello', 'value' : u'Hola' }, { 'key' : u'bye', 'value' : u'Adios' } ])
+        self.assertEquals('success', result['result'])
+        stored = self.stored()
+        self.assertEquals((u'Hola', u'Adios'), (stored[u'hello']['value'], stored[u'bye']['value']))
+        self.assertEquals({ u'hello' : stored[u'hello']['revision'], u'bye' : stored[u'bye']['revision'] }, result['revisions'])
+
+    def test_conflict(self):
+        revision = self.update([ { 'key' : u'hello', 'value' : u'Hola' } ])['revisions'][u'hello']
+        self.update([ { 'key' : u'hello', 'value' : u'Buenas', 'revision' : revision } ])
+        current_revision = self.stored()[u'hello']['revision']
+
+        result = self.update([ { 'key' : u'hello', 'value' : u'Saludos', 'revision' : revision }, { 'key' : u'bye', 'value' : u'Adios' } ])
+        self.assertEquals('conflict', result['result'])
+        self.assertEquals({ u'hello' : { 'value' : u'Buenas', 'revision' : current_revision } }, result['conflicts'])
+        self.assertEquals(u'Buenas', self.stored()[u'hello']['value'])
+        self.assertEquals(u'Adios', self.stored()[u'bye']['value'])
+
+    def test_revision_as_string(self):
+        revision = self.update([ { 'key' : u'hello', 'value' : u'Hola' } ])['revisions'][u'hello']
+        result = self.update([ { 'key' : u'hello', 'value' : u'Buenas', 'revision' : unicode(revision) } ])
+        self.assertEquals('success', result['result'])
+        self.assertEquals(u'Buenas', self.stored()[u'hello']['value'])
+
+    def test_invalid_requests(self):
+        self.assertEquals('error', self.update([])['result'])
+        self.assertEquals('error', self.update([ { 'key' : u'hello' } ])['result'])
+        self.assertEquals('error', self.update([ { 'key' : u'hello', 'value' : u'Hola', 'revision' : u'latest' } ])['result'])
+        self.assertEquals({}, self.stored())
@@ -0,0 +1,213 @@
+import time
+import threading
+import unittest
+from collections import defaultdict
+
+from appcomposer.translator import executor as executor_module
+from appcomposer.translator.executor import FetchTask, FetchExecutor, GreenletFetchExecutor, _HostScheduler, create_executor, TIMEOUT, CANCELLED, ERROR, THREADS_ENGINE, GEVENT_ENGINE
+
+gevent = executor_module.gevent
+
+class RecordingTask(FetchTask):
+    "Records how it finished. fetch runs func (if any) and returns the name of the task"
+    def __init__(self, name, host = None, func = None):
+        self.name = name
+        self.host = host
+        self.func = func
+        self.results = []
+
+    def fetch(self):
+        if self.func is not None:
+            self.func(self)
+        return self.name
+
+    def on_success(self, result):
+        self.results.append(('success', result))
+
+    def on_failure(self, reason, exc_info = None):
+        self.results.append((reason, exc_info[0] if exc_info else None))
+
+class HostSchedulerTest(unittest.TestCase):
+    def test_round_robin(self):
+        tasks = [ RecordingTask(name, host) for name, host in [ ('a1', 'a'), ('a2', 'a'), ('a3', 'a'), ('b1', 'b'), ('b2', 'b'), ('c1', 'c') ] ]
+        scheduler = _HostScheduler(tasks, per_host = None)
+        self.assertEquals(6, len(scheduler))
+        self.assertEquals([ 'a1', 'b1', 'c1', 'a2', 'b2', 'a3' ], [ scheduler.next().name for _ in tasks ])
+        self.assertEquals(0, len(scheduler))
+
+    def test_per_host(self):
+        tasks = [ RecordingTask(name, host) for name, host in [ ('a1', 'a'), ('a2', 'a'), ('b1', 'b'), ('n1', None), ('n2', None) ] ]
+        scheduler = _HostScheduler(tasks, per_host = 1)
+        a1, b1, n1, n2 = [ scheduler.next() for _ in range(4) ]
+        self.assertEquals([ 'a1', 'b1', 'n1', 'n2' ], [ a1.name, b1.name, n1.name, n2.name ])
+
+        # a is busy with a1
+        self.assertIsNone(scheduler.next())
+        scheduler.done(a1)
+        self.assertEquals('a2', scheduler.next().name)
+
+    def test_drain(self):
+        scheduler = _HostScheduler([ RecordingTask('a1', 'a'), RecordingTask('b1', 'b') ], per_host = None)
+        self.assertEquals(set([ 'a1', 'b1' ]), set([ task.name for task in scheduler.drain() ]))
+        self.assertEquals(0, len(scheduler))
+        self.assertIsNone(scheduler.next())
+
+class FetchExecutorTest(unittest.TestCase):
+    def run_tasks(self, tasks, **kwargs):
+        kwargs.setdefault('tick', 0.05)
+        executor = FetchExecutor('tests', **kwargs)
+        executor.run(tasks)
+        return executor
+
+    def test_results(self):
+        def fail(task):
+            raise ValueError("failure")
+
+        tasks = [ RecordingTask('task{0}'.format(position), func = fail if position % 3 == 0 else None) for position in range(20) ]
+        self.run_tasks(tasks, workers = 4)
+        for position, task in enumerate(tasks):
+            if position % 3 == 0:
+                self.assertEquals([ (ERROR, ValueError) ], task.results)
+            else:
+                self.assertEquals([ ('success', task.name) ], task.results)
+
+    def test_per_host_limit(self):
+        lock = threading.Lock()
+        in_flight = defaultdict(int)
+        max_in_flight = defaultdict(int)
+
+        def fetch(task):
+            with lock:
+                in_flight[task.host] += 1
+                max_in_flight[task.host] = max(max_in_flight[task.host], in_flight[task.host])
+            time.sleep(0.01)
+            with lock:
+                in_flight[task.host] -= 1
+
+        tasks = [ RecordingTask('task{0}'.format(position), host = 'slow' if position < 20 else 'host{0}'.format(position), func = fetch) for position in range(30) ]
+        self.run_tasks(tasks, workers = 8, per_host = 2)
+        self.assertLessEqual(max_in_flight['slow'], 2)
+        for task in tasks:
+            self.assertEquals([ ('success', task.name) ], task.results)
+
+    def test_timeout(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        # A single worker: once the first task times out, a new worker runs the rest
+        tasks = [ RecordingTask('hung', func = lambda task : release.wait(5)) ] + [ RecordingTask('task{0}'.format(position)) for position in range(3) ]
+        t0 = time.time()
+        self.run_tasks(tasks, workers = 1, task_timeout = 0.2)
+        self.assertLess(time.time() - t0, 2)
+
+        self.assertEquals([ (TIMEOUT, None) ], tasks[0].results)
+        for task in tasks[1:]:
+            self.assertEquals([ ('success', task.name) ], task.results)
+
+        # When the hung task finally finishes, it is not reported again
+        release.set()
+        time.sleep(0.1)
+        self.assertEquals([ (TIMEOUT, None) ], tasks[0].results)
+
+    def test_cancel(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        started = threading.Event()
+
+        def hang(task):
+            started.set()
+            release.wait(5)
+
+        tasks = [ RecordingTask('running', func = hang) ] + [ RecordingTask('task{0}'.format(position)) for position in range(10) ]
+        executor = FetchExecutor('tests', workers = 1, tick = 0.05)
+
+        def cancel():
+            started.wait(5)
+            executor.cancel()
+        canceller = threading.Thread(target = cancel)
+        canceller.start()
+
+        t0 = time.time()
+        executor.run(tasks)
+        canceller.join()
+        self.assertLess(time.time() - t0, 2)
+        self.assertTrue(executor.cancelled)
+
+        # Every task is reported exactly once, as cancelled
+        for task in tasks:
+            self.assertEquals([ (CANCELLED, None) ], task.results)
+
+    def test_cancel_from_callback(self):
+        executor = FetchExecutor('tests', workers = 1, tick = 0.05)
+
+        class CancellingTask(RecordingTask):
+            def on_success(self, result):
+                RecordingTask.on_success(self, result)
+                executor.cancel()
+
+        tasks = [ CancellingTask('first') ] + [ RecordingTask('task{0}'.format(position)) for position in range(5) ]
+        executor.run(tasks)
+        self.assertEquals([ ('success', 'first') ], tasks[0].results)
+        # With a single worker, no other task had been started
+        for task in tasks[1:]:
+            self.assertEquals([ (CANCELLED, None) ], task.results)
+
+@unittest.skipIf(gevent is None, "gevent is not installed")
+class GreenletFetchExecutorTest(unittest.TestCase):
+    "The tasks use gevent.sleep, so the process does not need to be monkey-patched"
+
+    def test_results_and_timeout(self):
+        def fail(task):
+            raise ValueError("failure")
+
+        tasks = [ RecordingTask('hung', func = lambda task : gevent.sleep(5)), RecordingTask('failing', func = fail) ]
+        tasks.extend([ RecordingTask('task{0}'.format(position), func = lambda task : gevent.sleep(0.01)) for position in range(10) ])
+        t0 = time.time()
+        GreenletFetchExecutor('tests', concurrency = 4, task_timeout = 0.2, tick = 0.05).run(tasks)
+        self.assertLess(time.time() - t0, 2)
+
+        self.assertEquals([ (TIMEOUT, None) ], tasks[0].results)
+        self.assertEquals([ (ERROR, ValueError) ], tasks[1].results)
+        for task in tasks[2:]:
+            self.assertEquals([ ('success', task.name) ], task.results)
+
+    def test_per_host_limit(self):
+        in_flight = defaultdict(int)
+        max_in_flight = defaultdict(int)
+
+        def fetch(task):
+            in_flight[task.host] += 1
+            max_in_flight[task.host] = max(max_in_flight[task.host], in_flight[task.host])
+            gevent.sleep(0.01)
+            in_flight[task.host] -= 1
+
+        tasks = [ RecordingTask('task{0}'.format(position), host = 'slow' if position < 20 else 'host{0}'.format(position), func = fetch) for position in range(30) ]
+        GreenletFetchExecutor('tests', concurrency = 50, per_host = 3, tick = 0.05).run(tasks)
+        self.assertEquals(3, max_in_flight['slow'])
+        for task in tasks:
+            self.assertEquals([ ('success', task.name) ], task.results)
+
+    def test_cancel(self):
+        executor = GreenletFetchExecutor('tests', concurrency = 1, tick = 0.05)
+
+        class CancellingTask(RecordingTask):
+            def on_success(self, result):
+                RecordingTask.on_success(self, result)
+                executor.cancel()
+
+        tasks = [ CancellingTask('first') ] + [ RecordingTask('task{0}'.format(position)) for position in range(5) ]
+        executor.run(tasks)
+        self.assertEquals([ ('success', 'first') ], tasks[0].results)
+        for task in tasks[1:]:
+            self.assertEquals([ (CANCELLED, None) ], task.results)
+
+class CreateExecutorTest(unittest.TestCase):
+    def test_threads(self):
+        self.assertIsInstance(create_executor(THREADS_ENGINE, 'tests'), FetchExecutor)
+        self.assertIsInstance(create_executor('unknown', 'tests'), FetchExecutor)
+
+    def test_gevent_requires_monkey_patching(self):
+        if gevent is not None and gevent.monkey.is_module_patched('socket'):
+            self.assertIsInstance(create_executor(GEVENT_ENGINE, 'tests'), GreenletFetchExecutor)
+        else:
+            self.assertIsInstance(create_executor(GEVENT_ENGINE, 'tests'), FetchExecutor)
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+import urlparse
+import StringIO
+import xml.etree.ElementTree as ET
+
+import mock
+import requests
+from bs4 import BeautifulSoup
+from requests.packages.urllib3.response import HTTPResponse
+
+from appcomposer.exceptions import TranslatorError
+from appcomposer.translator.utils import get_html_head_from_response, validator_store
+from appcomposer.translator.extractors import extract_messages_from_translation, _scan_html_metas, _extract_information_html
+
+TRANSLATION_URL = u'http://localhost/apps/app1/languages/en_ALL.xml'
+
+def _extract_messages_with_elementtree(messages_absolute_url, xml_contents):
+    "The previous implementation of extract_messages_from_translation, which loaded the whole document in ElementTree"
+    contents = ET.fromstring(xml_contents.encode('utf8'))
+    messages = {}
+    attribs = dict(contents.attrib)
+    default_namespace = contents.attrib.get('namespace')
+    if 'mails' in contents.attrib:
+        mails = [ mail.strip() for mail in contents.attrib['mails'].split(',') ]
+    else:
+        mails = []
+    automatic = contents.attrib.get('automatic', 'true').lower() == 'true'
+
+    for pos, xml_msg in enumerate(contents.findall('msg')):
+        name = xml_msg.attrib['name']
+        namespace = xml_msg.attrib.get('namespace', default_namespace)
+        same_tool = True
+        tool_id = xml_msg.attrib.get('toolId')
+        if tool_id:
+            basename = messages_absolute_url.rsplit('/', 1)[1]
+            if not basename.lower().startswith(tool_id.lower()):
+                same_tool = False
+            namespace = "{0}::{1}".format(urlparse.urlparse(messages_absolute_url).netloc, tool_id)
+
+        try:
+            raw_msg_message = ET.tostring(xml_msg).split(">", 1)[1].rsplit("<", 1)[0]
+        except IndexError:
+            raw_msg_message = ""
+
+        if '<' in raw_msg_message or '>' in raw_msg_message:
+            xml_text = raw_msg_message
+        else:
+            xml_text = xml_msg.text or ""
+
+        messages[name] = {
+            'text' : xml_text,
+            'category' : xml_msg.attrib.get('category'),
+            'namespace' : namespace,
+            'position' : pos,
+            'same_tool' : same_tool,
+            'tool_id' : tool_id,
+            'format': xml_msg.attrib.get('format', 'plain'),
+        }
+    metadata = {
+        'mails' : mails,
+        'automatic' : automatic,
+        'attribs' : json.dumps(attribs),
+    }
+    return messages, metadata
+
+class ExtractMessagesTest(unittest.TestCase):
+
+    def assertSameAsElementTree(self, xml_contents, translation_url = TRANSLATION_URL):
+        messages, metadata = extract_messages_from_translation(translation_url, xml_contents)
+        expected_messages, expected_metadata = _extract_messages_with_elementtree(translation_url, xml_contents)
+        self.assertEquals(expected_messages, messages)
+        digests = metadata.pop('digests')
+        self.assertEquals(expected_metadata, metadata)
+        return messages, digests
+
+    def test_plain_messages(self):
+        messages, digests = self.assertSameAsElementTree(u"""<?xml version="1.0" encoding="UTF-8"?>
+        <messagebundle namespace="common" mails="a@example.com, b@example.com" automatic="false">
+            <msg name="hello">Hello</msg>
+            <msg name="bye" category="greetings" format="html">Goodbye, ñandú</msg>
+            <msg name="empty"></msg>
+            <msg name="other" namespace="other">Other</msg>
+            <msg name="escaped">Press &lt;i class=''&gt;&lt;/i&gt; &amp; go</msg>
+        </messagebundle>""")
+        self.assertEquals(u'Goodbye, ñandú', messages['bye']['text'])
+        self.assertEquals(u"Press <i class=''></i> & go", messages['escaped']['text'])
+
+    def test_nested_markup(self):
+        messages, digests = self.assertSameAsElementTree(u"""<messagebundle>
+            <msg name="icon">Press <i class="fa fa-play"></i> to start</msg>
+            <msg name="nested">Some <b>bold <i>and italic</i></b> text &amp; more<br/></msg>
+            <msg name="after">After</msg>
+        </messagebundle>""")
+        self.assertEquals(u'Press <i class="fa fa-play" /> to start', messages['icon']['text'])
+
+    def test_cdata(self):
+        messages, digests = self.assertSameAsElementTree(u"""<messagebundle>
+            <msg name="cdata"><![CDATA[<b>Bold</b> & <i>italic</i>]]></msg>
+            <msg name="mixed">Text <![CDATA[<i>]]> and <b>bold</b></msg>
+        </messagebundle>""")
+        self.assertEquals(u'<b>Bold</b> & <i>italic</i>', messages['cdata']['text'])
+
+    def test_comments(self):
+        self.assertSameAsElementTree(u"""<!-- Before the root -->
+        <messagebundle>
+            <!-- A comment between messages -->
+            <msg name="hello">Hello <!-- inside --> world</msg>
+            <msg name="markup">Press <!-- inside --><i>here</i></msg>
+            <!-- <msg name="commented">Not a message</msg> -->
+            <msg name="bye">Bye</msg>
+        </messagebundle>""")
+
+    def test_duplicate_keys(self):
+        messages, digests = self.assertSameAsElementTree(u"""<messagebundle>
+            <msg name="hello">First</msg>
+            <msg name="bye">Bye</msg>
+            <msg name="hello">Second</msg>
+        </messagebundle>""")
+        self.assertEquals((u'Second', 2), (messages['hello']['text'], messages['hello']['position']))
+
+        # The digests are those of the messages which are finally kept
+        without_duplicates, digests_without_duplicates = self.assertSameAsElementTree(u"""<messagebundle>
+            <msg name="bye">Bye</msg>
+            <msg name="hello">Second</msg>
+        </messagebundle>""")
+        self.assertEquals(digests_without_duplicates['text'], digests['text'])
+
+    def test_not_direct_children(self):
+        self.assertSameAsElementTree(u"""<messagebundle>
+            <group><msg name="grouped">Ignored</msg></group>
+            <msg name="hello">Hello<msg name="inner">Inner</msg></msg>
+        </messagebundle>""")
+
+    def test_tools(self):
+        self.assertSameAsElementTree(u"""<messagebundle>
+            <msg name="own" toolId="en">Own</msg>
+            <msg name="other" toolId="common">Other tool</msg>
+            <msg name="empty" toolId="">No tool</msg>
+        </messagebundle>""")
+
+    def test_errors(self):
+        self.assertRaises(TranslatorError, extract_messages_from_translation, TRANSLATION_URL, u'<messagebundle><msg name="a">Unclosed</messagebundle>')
+        self.assertRaises(TranslatorError, extract_messages_from_translation, TRANSLATION_URL, u'<messagebundle><msg>No name</msg></messagebundle>')
+        self.assertRaises(TranslatorError, extract_messages_from_translation, TRANSLATION_URL, u'')
+
+class _CountingStringIO(StringIO.StringIO):
+    "Counts the bytes read"
+    def __init__(self, contents):
+        StringIO.StringIO.__init__(self, contents)
+        self.bytes_read = 0
+
+    def read(self, n = -1):
+        data = StringIO.StringIO.read(self, n)
+        self.bytes_read += len(data)
+        return data
+
+def _streamed_response(contents, encoding = None, headers = None):
+    r = requests.Response()
+    r.status_code = 200
+    r.encoding = encoding
+    r.headers.update(headers or {})
+    r.raw = HTTPResponse(body = _CountingStringIO(contents), preload_content = False)
+    return r
+
+HTML_APP = u"""<!DOCTYPE html>
+<html>
+<head>
+    <title>My lab</title>
+    <META name="translations" lang="es" country="ES" value="languages/es_ES.xml">
+    <meta name="translations" lang="fr" messages="languages/fr_ALL.xml" />
+    <meta name='check-url' value='http://localhost/apps/app1/check'>
+    <meta name="uses-proxy" value="false"><meta name="uses-proxy" value="TRUE">
+    <meta charset="utf-8">
+    <!-- <meta name="translations" lang="de" value="commented.xml"> -->
+    <script>var head = "<meta name='translations' lang='it'>";</script>
+</head>
+<body>
+    <p>Ñandú</p>
+</body>
+</html>"""
+
+HTML_APP_URL = u'http://localhost/apps/app1/index.html'
+
+class HtmlHeadTest(unittest.TestCase):
+    def setUp(self):
+        validator_store.delete('html', HTML_APP_URL)
+
+    def tearDown(self):
+        validator_store.delete('html', HTML_APP_URL)
+
+    def test_same_metas_as_beautifulsoup(self):
+        soup = BeautifulSoup(HTML_APP, 'lxml')
+        metas = _scan_html_metas(get_html_head_from_response(_streamed_response(HTML_APP.encode('utf8'))))
+        for name in ('translations', 'check-url', 'uses-proxy', 'download'):
+            self.assertEquals([ meta.attrs for meta in soup.find_all('meta', attrs = dict(name = name)) ], metas.find_all(name))
+
+    def test_only_head_is_read(self):
+        contents = HTML_APP.encode('utf8').replace('<p>', '<p>' + 'x' * (1024 * 1024))
+        response = _streamed_response(contents)
+        body = response.raw._fp
+        head = get_html_head_from_response(response)
+        self.assertIn(u'</head', head)
+        self.assertNotIn(u'Ñandú', head)
+        self.assertLess(body.bytes_read, 64 * 1024)
+        self.assertTrue(response.raw.closed)
+
+    def test_budget(self):
+        contents = '<html><head>' + 'x' * (1024 * 1024)
+        head = get_html_head_from_response(_streamed_response(contents), budget = 10000)
+        self.assertEquals(10000, len(head))
+
+    def test_encodings(self):
+        contents = (u'<html><head><title>' + u'ñ' * 5000 + u'</title></head>').encode('utf8')
+        # Many chunks, with multi-byte characters split among them
+        self.assertEquals(contents.decode('utf8'), get_html_head_from_response(_streamed_response(contents)))
+        self.assertEquals(contents.decode('utf8'), get_html_head_from_response(_streamed_response(contents, encoding = 'ISO-8859-1')))
+
+        latin1 = u'<html><head><title>Ñandú</title></head>'.encode('latin1')
+        self.assertEquals(u'<html><head><title>Ñandú</title></head>', get_html_head_from_response(_streamed_response(latin1, encoding = 'ISO-8859-1')))
+
+        # The budget cuts a character: it is not returned
+        self.assertEquals(u'<html><head>', get_html_head_from_response(_streamed_response((u'<html><head>ñ').encode('utf8')), budget = 13))
+
+    def test_extract_information_html(self):
+        cached_requests = mock.Mock()
+        cached_requests.get.return_value = _streamed_response(HTML_APP.encode('utf8'))
+        information = _extract_information_html(HTML_APP_URL, cached_requests)
+
+        self.assertEquals([
+            { 'lang' : 'es', 'country' : 'ES', 'messages' : 'languages/es_ES.xml' },
+            { 'lang' : 'fr', 'country' : None, 'messages' : 'languages/fr_ALL.xml' },
+        ], information.locales)
+        self.assertEquals([ 'http://localhost/apps/app1/check', HTML_APP_URL ], information.check_urls)
+        self.assertTrue(information.uses_proxy)
+        self.assertFalse(information.offline)
+
+    def test_not_an_app(self):
+        cached_requests = mock.Mock()
+        cached_requests.get.return_value = _streamed_response('<html><head><title>Nothing</title></head><body></body></html>')
+        self.assertRaises(TranslatorError, _extract_information_html, HTML_APP_URL, cached_requests)
+
+class ValidatorStoreTest(unittest.TestCase):
+    def setUp(self):
+        validator_store.delete('html', HTML_APP_URL)
+
+    def tearDown(self):
+        validator_store.delete('html', HTML_APP_URL)
+
+    def test_store_and_load(self):
+        self.assertEquals(({}, None), validator_store.load('html', HTML_APP_URL))
+
+        response = _streamed_response('', headers = { 'ETag' : '"abc"', 'Last-Modified' : 'Wed, 21 Oct 2015 07:28:00 GMT' })
+        validator_store.store('html', HTML_APP_URL, response, { 'result' : 1 })
+        self.assertEquals(({ 'If-None-Match' : '"abc"', 'If-Modified-Since' : 'Wed, 21 Oct 2015 07:28:00 GMT' }, { 'result' : 1 }), validator_store.load('html', HTML_APP_URL))
+        # Each kind of processing has its own result
+        self.assertEquals(({}, None), validator_store.load('opensocial', HTML_APP_URL))
+
+        # Without validators, the previous ones are not valid anymore
+        validator_store.store('html', HTML_APP_URL, _streamed_response(''), { 'result' : 2 })
+        self.assertEquals(({}, None), validator_store.load('html', HTML_APP_URL))
+
+    def test_not_modified(self):
+        cached_requests = mock.Mock()
+        cached_requests.get.return_value = _streamed_response(HTML_APP.encode('utf8'), headers = { 'ETag' : '"abc"' })
+        information = _extract_information_html(HTML_APP_URL, cached_requests)
+        self.assertEquals({}, cached_requests.get.call_args[1]['headers'])
+
+        not_modified = _streamed_response('')
+        not_modified.status_code = 304
+        cached_requests.get.return_value = not_modified
+        self.assertEquals(information, _extract_information_html(HTML_APP_URL, cached_requests))
+        self.assertEquals({ 'If-None-Match' : '"abc"' }, cached_requests.get.call_args[1]['headers'])
+        self.assertTrue(not_modified.raw.closed)
+
+    def test_error_is_not_stored(self):
+        cached_requests = mock.Mock()
+        cached_requests.get.return_value = _streamed_response(HTML_APP.encode('utf8'), headers = { 'ETag' : '"abc"' })
+        _extract_information_html(HTML_APP_URL, cached_requests)
+
+        error = _streamed_response('Internal error')
+        error.status_code = 500
+        cached_requests.get.return_value = error
+        self.assertRaises(TranslatorError, _extract_information_html, HTML_APP_URL, cached_requests)
+        self.assertTrue(error.raw.closed)
+        self.assertEquals({ 'If-None-Match' : '"abc"' }, validator_store.load('html', HTML_APP_URL)[0])
@@ -0,0 +1,333 @@
+from mock import patch
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+import appcomposer.translator.ops as ops
+
+from appcomposer import db, redis_store
+from appcomposer.exceptions import TranslatorError
+from appcomposer.tests.utils import ComposerTest
+from appcomposer.models import TranslationBundle, ActiveTranslationMessage, TranslationMessageHistory, GoLabOAuthUser, RepositoryApp, TranslationNamespaceIndex, TranslationBundleStats, TranslationBundleTool, TranslationKeySuggestion, TranslationValueSuggestion
+from appcomposer.translator.ops import add_full_translation_to_app, retrieve_stored, flush_suggestion_counters, repair_bundle_stats, retrieve_translations_stats, retrieve_translations_percent
+
+DEVELOPER = u'developer@example.com'
+TRANSLATOR = u'translator@example.com'
+OTHER_TRANSLATOR = u'other.translator@example.com'
+
+def app_url(name):
+    return u'http://localhost/apps/{0}/gadget.xml'.format(name)
+
+def translation_url(name):
+    return u'http://localhost/apps/{0}/languages/en_ALL.xml'.format(name)
+
+def original_messages(texts, namespace = None, tool_id = None, same_tool = True):
+    messages = {}
+    for position, (key, text) in enumerate(sorted(texts.items())):
+        messages[key] = {
+            'text' : text,
+            'position' : position,
+            'category' : None,
+            'namespace' : namespace,
+            'tool_id' : tool_id,
+            'same_tool' : same_tool,
+            'format' : None,
+        }
+    return messages
+
+class TranslatorOpsTest(ComposerTest):
+    def setUp(self):
+        super(TranslatorOpsTest, self).setUp()
+        redis_store.flushall()
+        for email in (DEVELOPER, TRANSLATOR, OTHER_TRANSLATOR):
+            db.session.add(GoLabOAuthUser(email = email, display_name = email.split('@')[0]))
+        db.session.commit()
+
+    def store(self, name, user_email, translated_messages, originals, from_developer = False, expected_revisions = None, language = u'es_ALL', translation_name = None):
+        return add_full_translation_to_app(user_email, app_url(name), translation_url(translation_name or name), {}, language, u'ALL', translated_messages, originals, from_developer, expected_revisions)
+
+    def add_to_repository(self, name):
+        db.session.add(RepositoryApp(name = name, url = app_url(name), repository = u'golabz'))
+        db.session.commit()
+
+    def user_id(self, email):
+        return db.session.query(GoLabOAuthUser).filter_by(email = email).one().id
+
+    def active_messages(self, name, language = u'es_ALL'):
+        "{key: (value, taken_from_default, from_developer, user_id)}"
+        messages = {}
+        for message in db.session.query(ActiveTranslationMessage).filter(ActiveTranslationMessage.bundle_id == TranslationBundle.id, TranslationBundle.language == language, TranslationBundle.translation_url.has(url = translation_url(name))).all():
+            messages[message.key] = (message.value, message.taken_from_default, message.from_developer, message.history.user_id)
+        return messages
+
+    def history(self, name, key, language = u'es_ALL'):
+        "[(value, user_id, parent_translation_id)] from the oldest"
+        return [ (message.value, message.user_id, message.parent_translation_id) for message in db.session.query(TranslationMessageHistory).filter(
+                            TranslationMessageHistory.key == key, TranslationMessageHistory.bundle_id == TranslationBundle.id, TranslationBundle.language == language,
+                            TranslationBundle.translation_url.has(url = translation_url(name))).order_by(TranslationMessageHistory.id).all() ]
+
+    def assertActiveHistoryConsistent(self):
+        for message in db.session.query(ActiveTranslationMessage).all():
+            self.assertIsNotNone(message.history)
+            self.assertEquals((message.bundle_id, message.key, message.value), (message.history.bundle_id, message.history.key, message.history.value))
+
+    def assertSummariesConsistent(self):
+        "The rolling hash, the namespace index and the stats must be the same as a recalculation"
+        db.session.remove()
+        bundle_ids = [ bundle_id for bundle_id, in db.session.query(TranslationBundle.id).all() ]
+
+        expected_hashes = ops._calculate_bundle_hashes(bundle_ids)
+        for bundle_id, contents_hash in db.session.query(TranslationBundle.id, TranslationBundle.contents_hash).all():
+            self.assertEquals(expected_hashes[bundle_id], contents_hash)
+
+        index_table = TranslationNamespaceIndex.__table__
+        indexed = sorted([ tuple(row) for row in db.session.execute(select([ index_table.c[column] for column in ops._NAMESPACE_INDEX_COLUMNS ])) ])
+        expected_indexed = sorted([ tuple(row) for row in db.session.execute(ops._namespace_index_select()) ])
+        self.assertEquals(expected_indexed, indexed)
+
+        stats_table = TranslationBundleStats.__table__
+        tools_table = TranslationBundleTool.__table__
+        expected_rows, expected_tools = ops._bundle_stats_rows()
+        rows = dict([ (row['bundle_id'], dict(row)) for row in db.session.execute(select([ stats_table.c.bundle_id, stats_table.c.translation_url_id, stats_table.c.language, stats_table.c.target,
+                                                                                    stats_table.c.translated, stats_table.c.creation_date, stats_table.c.modification_date ])) ])
+        self.assertEquals(expected_rows, rows)
+        tools = {}
+        for bundle_id, tool_id in db.session.execute(select([ tools_table.c.bundle_id, tools_table.c.tool_id ])):
+            tools.setdefault(bundle_id, set()).add(tool_id)
+        self.assertEquals(dict(expected_tools), tools)
+        self.assertEquals(0, repair_bundle_stats())
+
+class TestAddFullTranslation(TranslatorOpsTest):
+
+    def test_from_developer(self):
+        originals = original_messages({ u'hello' : u'Hello', u'bye' : u'Bye', u'other' : u'Other' }, tool_id = u'tool1')
+        self.store('app1', DEVELOPER, { u'hello' : u'Hola', u'bye' : u'Bye' }, originals, from_developer = True)
+
+        developer_id = self.user_id(DEVELOPER)
+        self.assertEquals({
+            u'hello' : (u'Hola', False, True, developer_id),
+            u'bye' : (u'Bye', True, True, developer_id),
+            u'other' : (u'Other', True, False, developer_id),
+        }, self.active_messages('app1'))
+        self.assertEquals([ (u'Hola', developer_id, None) ], self.history('app1', u'hello'))
+        self.assertActiveHistoryConsistent()
+        self.assertSummariesConsistent()
+
+        # A translator changes it; the developer sending the same message again does not override it
+        self.store('app1', TRANSLATOR, { u'hello' : u'Buenas' }, originals)
+        self.store('app1', DEVELOPER, { u'hello' : u'Hola', u'bye' : u'Bye' }, originals, from_developer = True)
+
+        translator_id = self.user_id(TRANSLATOR)
+        first_history_id = db.session.query(TranslationMessageHistory.id).filter_by(key = u'hello', value = u'Hola').one()[0]
+        self.assertEquals((u'Buenas', False, False, translator_id), self.active_messages('app1')[u'hello'])
+        self.assertEquals([ (u'Hola', developer_id, None), (u'Buenas', translator_id, first_history_id) ], self.history('app1', u'hello'))
+
+        # A message which is not in the original messages anymore is deleted
+        del originals[u'other']
+        self.store('app1', DEVELOPER, None, originals, from_developer = True)
+        self.assertEquals(set([ u'hello', u'bye' ]), set(self.active_messages('app1')))
+        self.assertActiveHistoryConsistent()
+        self.assertSummariesConsistent()
+
+    def test_large_bundle(self):
+        "More messages than a chunk: each active message points to the history message of its key"
+        texts = dict([ (u'message_{0}'.format(position), u'Message {0}'.format(position)) for position in xrange(1200) ])
+        originals = original_messages(texts)
+        self.store('app1', DEVELOPER, dict([ (key, u'Mensaje ' + key) for key in texts ]), originals, from_developer = True)
+        self.store('app1', TRANSLATOR, dict([ (key, u'Otro ' + key) for key in sorted(texts)[::2] ]), originals)
+
+        messages = self.active_messages('app1')
+        self.assertEquals(1200, len(messages))
+        self.assertEquals(u'Otro message_0', messages[u'message_0'][0])
+        self.assertEquals(u'Mensaje message_1', messages[u'message_1'][0])
+        self.assertActiveHistoryConsistent()
+        self.assertSummariesConsistent()
+
+    def test_namespace_propagation(self):
+        self.add_to_repository('app1')
+        self.add_to_repository('app2')
+        originals = original_messages({ u'hello' : u'Hello', u'title' : u'Title' }, namespace = u'common')
+
+        self.store('app1', TRANSLATOR, { u'hello' : u'Hola' }, originals)
+        # app2 takes the translation of the same namespace
+        self.store('app2', DEVELOPER, None, originals, from_developer = True)
+
+        translator_id = self.user_id(TRANSLATOR)
+        developer_id = self.user_id(DEVELOPER)
+        self.assertEquals((u'Hola', False, False, translator_id), self.active_messages('app2')[u'hello'])
+        self.assertEquals((u'Title', True, False, developer_id), self.active_messages('app2')[u'title'])
+
+        # A new translation is copied to the other bundles, with the credentials of who translated it
+        previous_revision = retrieve_stored(translation_url('app2'), u'es_ALL', u'ALL')[0][u'hello']['revision']
+        self.store('app1', OTHER_TRANSLATOR, { u'hello' : u'Saludos' }, originals)
+        other_translator_id = self.user_id(OTHER_TRANSLATOR)
+        self.assertEquals((u'Saludos', False, False, other_translator_id), self.active_messages('app1')[u'hello'])
+        self.assertEquals((u'Saludos', False, False, other_translator_id), self.active_messages('app2')[u'hello'])
+        self.assertEquals((u'Saludos', other_translator_id, previous_revision), self.history('app2', u'hello')[-1])
+
+        # The same value is not copied again
+        history_size = len(self.history('app2', u'hello'))
+        self.store('app1', TRANSLATOR, { u'hello' : u'Saludos' }, originals)
+        self.assertEquals(history_size, len(self.history('app2', u'hello')))
+
+        # Other languages are not affected
+        self.store('app1', TRANSLATOR, { u'hello' : u'Bonjour' }, originals, language = u'fr_ALL')
+        self.assertEquals(u'Saludos', self.active_messages('app2')[u'hello'][0])
+
+        self.assertActiveHistoryConsistent()
+        self.assertSummariesConsistent()
+
+    def test_existing_namespace_translations(self):
+        "Messages taken from default in a bundle are replaced by the translations of the same namespace"
+        self.add_to_repository('app1')
+        originals = original_messages({ u'hello' : u'Hello' }, namespace = u'common')
+        app2_originals = original_messages({ u'hello' : u'Hello' }, namespace = u'common')
+        app2_originals.update(original_messages({ u'title' : u'Title' }))
+
+        # app2 is not in the repository yet, so nothing is copied to it
+        self.store('app2', DEVELOPER, None, app2_originals, from_developer = True)
+        self.store('app1', TRANSLATOR, { u'hello' : u'Hola' }, originals)
+        self.assertTrue(self.active_messages('app2')[u'hello'][1])
+
+        self.add_to_repository('app2')
+        self.store('app2', OTHER_TRANSLATOR, { u'title' : u'Titulo' }, app2_originals)
+
+        # The copied message keeps its author, and the new one is attributed to who translated it
+        self.assertEquals((u'Hola', False, False, self.user_id(TRANSLATOR)), self.active_messages('app2')[u'hello'])
+        self.assertEquals((u'Titulo', False, False, self.user_id(OTHER_TRANSLATOR)), self.active_messages('app2')[u'title'])
+        self.assertActiveHistoryConsistent()
+        self.assertSummariesConsistent()
+
+    def test_expected_revisions(self):
+        originals = original_messages({ u'hello' : u'Hello', u'bye' : u'Bye' })
+        self.store('app1', TRANSLATOR, { u'hello' : u'Hola', u'bye' : u'Adios' }, originals)
+        stored, from_developer, automatic = retrieve_stored(translation_url('app1'), u'es_ALL', u'ALL')
+        revisions = dict([ (key, message['revision']) for key, message in stored.items() ])
+
+        # Somebody else changes hello meanwhile
+        self.store('app1', OTHER_TRANSLATOR, { u'hello' : u'Buenas' }, originals, expected_revisions = revisions)
+        current_revision = retrieve_stored(translation_url('app1'), u'es_ALL', u'ALL')[0][u'hello']['revision']
+        self.assertNotEquals(revisions[u'hello'], current_revision)
+
+        conflicts = self.store('app1', TRANSLATOR, { u'hello' : u'Saludos', u'bye' : u'Chao' }, originals, expected_revisions = revisions)
+        self.assertEquals({ u'hello' : current_revision }, conflicts)
+        messages = self.active_messages('app1')
+        self.assertEquals(u'Buenas', messages[u'hello'][0])
+        self.assertEquals(u'Chao', messages[u'bye'][0])
+        self.assertSummariesConsistent()
+
+    def test_orm_changes(self):
+        "Changes through the ORM (namespace changes, copies of bundles) are summarized when committing"
+        originals = original_messages({ u'hello' : u'Hello', u'bye' : u'Bye' }, tool_id = u'tool1')
+        self.store('app1', TRANSLATOR, { u'hello' : u'Hola' }, originals)
+        self.store('app1', TRANSLATOR, { u'hello' : u'Bonjour' }, originals, language = u'fr_ALL')
+        self.assertSummariesConsistent()
+
+        originals = original_messages({ u'hello' : u'Hello', u'bye' : u'Bye' }, namespace = u'common', tool_id = u'tool2')
+        self.store('app1', TRANSLATOR, None, originals)
+        self.assertSummariesConsistent()
+
+        # Same app with a new translation URL: the bundles are copied
+        self.store('app1', TRANSLATOR, { u'bye' : u'Adios' }, originals, translation_name = 'app1-new')
+        self.assertEquals(u'Hola', self.active_messages('app1-new')[u'hello'][0])
+        self.assertEquals(u'Adios', self.active_messages('app1-new')[u'bye'][0])
+        self.assertSummariesConsistent()
+
+    def test_repair_bundle_stats(self):
+        self.store('app1', TRANSLATOR, { u'hello' : u'Hola' }, original_messages({ u'hello' : u'Hello' }, tool_id = u'tool1'))
+        stats_table = TranslationBundleStats.__table__
+        db.session.execute(stats_table.update().values(translated = 5))
+        db.session.execute(TranslationBundleTool.__table__.delete())
+        db.session.commit()
+
+        self.assertEquals(1, repair_bundle_stats())
+        self.assertSummariesConsistent()
+
+class TestTranslationsStats(TranslatorOpsTest):
+
+    def test_stored_stats(self):
+        originals = original_messages({ u'hello' : u'Hello', u'bye' : u'Bye' })
+        self.store('app1', TRANSLATOR, { u'hello' : u'Hola' }, originals)
+        self.store('app1', TRANSLATOR, { u'hello' : u'Bonjour', u'bye' : u'Au revoir' }, originals, language = u'fr_ALL')
+        self.assertEquals({ u'es_ALL_ALL' : 0.5, u'fr_ALL_ALL' : 1.0 }, retrieve_translations_percent(translation_url('app1'), originals))
+
+    def test_original_messages_changed(self):
+        "The app removed messages and has not been synchronized yet: only the current ones are counted"
+        originals = original_messages({ u'hello' : u'Hello', u'bye' : u'Bye', u'other' : u'Other' })
+        self.store('app1', TRANSLATOR, { u'hello' : u'Hola', u'bye' : u'Adios', u'other' : u'Otro' }, originals)
+        new_originals = original_messages({ u'hello' : u'Hello' })
+        self.assertEquals({ u'es_ALL_ALL' : 1.0 }, retrieve_translations_percent(translation_url('app1'), new_originals))
+
+        stats, dependencies = retrieve_translations_stats(translation_url('app1'), new_originals)
+        self.assertEquals((1, 1), (stats[u'es_ALL']['targets'][u'ALL']['translated'], stats[u'es_ALL']['targets'][u'ALL']['items']))
+
+class TestLocks(TranslatorOpsTest):
+
+    def test_expired_lock(self):
+        lock_objs = ops._acquire_locks([ u'locks:test' ])
+        ops._held_locks.lock_objs = lock_objs
+        try:
+            ops._extend_locks()
+            redis_store.delete(u'locks:test')
+            self.assertRaises(Exception, ops._extend_locks)
+        finally:
+            ops._held_locks.lock_objs = None
+            ops._release_locks(lock_objs)
+
+    def test_translation_url_is_locked(self):
+        "Different bundles of the same translation url share the rows of the url, so they are serialized"
+        originals = original_messages({ u'hello' : u'Hello' })
+        es_keys = ops._translation_lock_keys(TRANSLATOR, app_url('app1'), translation_url('app1'), {}, u'es_ALL', u'ALL', {}, originals, False)
+        fr_keys = ops._translation_lock_keys(TRANSLATOR, app_url('app1'), translation_url('app1'), {}, u'fr_ALL', u'ALL', {}, originals, False)
+        self.assertIn(ops._translation_url_lock_key(translation_url('app1')), set(es_keys) & set(fr_keys))
+
+    def test_integrity_error_is_reported_to_users(self):
+        originals = original_messages({ u'hello' : u'Hello' })
+        integrity_error = IntegrityError("INSERT", {}, Exception("duplicated"))
+        with patch.object(db.session, 'commit', side_effect = integrity_error):
+            self.assertRaises(TranslatorError, self.store, 'app1', TRANSLATOR, { u'hello' : u'Hola' }, originals)
+
+        # The synchronization with the developer will simply try again
+        with patch.object(db.session, 'commit', side_effect = integrity_error):
+            self.store('app1', DEVELOPER, { u'hello' : u'Hola' }, originals, from_developer = True)
+
+class TestSuggestionCounters(TranslatorOpsTest):
+
+    def suggestions(self):
+        return (
+            dict([ ((suggestion.key, suggestion.value), suggestion.number) for suggestion in db.session.query(TranslationKeySuggestion).all() ]),
+            dict([ ((suggestion.human_key, suggestion.value), suggestion.number) for suggestion in db.session.query(TranslationValueSuggestion).all() ]),
+        )
+
+    def test_flush(self):
+        originals = original_messages({ u'hello' : u'Hello' })
+        self.store('app1', TRANSLATOR, { u'hello' : u'Hola' }, originals)
+        self.store('app2', TRANSLATOR, { u'hello' : u'Hola' }, originals)
+        self.assertEquals(({}, {}), self.suggestions())
+
+        self.assertEquals(2, flush_suggestion_counters())
+        self.assertEquals(({ (u'hello', u'Hola') : 2 }, { (u'Hello', u'Hola') : 2 }), self.suggestions())
+
+        # Nothing else to flush
+        self.assertEquals(0, flush_suggestion_counters())
+        self.assertEquals(({ (u'hello', u'Hola') : 2 }, { (u'Hello', u'Hola') : 2 }), self.suggestions())
+
+    def test_flush_crash_is_not_counted_twice(self):
+        self.store('app1', TRANSLATOR, { u'hello' : u'Hola' }, original_messages({ u'hello' : u'Hello' }))
+
+        # The worker dies after committing, before deleting the counters
+        with patch.object(redis_store, 'delete', side_effect = Exception("crash")):
+            self.assertRaises(Exception, flush_suggestion_counters)
+        db.session.remove()
+        self.assertEquals(({ (u'hello', u'Hola') : 1 }, {}), self.suggestions())
+
+        flush_suggestion_counters()
+        flush_suggestion_counters()
+        self.assertEquals(({ (u'hello', u'Hola') : 1 }, { (u'Hello', u'Hola') : 1 }), self.suggestions())
+
+    def test_no_suggestions_after_rollback(self):
+        with patch.object(db.session, 'commit', side_effect = Exception("failure")):
+            self.assertRaises(Exception, self.store, 'app1', TRANSLATOR, { u'hello' : u'Hola' }, original_messages({ u'hello' : u'Hello' }))
+
+        for model, column_name, counters_key in ops.SUGGESTION_COUNTERS:
+            self.assertFalse(redis_store.exists(counters_key))
+        self.assertEquals(0, flush_suggestion_counters())
@@ -0,0 +1,84 @@
+import datetime
+import unittest
+
+from appcomposer import redis_store
+from appcomposer.translator.scheduler import RecheckScheduler
+
+TEST_PREFIX = 'appcomposer:tests:schedule'
+NOW = 1000000
+
+class RecheckSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self._cleanup()
+        # No jitter, so the next checks can be compared
+        self.scheduler = RecheckScheduler(prefix = TEST_PREFIX, min_interval = 100, max_interval = 1000,
+                                failing_min_interval = 50, failing_max_interval = 300, jitter = 0)
+
+    def tearDown(self):
+        self._cleanup()
+
+    def _cleanup(self):
+        keys = redis_store.keys(TEST_PREFIX + '*')
+        if keys:
+            redis_store.delete(*keys)
+
+    def next_check(self, app_id):
+        return redis_store.zscore(TEST_PREFIX, unicode(app_id)) - NOW
+
+    def test_sync(self):
+        self.scheduler.sync([ 1, 2, 3 ])
+        self.assertEquals(set([ 1, 2, 3 ]), self.scheduler.due(NOW))
+
+        self.scheduler.record([ (1, False, False, None) ], NOW)
+        self.scheduler.sync([ 1, 2, 4 ])
+        self.assertEquals(set([ 2, 4 ]), self.scheduler.due(NOW))
+        # Already scheduled apps keep their schedule
+        self.assertEquals(set([ 1, 2, 4 ]), self.scheduler.due(NOW + 200))
+        self.assertEquals({ 'scheduled' : 3, 'due' : 2, 'failing' : 0 }, self.scheduler.stats(NOW))
+
+    def test_backoff(self):
+        self.scheduler.sync([ 1 ])
+        delays = []
+        for position in range(6):
+            self.scheduler.record([ (1, False, False, None) ], NOW)
+            delays.append(self.next_check(1))
+        self.assertEquals([ 200, 400, 800, 1000, 1000, 1000 ], delays)
+
+        # A change takes it back to the minimum interval
+        self.scheduler.record([ (1, True, False, None) ], NOW)
+        self.assertEquals(100, self.next_check(1))
+
+    def test_initial_interval(self):
+        long_ago = datetime.datetime.utcnow() - datetime.timedelta(days = 30)
+        recently = datetime.datetime.utcnow() - datetime.timedelta(seconds = 400)
+        self.scheduler.record([ (1, False, False, long_ago), (2, False, False, recently), (3, False, False, None) ], NOW)
+        self.assertEquals(1000, self.next_check(1))
+        self.assertEquals(200, self.next_check(2))
+        self.assertEquals(200, self.next_check(3))
+
+    def test_failures(self):
+        self.scheduler.record([ (1, False, False, None) ], NOW)
+        self.scheduler.record([ (1, False, False, None) ], NOW)
+        self.assertEquals(400, self.next_check(1))
+
+        delays = []
+        for position in range(5):
+            self.scheduler.record([ (1, False, True, None) ], NOW)
+            delays.append(self.next_check(1))
+        self.assertEquals([ 50, 100, 200, 300, 300 ], delays)
+        self.assertEquals(1, self.scheduler.stats(NOW)['failing'])
+
+        # Once it works again, it goes on with the interval it had
+        self.scheduler.record([ (1, False, False, None) ], NOW)
+        self.assertEquals(800, self.next_check(1))
+        self.assertEquals(0, self.scheduler.stats(NOW)['failing'])
+
+        # And if it fails again, the backoff starts again
+        self.scheduler.record([ (1, False, True, None) ], NOW)
+        self.assertEquals(50, self.next_check(1))
+
+    def test_jitter(self):
+        scheduler = RecheckScheduler(prefix = TEST_PREFIX, min_interval = 100, max_interval = 1000, jitter = 0.1)
+        for position in range(20):
+            scheduler.record([ (position, True, False, None) ], NOW)
+            self.assertTrue(90 <= self.next_check(position) <= 110)
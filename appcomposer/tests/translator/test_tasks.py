@@ -0,0 +1,76 @@
+import time
+import unittest
+
+from mock import patch
+
+from appcomposer import redis_store
+import appcomposer.translator.tasks as tasks
+
+APP_URL = u'http://localhost/apps/debounced/gadget.xml'
+NOW = 1000000.0
+
+class DebounceTest(unittest.TestCase):
+    def setUp(self):
+        self._cleanup()
+        self.now = NOW
+        patchers = [
+            patch.object(time, 'time', side_effect = lambda : self.now),
+            patch.object(tasks, '_debounce_periods', return_value = (10, 60)),
+            patch.object(tasks.task_synchronize_single_app_debounced, 'apply_async'),
+            patch.object(tasks, 'task_synchronize_single_app'),
+        ]
+        mocks = []
+        for patcher in patchers:
+            mocks.append(patcher.start())
+            self.addCleanup(patcher.stop)
+        self.apply_async, self.synchronize = mocks[2:]
+
+    def tearDown(self):
+        self._cleanup()
+
+    def _cleanup(self):
+        redis_store.delete(*tasks._debounce_keys(APP_URL))
+
+    def change(self, seconds_later = 0):
+        self.now += seconds_later
+        tasks.schedule_single_app_synchronization('update', APP_URL)
+
+    def run_debounced(self, seconds_later):
+        self.now += seconds_later
+        self.apply_async.reset_mock()
+        tasks.task_synchronize_single_app_debounced('update', APP_URL)
+
+    def test_coalesced(self):
+        self.change()
+        self.change(2)
+        self.change(3)
+        # Only the first change enqueues the task
+        self.apply_async.assert_called_once_with(('update', APP_URL), countdown = 10)
+
+        # It runs 10 seconds after the first change, but the last one was 5 seconds ago
+        self.run_debounced(5)
+        self.apply_async.assert_called_once_with(('update', APP_URL), countdown = 5)
+        self.assertFalse(self.synchronize.called)
+
+        self.run_debounced(5)
+        self.assertFalse(self.apply_async.called)
+        self.synchronize.assert_called_once_with(source = 'update', single_app_url = APP_URL)
+
+        # A new change enqueues it again
+        self.change(1)
+        self.assertEquals(1, self.apply_async.call_count)
+
+    def test_max_delay(self):
+        "An app which is being changed all the time is synchronized at least every 60 seconds"
+        self.change()
+        for position in range(10):
+            self.change(7)
+        self.run_debounced(0)
+        self.synchronize.assert_called_once_with(source = 'update', single_app_url = APP_URL)
+
+    def test_expired_keys(self):
+        "If the keys expired meanwhile, it is synchronized anyway"
+        self.change()
+        self._cleanup()
+        self.run_debounced(10)
+        self.synchronize.assert_called_once_with(source = 'update', single_app_url = APP_URL)
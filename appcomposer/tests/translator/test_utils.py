@@ -0,0 +1,270 @@
+import time
+import threading
+import unittest
+import StringIO
+
+import requests
+from mock import patch
+from requests.packages.urllib3.response import HTTPResponse
+
+from appcomposer import redis_store
+from appcomposer.translator.utils import BoundedRedisCache, HostSessions, CircuitBreaker, CircuitOpenError, RedisSingleFlight
+
+TEST_PREFIX = 'appcomposer:tests:http:cache'
+
+class BoundedRedisCacheTest(unittest.TestCase):
+    def setUp(self):
+        self._cleanup()
+        self.cache = BoundedRedisCache(prefix = TEST_PREFIX, max_bytes = 1000)
+
+    def tearDown(self):
+        self._cleanup()
+
+    def _cleanup(self):
+        keys = redis_store.keys(TEST_PREFIX + '*')
+        if keys:
+            redis_store.delete(*keys)
+
+    def test_set_get(self):
+        self.cache.set('http://localhost/a', 'a' * 100)
+        self.assertEquals('a' * 100, self.cache.get('http://localhost/a'))
+        self.assertIsNone(self.cache.get('http://localhost/b'))
+
+        self.cache.set('http://localhost/a', 'a' * 50)
+        stats = self.cache.stats()
+        self.assertEquals((1, 1, 50, 1), (stats['hits'], stats['misses'], stats['bytes'], stats['responses']))
+
+        self.cache.delete('http://localhost/a')
+        self.assertIsNone(self.cache.get('http://localhost/a'))
+        self.assertEquals(0, self.cache.stats()['bytes'])
+
+    def test_evict_least_recently_used(self):
+        for position in range(9):
+            self.cache.set('http://localhost/{0}'.format(position), 'x' * 100)
+        # 0 is used again, so 1 is now the least recently used
+        self.cache.get('http://localhost/0')
+
+        # 1100 bytes: only the two least recently used are needed to go below 900
+        self.cache.set('http://localhost/9', 'x' * 200)
+        self.assertIsNone(self.cache.get('http://localhost/1'))
+        self.assertIsNone(self.cache.get('http://localhost/2'))
+        for position in [ 0 ] + range(3, 9):
+            self.assertIsNotNone(self.cache.get('http://localhost/{0}'.format(position)))
+
+        stats = self.cache.stats()
+        self.assertEquals((2, 900, 8), (stats['evictions'], stats['bytes'], stats['responses']))
+
+    def test_evict_response_bigger_than_cache(self):
+        self.cache.set('http://localhost/big', 'x' * 1200)
+        self.assertIsNone(self.cache.get('http://localhost/big'))
+        self.cache.set('http://localhost/small', 'x' * 10)
+        self.assertIsNotNone(self.cache.get('http://localhost/small'))
+        self.assertEquals(10, self.cache.stats()['bytes'])
+
+def _streamed_response(contents):
+    r = requests.Response()
+    r.status_code = 200
+    r.raw = HTTPResponse(body = StringIO.StringIO(contents), preload_content = False)
+    return r
+
+class HostSessionsTest(unittest.TestCase):
+    def setUp(self):
+        self.sessions = HostSessions(per_host = 1, caching = False)
+
+    def tearDown(self):
+        self.sessions.close()
+
+    def slot_is_free(self, host = 'localhost'):
+        session, semaphore = self.sessions._get_session(host)
+        if semaphore.acquire(False):
+            semaphore.release()
+            return True
+        return False
+
+    def test_single_adapter_per_host(self):
+        session, semaphore = self.sessions._get_session('localhost')
+        self.assertIs(session.get_adapter('http://localhost/'), session.get_adapter('https://localhost/'))
+        self.assertEquals(1, len(set([ id(adapter) for adapter in session.adapters.values() ])))
+        self.assertIsNot(session, self.sessions._get_session('example.com')[0])
+
+    @patch("appcomposer.translator.utils.circuit_breaker")
+    def test_slot_released(self, circuit_breaker):
+        circuit_breaker.get.return_value = _streamed_response('contents')
+        self.sessions.get('http://localhost/app.xml')
+        self.assertTrue(self.slot_is_free())
+
+        circuit_breaker.get.side_effect = requests.ConnectionError("down")
+        self.assertRaises(requests.ConnectionError, self.sessions.get, 'http://localhost/app.xml')
+        self.assertTrue(self.slot_is_free())
+
+    @patch("appcomposer.translator.utils.circuit_breaker")
+    def test_streamed_slot_held_until_closed(self, circuit_breaker):
+        circuit_breaker.get.return_value = _streamed_response('<html><head></head><body></body></html>')
+        response = self.sessions.get('http://localhost/app.html', stream = True)
+        self.assertFalse(self.slot_is_free())
+        self.assertTrue(self.slot_is_free('example.com'))
+
+        self.assertEquals('<html>', response.raw.read(6))
+        self.assertFalse(self.slot_is_free())
+
+        response.close()
+        self.assertTrue(self.slot_is_free())
+        # Closing it again does not release the slot twice
+        response.close()
+        self.assertTrue(self.slot_is_free())
+
+CIRCUIT_PREFIX = 'appcomposer:tests:http:circuit'
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self._cleanup()
+        self.breaker = CircuitBreaker(prefix = CIRCUIT_PREFIX, max_failures = 3, cooldown = 60)
+        self.session = requests.Session()
+        self.responses = []
+        patcher = patch.object(self.session, 'get', side_effect = self._next_response)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self._cleanup()
+
+    def _cleanup(self):
+        keys = redis_store.keys(CIRCUIT_PREFIX + '*')
+        if keys:
+            redis_store.delete(*keys)
+
+    def _next_response(self, url, **kwargs):
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        r = requests.Response()
+        r.status_code = response
+        return r
+
+    def get(self, *responses):
+        self.responses.extend(responses)
+        return self.breaker.get(self.session, 'http://localhost/app.xml')
+
+    def test_failures_must_be_consecutive(self):
+        for response in (500, requests.Timeout("timeout"), 200, 502, requests.ConnectionError("down"), 404):
+            try:
+                self.get(response)
+            except requests.RequestException:
+                pass
+        self.assertEquals(404, self.get(404).status_code)
+        self.assertEquals(0, len(self.responses))
+
+    def test_open_circuit(self):
+        self.get(500)
+        self.assertRaises(requests.ConnectionError, self.get, requests.ConnectionError("down"))
+        self.assertRaises(requests.Timeout, self.get, requests.Timeout("timeout"))
+
+        # The request is not even sent, neither to this host nor to its other URLs
+        self.assertRaises(CircuitOpenError, self.get, 200)
+        self.assertRaises(CircuitOpenError, self.breaker.get, self.session, 'http://LOCALHOST/other.xml')
+        self.assertEquals([ 200 ], self.responses)
+        self.assertEquals(2, int(redis_store.hget(CIRCUIT_PREFIX + ':localhost', 'skipped')))
+
+        # Other hosts are not affected
+        self.assertEquals(200, self.breaker.get(self.session, 'http://example.com/app.xml').status_code)
+
+    def test_probe(self):
+        for position in range(3):
+            self.get(500)
+        self.assertRaises(CircuitOpenError, self.get)
+
+        with patch.object(time, 'time', return_value = time.time() + 61):
+            # Only one request is sent as a probe; the rest are skipped meanwhile
+            self.breaker.before('localhost')
+            self.assertRaises(CircuitOpenError, self.breaker.before, 'localhost')
+
+            # The probe fails: open again
+            self.breaker.failure('localhost')
+
+        with patch.object(time, 'time', return_value = time.time() + 62):
+            self.assertRaises(CircuitOpenError, self.get)
+
+        with patch.object(time, 'time', return_value = time.time() + 130):
+            # The probe works: closed
+            self.assertEquals(200, self.get(200).status_code)
+            self.assertEquals(200, self.get(200).status_code)
+
+SINGLE_FLIGHT_PREFIX = 'appcomposer:tests:single-flight:'
+
+class RedisSingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        self._cleanup()
+        self.single_flight = RedisSingleFlight(SINGLE_FLIGHT_PREFIX, poll_interval = 0.01)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.stored = {}
+
+    def tearDown(self):
+        self._cleanup()
+
+    def _cleanup(self):
+        keys = redis_store.keys(SINGLE_FLIGHT_PREFIX + '*')
+        if keys:
+            redis_store.delete(*keys)
+
+    def func(self, duration = 0.2, failures = 0):
+        "Store (and return) a new result after duration seconds. The first failures calls fail."
+        def func():
+            with self.lock:
+                self.calls += 1
+                call = self.calls
+            time.sleep(duration)
+            if call <= failures:
+                raise ValueError("failure")
+            self.stored['app'] = 'result {0}'.format(call)
+            return self.stored['app']
+        return func
+
+    def load(self):
+        return self.stored.get('app')
+
+    def run_concurrently(self, func, threads = 5):
+        results = []
+        errors = []
+        def run():
+            try:
+                results.append(self.single_flight.run('app', func, self.load))
+            except ValueError as e:
+                errors.append(e)
+
+        running = [ threading.Thread(target = run) ]
+        running[0].start()
+        time.sleep(0.05)
+        for _ in range(threads - 1):
+            running.append(threading.Thread(target = run))
+            running[-1].start()
+        for thread in running:
+            thread.join()
+        return results, errors
+
+    def test_single_call(self):
+        results, errors = self.run_concurrently(self.func())
+        self.assertEquals(1, self.calls)
+        self.assertEquals([ 'result 1' ] * 5, results)
+        self.assertEquals([], errors)
+
+    def test_failure(self):
+        "The first caller fails: one of the waiters runs it again"
+        results, errors = self.run_concurrently(self.func(failures = 1))
+        self.assertEquals(2, self.calls)
+        self.assertEquals([ 'result 2' ] * 4, results)
+        self.assertEquals(1, len(errors))
+
+    def test_finished_before(self):
+        "Those arriving after it finished do not reuse an old result"
+        self.assertEquals('result 1', self.single_flight.run('app', self.func(duration = 0), self.load))
+        self.assertEquals('result 2', self.single_flight.run('app', self.func(duration = 0), self.load))
+
+    def test_wait_timeout(self):
+        single_flight = RedisSingleFlight(SINGLE_FLIGHT_PREFIX, poll_interval = 0.01, wait_timeout = 0.2)
+        # Somebody else is running it (and never finishes)
+        redis_store.set(SINGLE_FLIGHT_PREFIX + 'app', 'other', ex = 60)
+        t0 = time.time()
+        self.assertEquals('result 1', single_flight.run('app', self.func(duration = 0), self.load))
+        self.assertLess(time.time() - t0, 1)
+        self.assertEquals('other', redis_store.get(SINGLE_FLIGHT_PREFIX + 'app'))
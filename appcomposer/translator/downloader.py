@@ -12,9 +12,9 @@ import sys
 import zlib
 import time
 import json
+import hashlib
 import urlparse
 import datetime
-import threading
 import traceback
 
 import certifi
@@ -28,8 +28,11 @@ from flask import current_app
 from appcomposer import db, redis_store
 from appcomposer.models import RepositoryApp, RepositoryAppCheckUrl
 import appcomposer.translator.utils as trutils
-from appcomposer.translator.ops import calculate_content_hash
-from appcomposer.translator.extractors import extract_metadata_information, extract_check_url_metadata
+from appcomposer.translator.ops import calculate_content_hash, calculate_legacy_content_hash, is_legacy_content_hash
+from appcomposer.translator.extractors import extract_metadata_information, extract_check_url_metadata, invalidate_local_translations_cache, \
+            is_legacy_translations_hash, calculate_legacy_translations_hash
+from appcomposer.translator.executor import FetchTask, create_executor, THREADS_ENGINE, GEVENT_ENGINE
+from appcomposer.translator.scheduler import RecheckScheduler
 
 from celery.utils.log import get_task_logger
 
@@ -41,16 +44,24 @@ logger = get_task_logger(__name__)
 DEBUG = True
 DEBUG_VERBOSE = False
 
+# Seconds after which a single app (XML and all its locales) or a single check URL are given up
+_METADATA_TASK_TIMEOUT = 5 * 60
+_CHECK_URL_TASK_TIMEOUT = 2 * 60
+
 def sync_repo_apps(force=False):
     """
     This script does not download anything related to the apps: it only checks golabz, and for repo app there,
     it synchronizes the table RepositoryApp adding new apps, deleting expired ones or updating existing ones.
 
     It stores in redis the hash of the Go-Lab repos, so if there is no change, it does not need to look in the database.
+    It also stores a fingerprint of each app record, so only those apps which changed (or are not in golabz anymore)
+    are loaded and written; the rest of the RepositoryApp rows are not even read.
 
-    Optionally, if force=True, then it will still go through the process, but it is very unlikely that it is ever needed.
+    Optionally, if force=True (or if there are no fingerprints, e.g., Redis was flushed), every app is loaded and
+    written as if it had changed, and every app in the database which is not in golabz is deleted. This repairs
+    the table if it was changed behind the fingerprints' back.
 
-    It return True if there was any change
+    It returns True if any app was added, updated or deleted.
     """
     last_hash = redis_store.get('last_repo_apps_sync_hash')
     downloaded_apps, new_hash = _get_all_apps(last_hash if not force else u'')
@@ -69,49 +80,80 @@ def sync_repo_apps(force=False):
     for app in downloaded_apps:
         apps_by_repo_id[app['repository'], unicode(app['id'])] = app
 
-    stored_apps = db.session.query(RepositoryApp).all()
-    stored_ids = [
-        # (repo, external_id)
-    ]
+    #
+    # Only those apps whose golabz record changed (or which are not in golabz anymore) are loaded and written
+    #
+    current_fingerprints = dict( (repo_id, _golabz_fingerprint(app)) for repo_id, app in apps_by_repo_id.iteritems() )
+    stored_fingerprints = _load_golabz_fingerprints()
+
+    changed_ids = set([ repo_id for repo_id, fingerprint in current_fingerprints.iteritems() if stored_fingerprints.get(repo_id) != fingerprint ])
+    deleted_ids = set(stored_fingerprints) - set(current_fingerprints)
+
+    if force or not stored_fingerprints:
+        # Do not trust the fingerprints: the RepositoryApp of an app could be missing (or outdated) even
+        # if its fingerprint did not change
+        changed_ids = set(current_fingerprints)
+
+        # Also look for apps in the database which are not in the fingerprints (e.g., Redis was flushed)
+        for repository, external_id in db.session.query(RepositoryApp.repository, RepositoryApp.external_id).all():
+            repo_id = (repository, unicode(external_id))
+            if repo_id not in current_fingerprints:
+                deleted_ids.add(repo_id)
+
+    stored_apps = {
+        # (repository, id): repo_app
+    }
+    external_ids = sorted(set([ external_id for repository, external_id in changed_ids.union(deleted_ids) ]))
+    for position in xrange(0, len(external_ids), 500):
+        query = db.session.query(RepositoryApp).filter(RepositoryApp.external_id.in_(external_ids[position:position + 500]))
+        for repo_app in query.all():
+            repo_id = (repo_app.repository, unicode(repo_app.external_id))
+            if repo_id in changed_ids or repo_id in deleted_ids:
+                stored_apps[repo_id] = repo_app
+
+    print "golabz apps: {0} changed, {1} deleted".format(len(changed_ids), len(deleted_ids))
 
     #
     # Update or delete existing apps
     #
-    for repo_app in stored_apps:
-        external_id = unicode(repo_app.external_id)
-        if (repo_app.repository, external_id) in apps_by_repo_id:
-            stored_ids.append((repo_app.repository, unicode(external_id)))
-            app = apps_by_repo_id[repo_app.repository, external_id]
-            _update_existing_app(repo_app, app_url = app['app_url'], title = app['title'], app_thumb = app.get('app_thumb'), preview_link = app.get('preview_link'), description = app.get('description'), app_image = app.get('app_image'), app_link = app.get('app_golabz_page'), repository = app['repository'], app_format=app.get('app_format', 'opensocial'))
-
-        else:
-            # Delete old apps (translations are kept, and the app is kept, but not listed in the repository apps)
-            objs = []
-            for db_url in repo_app.check_urls:
-                for db_failure in db_url.failures:
-                    objs.append(db_failure)
-            for db_url in repo_app.check_urls:
-                objs.append(db_url)
-            for db_lang in repo_app.languages:
-                objs.append(db_lang)
-
-            for obj_to_delete in objs:
-                db.session.delete(obj_to_delete)
-            db.session.delete(repo_app)
+    written = 0
+    for repo_id in deleted_ids:
+        repo_app = stored_apps.get(repo_id)
+        if repo_app is None:
+            continue
+        written += 1
+
+        # Delete old apps (translations are kept, and the app is kept, but not listed in the repository apps)
+        objs = []
+        for db_url in repo_app.check_urls:
+            for db_failure in db_url.failures:
+                objs.append(db_failure)
+        for db_url in repo_app.check_urls:
+            objs.append(db_url)
+        for db_lang in repo_app.languages:
+            objs.append(db_lang)
+
+        for obj_to_delete in objs:
+            db.session.delete(obj_to_delete)
+        db.session.delete(repo_app)
 
     #
-    # Add new apps
+    # Update existing apps or add new apps
     #
-    for app in downloaded_apps:
-        if (app['repository'], unicode(app['id'])) not in stored_ids:
-            # Double-check
-            repo_app = db.session.query(RepositoryApp).filter_by(repository = app['repository'], external_id = app['id']).first()
-            if repo_app is None:
-                _add_new_app(repository = app['repository'],
-                            app_url = app['app_url'], title = app['title'], external_id = app['id'],
-                            app_thumb = app.get('app_thumb'), description = app.get('description'),
-                            app_image = app.get('app_image'), app_link = app.get('app_golabz_page'), preview_link=app.get('preview_link'),
-                            app_format = app.get('app_format', 'opensocial'))
+    for repo_id in changed_ids:
+        app = apps_by_repo_id[repo_id]
+        repo_app = stored_apps.get(repo_id)
+        if repo_app is not None:
+            _update_existing_app(repo_app, app_url = app['app_url'], title = app['title'], app_thumb = app.get('app_thumb'), preview_link = app.get('preview_link'), description = app.get('description'), app_image = app.get('app_image'), app_link = app.get('app_golabz_page'), repository = app['repository'], app_format=app.get('app_format', 'opensocial'))
+            if db.session.is_modified(repo_app):
+                written += 1
+        else:
+            written += 1
+            _add_new_app(repository = app['repository'],
+                        app_url = app['app_url'], title = app['title'], external_id = app['id'],
+                        app_thumb = app.get('app_thumb'), description = app.get('description'),
+                        app_image = app.get('app_image'), app_link = app.get('app_golabz_page'), preview_link=app.get('preview_link'),
+                        app_format = app.get('app_format', 'opensocial'))
 
     try:
         db.session.commit()
@@ -121,12 +163,37 @@ def sync_repo_apps(force=False):
         return False
     else:
         redis_store.set('last_repo_apps_sync_hash', new_hash)
+        _store_golabz_fingerprints(dict( (repo_id, current_fingerprints[repo_id]) for repo_id in changed_ids ), deleted_ids)
     finally:
         db.session.remove()
 
     report_allowed_hosts()
 
-    return last_hash == new_hash
+    return written > 0
+
+_GOLABZ_FINGERPRINTS_KEY = 'appcomposer:repository:fingerprints'
+
+def _golabz_fingerprint(app):
+    """Hash of the fields of the golabz record which are stored in RepositoryApp"""
+    fields = [ app.get(field) for field in ('app_url', 'title', 'app_thumb', 'preview_link', 'description', 'app_image', 'app_golabz_page', 'repository', 'app_format') ]
+    return hashlib.md5(json.dumps(fields)).hexdigest()
+
+def _load_golabz_fingerprints():
+    fingerprints = {
+        # (repository, id): fingerprint
+    }
+    for field, fingerprint in redis_store.hgetall(_GOLABZ_FINGERPRINTS_KEY).iteritems():
+        repository, external_id = json.loads(field)
+        fingerprints[repository, external_id] = fingerprint
+    return fingerprints
+
+def _store_golabz_fingerprints(fingerprints, deleted_ids):
+    pipeline = redis_store.pipeline()
+    if fingerprints:
+        pipeline.hmset(_GOLABZ_FINGERPRINTS_KEY, dict( (json.dumps(list(repo_id)), fingerprint) for repo_id, fingerprint in fingerprints.iteritems() ))
+    if deleted_ids:
+        pipeline.hdel(_GOLABZ_FINGERPRINTS_KEY, *[ json.dumps(list(repo_id)) for repo_id in deleted_ids ])
+    pipeline.execute()
 
 def report_allowed_hosts():
     allowed_hosts_secret = current_app.config.get('ALLOWED_HOSTS_SECRET')
@@ -157,9 +224,16 @@ def report_allowed_hosts():
         except:
             traceback.print_exc()
 
+# The metadata of each app is stored in appcomposer:repository:cache:<app id>, compressed. The ids of the apps stored are
+# kept in a set. Previously, all the apps were stored uncompressed in a single hash in appcomposer:repository:cache;
+# _migrate_legacy_cache moves those to the new keys.
 _REDIS_CACHE_KEY = 'appcomposer:repository:cache'
+_REDIS_CACHE_IDS_KEY = _REDIS_CACHE_KEY + ':ids'
+_REDIS_CACHE_VERSION = 'z1:'
+# Apps retrieved from Redis in each round-trip by _retrieve_translatable_apps
+_REDIS_CACHE_CHUNK_SIZE = 100
 
-def download_repository_apps():
+def download_repository_apps(only_due=False):
     """This method assumes that the table RepositoryApp is updated in a different process.
 
     Therefore, it does not check in golabz, but just the database. The method itself is expensive, but can work in multiple threads processing all the requests.
@@ -168,30 +242,63 @@ def download_repository_apps():
 
     Then, other methods can check on the RepositoryApp table to see if anything has changed since the last time it was checked.
     Often, this will be "no", so no further database request will be needed.
+
+    If only_due=True, only those apps which are due according to the RecheckScheduler are downloaded (apps which
+    have not changed in a long time are checked less often).
     """
 
     repo_apps_by_id = {}
     tasks = []
 
-    stored_ids_in_redis = list(redis_store.hkeys(_REDIS_CACHE_KEY))
+    _migrate_legacy_cache()
+    stored_ids_in_redis = list(redis_store.smembers(_REDIS_CACHE_IDS_KEY))
 
-    for repo_app in db.session.query(RepositoryApp).all():
-        task = _MetadataTask(repo_app.id, repo_app.url, repo_app.preview_link, app_format=repo_app.app_format, force_reload=False)
-        repo_apps_by_id[repo_app.id] = repo_app
-        tasks.append(task)
+    sessions = _create_host_sessions(force_reload=False)
+    # Many apps share the same locale bundles: download and parse them once per cycle
+    locale_cache = trutils.SingleFlight()
+
+    scheduler = _create_scheduler()
+    repo_apps = db.session.query(RepositoryApp).all()
+    scheduler.sync([ repo_app.id for repo_app in repo_apps ])
+    if only_due:
+        due_ids = scheduler.due()
+
+    for repo_app in repo_apps:
         if str(repo_app.id) in stored_ids_in_redis:
             stored_ids_in_redis.remove(str(repo_app.id))
 
-    _RunInParallel('Go-Lab repo', tasks).run()
+        if only_due and repo_app.id not in due_ids:
+            continue
 
-    for key in stored_ids_in_redis:
-        redis_store.hdel(_REDIS_CACHE_KEY, key)
+        task = _MetadataTask(repo_app.id, repo_app.url, repo_app.preview_link, app_format=repo_app.app_format, force_reload=False, sessions=sessions, locale_cache=locale_cache)
+        repo_apps_by_id[repo_app.id] = repo_app
+        tasks.append(task)
+
+    if only_due:
+        print "{0} of {1} apps are due".format(len(tasks), len(repo_apps))
+
+    try:
+        _run_tasks('Go-Lab repo', tasks, _METADATA_TASK_TIMEOUT)
+    finally:
+        sessions.close()
+
+    print "{0} duplicate locale downloads saved".format(locale_cache.saved)
+    redis_store.hset('appcomposer:downloader:stats', 'locales_saved', locale_cache.saved)
+
+    _delete_cached_metadata(stored_ids_in_redis)
 
     app_changes = False
+    schedule_results = []
     for task in tasks:
         repo_app = repo_apps_by_id[task.repo_id]
-        if _update_repo_app(task=task, repo_app=repo_app):
+        if task.skipped:
+            schedule_results.append((repo_app.id, False, True, repo_app.last_download_change))
+            continue
+
+        changed = _update_repo_app(task=task, repo_app=repo_app)
+        if changed:
             app_changes = True
+        schedule_results.append((repo_app.id, changed, task.failing, repo_app.last_download_change))
 
     try:
         db.session.commit()
@@ -202,6 +309,9 @@ def download_repository_apps():
     else:
         db.session.remove()
 
+    scheduler.record(schedule_results)
+    redis_store.hmset('appcomposer:downloader:stats', scheduler.stats())
+
     report_allowed_hosts()
 
     return app_changes
@@ -217,11 +327,19 @@ def download_repository_single_app(app_url):
     if repo_app is None:
         raise Exception("App URL not in the repository: {}".format(app_url))
 
-    task = _MetadataTask(repo_app.id, repo_app.url, repo_app.preview_link, app_format=repo_app.app_format, force_reload=False)
+    sessions = _create_host_sessions(force_reload=False)
+    task = _MetadataTask(repo_app.id, repo_app.url, repo_app.preview_link, app_format=repo_app.app_format, force_reload=False, sessions=sessions, locale_cache=None)
+
+    try:
+        _run_tasks('Go-Lab repo', [ task ], _METADATA_TASK_TIMEOUT, workers = 1)
+    finally:
+        sessions.close()
 
-    _RunInParallel('Go-Lab repo', [ task ], thread_number=1).run()
+    if task.skipped:
+        return False
 
     changes = _update_repo_app(task=task, repo_app=repo_app)
+    schedule_results = [ (repo_app.id, changes, task.failing, repo_app.last_download_change) ]
 
     try:
         db.session.commit()
@@ -232,6 +350,8 @@ def download_repository_single_app(app_url):
     else:
         db.session.remove()
 
+    _create_scheduler().record(schedule_results)
+
     report_allowed_hosts()
 
     return changes
@@ -244,8 +364,12 @@ def update_content_hash(app_url):
         repo_app = db.session.query(RepositoryApp).filter_by(url=app_url).first()
         if repo_app:
             if repo_app.contents_hash != contents_hash:
+                if is_legacy_content_hash(repo_app.contents_hash) and repo_app.last_processed_contents_hash == repo_app.contents_hash and calculate_legacy_content_hash(app_url) == repo_app.contents_hash:
+                    # Calculated by a previous version, but nothing has changed: do not process it again
+                    repo_app.last_processed_contents_hash = contents_hash
+                else:
+                    repo_app.last_change = datetime.datetime.utcnow()
                 repo_app.contents_hash = contents_hash
-                repo_app.last_change = datetime.datetime.utcnow()
 
                 try:
                     db.session.commit()
@@ -288,7 +412,7 @@ def update_check_urls_status():
 
     db.session.remove()
 
-    _RunInParallel("check-urls", tasks).run()
+    _run_tasks("check-urls", tasks, _CHECK_URL_TASK_TIMEOUT)
 
     # Recalculate
     db_urls = db.session.query(RepositoryAppCheckUrl).filter(RepositoryAppCheckUrl.active == True).all()
@@ -373,7 +497,7 @@ def update_check_urls_status():
 
 
 def retrieve_updated_translatable_apps():
-    """This method collects information previously stored by other process into Redis, and returns only those apps which have changed, are translatable and not currently failing"""
+    """This method collects information previously stored by other process into Redis, and yields only those apps which have changed, are translatable and not currently failing"""
     return _retrieve_translatable_apps(query = db.session.query(RepositoryApp).filter(
                         RepositoryApp.translatable == True,                                  # Only translatable pages
                         RepositoryApp.failing == False,                                      # Which are not failing
@@ -388,14 +512,14 @@ def retrieve_updated_translatable_apps():
                 ))
 
 def retrieve_all_translatable_apps():
-    """This method collects information previously stored by other process into Redis, and returns only those apps which are translatable and not currently failing"""
+    """This method collects information previously stored by other process into Redis, and yields only those apps which are translatable and not currently failing"""
     return _retrieve_translatable_apps(query = db.session.query(RepositoryApp).filter(
                         RepositoryApp.translatable == True,                                  # Only translatable pages
                         RepositoryApp.failing == False,                                      # Which are not failing
                 ))
 
 def retrieve_single_translatable_apps(app_url):
-    """This method collects information previously stored by other process into Redis, and returns only those apps which are translatable and not currently failing"""
+    """This method collects information previously stored by other process into Redis, and yields only those apps which are translatable and not currently failing"""
     return _retrieve_translatable_apps(query = db.session.query(RepositoryApp).filter(
                         RepositoryApp.translatable == True,                                  # Only translatable pages
                         RepositoryApp.failing == False,                                      # Which are not failing
@@ -408,96 +532,100 @@ def retrieve_single_translatable_apps(app_url):
 #             CONCURRENCY
 #
 
-class _CheckUrlMetadataTask(threading.Thread):
+class _CheckUrlMetadataTask(FetchTask):
     def __init__(self, url, uses_proxy):
-        threading.Thread.__init__(self)
         self.url = url
+        self.host = trutils.url_host(url)
         self.uses_proxy = uses_proxy
-        self.finished = False
         self.failed = False
         self.metadata_information = None
 
-    def run(self):
-        try:
-            self.metadata_information = extract_check_url_metadata(self.url, self.uses_proxy)
-        except Exception as err:
-            logger.warning("Error extracting information from checker url %s" % self.url, exc_info = True)
-            if DEBUG_VERBOSE:
-                print("Error extracting information from checker url %s" % self.url)
-                traceback.print_exc()
+    def __repr__(self):
+        return '<_CheckUrlMetadataTask {}>'.format(self.url)
+
+    def fetch(self):
+        return extract_check_url_metadata(self.url, self.uses_proxy)
 
+    def on_success(self, metadata_information):
+        self.metadata_information = metadata_information
+
+    def on_failure(self, reason, exc_info = None):
+        if exc_info and isinstance(exc_info[1], trutils.CircuitOpenError):
+            # The host has been failing recently: keep the previous status
             self.failed = True
-        self.finished = True
+            return
+
+        logger.warning("Error extracting information from checker url %s (%s)" % (self.url, reason), exc_info = exc_info)
+        if DEBUG_VERBOSE:
+            print("Error extracting information from checker url %s (%s)" % (self.url, reason))
+            if exc_info:
+                traceback.print_exception(*exc_info)
 
-class _MetadataTask(threading.Thread):
-    def __init__(self, repo_id, app_url, preview_link, app_format, force_reload):
-        threading.Thread.__init__(self)
+        self.failed = True
+
+class _MetadataTask(FetchTask):
+    def __init__(self, repo_id, app_url, preview_link, app_format, force_reload, sessions, locale_cache):
         self.repo_id = repo_id
         self.app_url = app_url
+        self.host = trutils.url_host(app_url)
+        self.sessions = sessions
+        self.locale_cache = locale_cache
         self.app_format = app_format or 'opensocial' # Still the first time apps will be empty
         self.preview_link = preview_link
         self.force_reload = force_reload
-        self.finished = False
         self.failing = False
+        self.skipped = False
         self.metadata_information = None
 
-    def run(self):
-        self.failing = False
-        cached_requests = trutils.get_cached_session(caching = not self.force_reload)
-        try:
-            self.metadata_information = extract_metadata_information(self.app_url, self.preview_link, cached_requests, self.force_reload, app_format=self.app_format)
-        except Exception:
-            logger.warning("Error extracting information from %s" % self.app_url, exc_info = True)
-            if DEBUG_VERBOSE:
-                print("Error extracting information from %s" % self.app_url)
-                traceback.print_exc()
-            self.metadata_information = {}
-            self.failing = True
+    def __repr__(self):
+        return '<_MetadataTask {}>'.format(self.app_url)
+
+    def fetch(self):
+        return extract_metadata_information(self.app_url, self.preview_link, self.sessions, self.force_reload, app_format=self.app_format, locale_cache=self.locale_cache)
+
+    def on_success(self, metadata_information):
+        self.metadata_information = metadata_information
+        self.failing = self.metadata_information.get('failing', False)
+
+    def on_failure(self, reason, exc_info = None):
+        if exc_info and isinstance(exc_info[1], trutils.CircuitOpenError):
+            # The host has been failing recently: do not mark it as failing again, just skip it
+            self.skipped = True
         else:
-            self.failing = self.metadata_information.get('failing', False)
-        self.finished = True
-
-class _RunInParallel(object):
-    def __init__(self, tag, tasks, thread_number = 15):
-        self.tag = tag
-        self.tasks = tasks
-        self.thread_number = thread_number
-
-    def all_finished(self):
-        for task in self.tasks:
-            if not task.finished:
-                return False
-        return True
-
-    def run(self):
-        print "Starting downloading {0} apps of {1}".format(len(self.tasks), self.tag)
-        waiting_tasks = self.tasks[:]
-        running_tasks = []
-        while not self.all_finished():
-            has_changed = True
-            while has_changed:
-                has_changed = False
-                cur_pos = -1
-                for pos, task in enumerate(running_tasks):
-                    if task.finished:
-                        cur_pos = pos
-                        has_changed = True
-                        break
-                if has_changed:
-                    running_tasks.pop(cur_pos)
-
-            while len(running_tasks) < self.thread_number and len(waiting_tasks) > 0:
-                new_task = waiting_tasks.pop(0)
-                new_task.start()
-                running_tasks.append(new_task)
-
-            if len(running_tasks) > 0:
-                time.sleep(0.1)
-
-        for task in self.tasks:
-            task.join()
-
-        print "All {0} apps of {1} downloaded".format(len(self.tasks), self.tag)
+            logger.warning("Error extracting information from %s (%s)" % (self.app_url, reason), exc_info = exc_info)
+        if DEBUG_VERBOSE:
+            print("Error extracting information from %s (%s)" % (self.app_url, reason))
+            if exc_info:
+                traceback.print_exception(*exc_info)
+        self.metadata_information = {}
+        self.failing = True
+
+def _per_host(engine):
+    "Maximum number of requests in flight per host. The gevent engine has its own (higher) limit"
+    if engine == GEVENT_ENGINE:
+        return current_app.config.get('DOWNLOADER_GEVENT_PER_HOST', 50)
+    return current_app.config.get('DOWNLOADER_PER_HOST', 4)
+
+def _create_host_sessions(force_reload):
+    per_host = _per_host(current_app.config.get('DOWNLOADER_ENGINE', THREADS_ENGINE))
+    return trutils.HostSessions(per_host = per_host, caching = not force_reload)
+
+def _create_scheduler():
+    return RecheckScheduler(min_interval = current_app.config.get('DOWNLOADER_RECHECK_MIN_INTERVAL', 4 * 60),
+                            max_interval = current_app.config.get('DOWNLOADER_RECHECK_MAX_INTERVAL', 24 * 3600),
+                            failing_min_interval = current_app.config.get('DOWNLOADER_FAILING_MIN_INTERVAL', 10 * 60),
+                            failing_max_interval = current_app.config.get('DOWNLOADER_FAILING_MAX_INTERVAL', 6 * 3600))
+
+def _run_tasks(tag, tasks, task_timeout, workers = None):
+    if workers is None:
+        workers = current_app.config.get('DOWNLOADER_WORKERS', 15)
+        greenlets = current_app.config.get('DOWNLOADER_GREENLETS', 500)
+        engine = current_app.config.get('DOWNLOADER_ENGINE', THREADS_ENGINE)
+    else:
+        greenlets = workers
+        engine = THREADS_ENGINE
+    executor = create_executor(engine, tag, workers = workers, greenlets = greenlets, task_timeout = task_timeout, per_host = _per_host(engine))
+    executor.run(tasks)
 
 
 #######################################################################################
@@ -509,24 +637,110 @@ class _RunInParallel(object):
 #
 #
 
-def _retrieve_translatable_apps(query):
-    contents = [
-        # app_id: repo_app.id
-        # app_url: repo_app.url
-        # metadata: {
-        #      metadata contents retrieved from Redis
-        # }
-    ]
-    for repo_app in query.all():
-        app_metadata = redis_store.hget(_REDIS_CACHE_KEY, repo_app.id)
-        if app_metadata is not None:
-            contents.append({
-                'app_id': repo_app.id,
-                'app_url': repo_app.url,
-                'metadata': json.loads(app_metadata),
-            })
+def _retrieve_translatable_apps(query, chunk_size = _REDIS_CACHE_CHUNK_SIZE):
+    """Generator of the apps of the query with their metadata stored in Redis. The metadata is
+    retrieved in chunks (one MGET each) and decoded lazily, so the caller can start processing
+    the first apps before the rest are loaded. Each element is:
 
-    return contents
+    {
+        'app_id': repo_app.id,
+        'app_url': repo_app.url,
+        'metadata': { metadata contents retrieved from Redis },
+    }
+    """
+    # Only ids and URLs: the caller may remove the session between apps
+    repo_apps = query.with_entities(RepositoryApp.id, RepositoryApp.url).all()
+
+    for position in xrange(0, len(repo_apps), chunk_size):
+        chunk = repo_apps[position:position + chunk_size]
+        values = _load_cached_values_bulk([ repo_app_id for repo_app_id, repo_app_url in chunk ])
+        for (repo_app_id, repo_app_url), value in zip(chunk, values):
+            if value is not None:
+                yield {
+                    'app_id': repo_app_id,
+                    'app_url': repo_app_url,
+                    'metadata': _decode_cached_metadata(value),
+                }
+
+def _cache_key(app_id):
+    return '{0}:{1}'.format(_REDIS_CACHE_KEY, app_id)
+
+def _encode_cached_metadata(metadata):
+    return _REDIS_CACHE_VERSION + zlib.compress(json.dumps(metadata))
+
+def _decode_cached_metadata(value):
+    if value is None:
+        return None
+    if value.startswith(_REDIS_CACHE_VERSION):
+        return json.loads(zlib.decompress(value[len(_REDIS_CACHE_VERSION):]))
+    # Legacy: uncompressed JSON
+    return json.loads(value)
+
+def _store_cached_metadata(app_id, metadata):
+    pipeline = redis_store.pipeline()
+    pipeline.set(_cache_key(app_id), _encode_cached_metadata(metadata))
+    pipeline.sadd(_REDIS_CACHE_IDS_KEY, app_id)
+    pipeline.execute()
+
+def _delete_cached_metadata(app_ids):
+    if not app_ids:
+        return
+    pipeline = redis_store.pipeline()
+    pipeline.delete(*[ _cache_key(app_id) for app_id in app_ids ])
+    pipeline.srem(_REDIS_CACHE_IDS_KEY, *app_ids)
+    pipeline.hdel(_REDIS_CACHE_KEY, *app_ids)
+    pipeline.execute()
+
+def _cached_metadata_exists(app_id):
+    return redis_store.exists(_cache_key(app_id)) or redis_store.hexists(_REDIS_CACHE_KEY, app_id)
+
+def _load_cached_metadata(app_id):
+    value = redis_store.get(_cache_key(app_id))
+    if value is None:
+        # Not migrated yet
+        value = redis_store.hget(_REDIS_CACHE_KEY, app_id)
+    return _decode_cached_metadata(value)
+
+def _load_cached_values_bulk(app_ids):
+    """Return the encoded metadata of each app id (None if not available) in a couple of round-trips. Decode it with _decode_cached_metadata."""
+    if not app_ids:
+        return []
+
+    values = redis_store.mget([ _cache_key(app_id) for app_id in app_ids ])
+
+    missing = [ app_id for app_id, value in zip(app_ids, values) if value is None ]
+    if missing:
+        # Not migrated yet
+        legacy_values = dict(zip(missing, redis_store.hmget(_REDIS_CACHE_KEY, missing)))
+        values = [ legacy_values[app_id] if value is None else value for app_id, value in zip(app_ids, values) ]
+
+    return values
+
+def _migrate_legacy_cache():
+    """Move the apps stored in the legacy appcomposer:repository:cache hash to the new per-app keys"""
+    if redis_store.type(_REDIS_CACHE_KEY) != 'hash':
+        return
+
+    legacy_contents = redis_store.hgetall(_REDIS_CACHE_KEY)
+    pipeline = redis_store.pipeline()
+    for app_id, value in legacy_contents.iteritems():
+        pipeline.set(_cache_key(app_id), _encode_cached_metadata(json.loads(value)), nx = True)
+        pipeline.sadd(_REDIS_CACHE_IDS_KEY, app_id)
+    pipeline.delete(_REDIS_CACHE_KEY)
+    pipeline.execute()
+    print "{0} apps moved to the compressed repository cache".format(len(legacy_contents))
+
+def _migrate_downloaded_hash(repo_app, metadata_information, current_hash):
+    """Apps downloaded before TRANSLATIONS_HASH_VERSION have a legacy downloaded_hash. If the
+    contents have not changed, replace it by the new hash without considering it a change
+    (otherwise every app would be processed again)."""
+    legacy_hash = calculate_legacy_translations_hash(metadata_information.get('original_translations', {}), metadata_information.get('default_translations', {}))
+    if legacy_hash != repo_app.downloaded_hash:
+        return
+
+    if repo_app.last_processed_downloaded_hash == repo_app.downloaded_hash:
+        repo_app.last_processed_downloaded_hash = current_hash
+    repo_app.downloaded_hash = current_hash
 
 def _update_repo_app(task, repo_app):
     repo_changes = False
@@ -579,22 +793,26 @@ def _update_repo_app(task, repo_app):
 
         # For changes in translations, etc.
         current_hash = task.metadata_information.pop('translation_hash')
+        if repo_app.downloaded_hash != current_hash and is_legacy_translations_hash(repo_app.downloaded_hash):
+            _migrate_downloaded_hash(repo_app, task.metadata_information, current_hash)
+
         if repo_app.downloaded_hash != current_hash:
-            previous_contents = redis_store.hget(_REDIS_CACHE_KEY, repo_app.id)
+            previous_contents = _load_cached_metadata(repo_app.id)
             previous_hash = repo_app.downloaded_hash
 
             store_changes = False
             if store_changes:
                 open('changes_{}_{}.txt'.format(int(time.time()), repo_app.id), 'w').write(json.dumps({
-                    'previous_contents': json.loads(previous_contents or '{}'),
+                    'previous_contents': previous_contents or {},
                     'previous_hash': previous_hash,
                     'new_contents': task.metadata_information,
                     'new_hash': current_hash
                 }, indent = 4))
 
-            new_contents = json.dumps(task.metadata_information)
-            redis_store.hset(_REDIS_CACHE_KEY, repo_app.id, new_contents)
+            _store_cached_metadata(repo_app.id, task.metadata_information)
             repo_app.downloaded_hash = current_hash
+            # The translator API must not keep using the previous contents
+            invalidate_local_translations_cache(repo_app.url)
 
             if task.metadata_information.get('translatable') and len(task.metadata_information.get('default_translations', [])) > 0:
                 repo_app.translatable = True
@@ -610,9 +828,8 @@ def _update_repo_app(task, repo_app):
             redis_store.rpush('appcomposer:downloader:changes', repo_app.url)
 
         else: # same hash, still check (if redis was restarted or something, the database will say that it's gone while it's not)
-            current_contents = redis_store.hget(_REDIS_CACHE_KEY, repo_app.id)
-            if current_contents is None:
-                redis_store.hset(_REDIS_CACHE_KEY, repo_app.id, json.dumps(task.metadata_information))
+            if not _cached_metadata_exists(repo_app.id):
+                _store_cached_metadata(repo_app.id, task.metadata_information)
                 repo_changes = True
 
     if repo_changes:
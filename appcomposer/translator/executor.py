@@ -0,0 +1,341 @@
+"""
+The downloader needs to run thousands of small network-bound tasks (downloading the app XML and
+its locales, checking URLs...). This module provides a reusable executor for them:
+
+ * A fixed number of worker threads is started once, instead of one thread per task.
+ * Finished tasks are reported through a completion queue, so the coordinator does not need
+   to poll the whole list of tasks.
+ * Each task may take at most ``task_timeout`` seconds. If it takes longer, it is reported as
+   failed and its worker is replaced (Python threads can not be killed, so the worker is just
+   retired and exits when the task finally returns).
+ * The whole run can be cancelled: pending tasks will not be started.
+ * Tasks may define a ``host`` attribute. If ``per_host`` is provided, pending tasks are served
+   round-robin by host and no more than ``per_host`` tasks of the same host run at the same time,
+   so a single host with hundreds of apps does not take all the workers.
+
+Tasks must inherit from FetchTask. ``fetch`` is run in a worker thread, while ``on_success`` and
+``on_failure`` are always called exactly once per task from the thread calling ``run``.
+
+Optionally, if gevent is installed and the process has been monkey-patched (e.g., the celery
+worker is run with run_celery_slow_independent_gevent.py), GreenletFetchExecutor provides the
+same interface but runs each task in a greenlet, so thousands of requests can be in flight at
+the same time. Use create_executor to select one or the other.
+"""
+import sys
+import time
+import Queue
+import threading
+from collections import deque, defaultdict
+
+from celery.utils.log import get_task_logger
+
+try:
+    import gevent
+    import gevent.pool
+    import gevent.queue
+    import gevent.monkey
+except ImportError:
+    gevent = None
+
+logger = get_task_logger(__name__)
+
+THREADS_ENGINE = 'threads'
+GEVENT_ENGINE = 'gevent'
+
+TIMEOUT = 'timeout'
+CANCELLED = 'cancelled'
+ERROR = 'error'
+
+class FetchTask(object):
+    def fetch(self):
+        """Run in a worker thread. Whatever it returns is passed to on_success."""
+        raise NotImplementedError("fetch must be implemented")
+
+    def on_success(self, result):
+        pass
+
+    def on_failure(self, reason, exc_info = None):
+        """reason is one of ERROR, TIMEOUT or CANCELLED. exc_info is only provided with ERROR."""
+        pass
+
+class _HostScheduler(object):
+    """Pending tasks grouped by host"""
+    def __init__(self, tasks, per_host):
+        self.per_host = per_host
+        self.size = 0
+        self.queues = {
+            # host: deque([task1, task2...])
+        }
+        self.hosts = deque() # round-robin
+        self.in_flight = defaultdict(int)
+        for task in tasks:
+            self.add(task)
+
+    def __len__(self):
+        return self.size
+
+    def add(self, task):
+        host = getattr(task, 'host', None)
+        if host not in self.queues:
+            self.queues[host] = deque()
+            self.hosts.append(host)
+        self.queues[host].append(task)
+        self.size += 1
+
+    def next(self):
+        """Return the next task which can be started, or None if all the hosts are busy"""
+        for _ in xrange(len(self.hosts)):
+            host = self.hosts[0]
+            self.hosts.rotate(-1)
+            if self.per_host is None or host is None or self.in_flight[host] < self.per_host:
+                queue = self.queues[host]
+                task = queue.popleft()
+                if not queue:
+                    # After rotating, it is the last one
+                    self.hosts.pop()
+                    self.queues.pop(host)
+                self.in_flight[host] += 1
+                self.size -= 1
+                return task
+        return None
+
+    def done(self, task):
+        self.in_flight[getattr(task, 'host', None)] -= 1
+
+    def drain(self):
+        for host in list(self.hosts):
+            for task in self.queues.pop(host):
+                yield task
+        self.hosts.clear()
+        self.size = 0
+
+class _Worker(threading.Thread):
+    def __init__(self, work_queue, done_queue):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.work_queue = work_queue
+        self.done_queue = done_queue
+        self.retired = False
+        self.current = None # (task, started)
+
+    def run(self):
+        while not self.retired:
+            task = self.work_queue.get()
+            if task is None:
+                break
+
+            self.current = (task, time.time())
+            try:
+                result = task.fetch()
+            except Exception:
+                self.done_queue.put((task, False, sys.exc_info()))
+            else:
+                self.done_queue.put((task, True, result))
+            finally:
+                self.current = None
+
+class FetchExecutor(object):
+    def __init__(self, tag, workers = 15, task_timeout = None, per_host = None, tick = 0.5):
+        self.tag = tag
+        self.workers = workers
+        self.per_host = per_host
+        self.task_timeout = task_timeout
+        self.tick = tick
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        """Do not start any other task. Those already running are reported as cancelled."""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def run(self, tasks):
+        print "Starting downloading {0} apps of {1}".format(len(tasks), self.tag)
+        if not tasks:
+            return
+
+        work_queue = Queue.Queue()
+        done_queue = Queue.Queue()
+
+        pending = _HostScheduler(tasks, self.per_host)
+        running = {
+            # id(task): task
+        }
+        workers = []
+
+        def start_worker():
+            worker = _Worker(work_queue, done_queue)
+            worker.start()
+            workers.append(worker)
+
+        for _ in xrange(min(self.workers, len(tasks))):
+            start_worker()
+
+        try:
+            while pending or running:
+                if self.cancelled:
+                    break
+
+                while pending and len(running) < self.workers:
+                    task = pending.next()
+                    if task is None:
+                        # All the hosts with pending tasks are busy
+                        break
+                    running[id(task)] = task
+                    work_queue.put(task)
+
+                try:
+                    task, succeeded, payload = done_queue.get(timeout = self.tick)
+                except Queue.Empty:
+                    self._check_timeouts(workers, running, pending, start_worker)
+                    continue
+
+                if running.pop(id(task), None) is None:
+                    # It had already timed out
+                    continue
+
+                pending.done(task)
+
+                if succeeded:
+                    task.on_success(payload)
+                else:
+                    task.on_failure(ERROR, payload)
+
+                if self.task_timeout is not None:
+                    self._check_timeouts(workers, running, pending, start_worker)
+
+            for task in running.values():
+                task.on_failure(CANCELLED)
+
+            for task in pending.drain():
+                task.on_failure(CANCELLED)
+        finally:
+            for worker in workers:
+                worker.retired = True
+                work_queue.put(None)
+
+            for worker in workers:
+                # Idle workers finish immediately; busy ones (if cancelled) are not waited for
+                worker.join(self.tick)
+
+        print "All {0} apps of {1} downloaded".format(len(tasks), self.tag)
+
+    def _check_timeouts(self, workers, running, pending, start_worker):
+        if self.task_timeout is None:
+            return
+
+        now = time.time()
+        for worker in list(workers):
+            current = worker.current
+            if current is None:
+                continue
+
+            task, started = current
+            if now - started > self.task_timeout and running.pop(id(task), None) is not None:
+                logger.warning("Task %r of %s took more than %s seconds; giving up" % (task, self.tag, self.task_timeout))
+                worker.retired = True
+                workers.remove(worker)
+                pending.done(task)
+                task.on_failure(TIMEOUT)
+                start_worker()
+
+class GreenletFetchExecutor(object):
+    def __init__(self, tag, concurrency = 500, task_timeout = None, per_host = None, tick = 0.5):
+        if gevent is None:
+            raise Exception("gevent is not installed")
+        self.tag = tag
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.task_timeout = task_timeout
+        self.tick = tick
+        self._cancelled = False
+
+    def cancel(self):
+        """Do not start any other task. Those already running are reported as cancelled."""
+        self._cancelled = True
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def _run_task(self, task, done_queue):
+        timeout = gevent.Timeout(self.task_timeout)
+        timeout.start()
+        try:
+            result = task.fetch()
+        except gevent.Timeout as err:
+            if err is not timeout:
+                raise
+            done_queue.put((task, TIMEOUT, None))
+        except Exception:
+            done_queue.put((task, ERROR, sys.exc_info()))
+        else:
+            done_queue.put((task, None, result))
+        finally:
+            timeout.cancel()
+
+    def run(self, tasks):
+        print "Starting downloading {0} apps of {1} (gevent)".format(len(tasks), self.tag)
+        if not tasks:
+            return
+
+        done_queue = gevent.queue.Queue()
+        pending = _HostScheduler(tasks, self.per_host)
+        pool = gevent.pool.Pool(self.concurrency)
+        running = {
+            # id(task): task
+        }
+
+        try:
+            while pending or running:
+                if self.cancelled:
+                    break
+
+                while pending and len(running) < self.concurrency:
+                    task = pending.next()
+                    if task is None:
+                        # All the hosts with pending tasks are busy
+                        break
+                    running[id(task)] = task
+                    pool.spawn(self._run_task, task, done_queue)
+
+                try:
+                    task, failure, payload = done_queue.get(timeout = self.tick)
+                except gevent.queue.Empty:
+                    continue
+
+                running.pop(id(task))
+                pending.done(task)
+
+                if failure is None:
+                    task.on_success(payload)
+                else:
+                    if failure == TIMEOUT:
+                        logger.warning("Task %r of %s took more than %s seconds; giving up" % (task, self.tag, self.task_timeout))
+                    task.on_failure(failure, payload)
+
+            for task in running.values():
+                task.on_failure(CANCELLED)
+
+            for task in pending.drain():
+                task.on_failure(CANCELLED)
+        finally:
+            pool.kill(block = False)
+
+        print "All {0} apps of {1} downloaded".format(len(tasks), self.tag)
+
+def create_executor(engine, tag, workers = 15, greenlets = 500, task_timeout = None, per_host = None):
+    """Return a GreenletFetchExecutor if requested and possible, or a FetchExecutor otherwise"""
+    if engine == GEVENT_ENGINE:
+        if gevent is None:
+            logger.warning("gevent engine requested for %s but gevent is not installed; using threads" % tag)
+        elif not gevent.monkey.is_module_patched('socket'):
+            logger.warning("gevent engine requested for %s but the process is not monkey-patched; using threads" % tag)
+        else:
+            return GreenletFetchExecutor(tag, concurrency = greenlets, task_timeout = task_timeout, per_host = per_host)
+    elif engine != THREADS_ENGINE:
+        logger.warning("Unknown downloader engine %r; using threads" % engine)
+
+    return FetchExecutor(tag, workers = workers, task_timeout = task_timeout, per_host = per_host)
@@ -1,16 +1,19 @@
 import json
 import zlib
 import time
+import uuid
 import hashlib
 import logging
 import urlparse
+import StringIO
+import HTMLParser
 import xml.etree.ElementTree as ET
 
 from collections import namedtuple
 
 import requests
 
-from bs4 import BeautifulSoup
+from lxml import etree as lxml_etree
 
 from selenium import webdriver
 
@@ -18,25 +21,73 @@ from appcomposer import redis_store, db
 from appcomposer.application import SSL_DOMAIN_WHITELIST
 from appcomposer.models import RepositoryApp
 from appcomposer.exceptions import TranslatorError
-from appcomposer.translator.utils import get_cached_session, fromstring, get_text_from_response
+from appcomposer.translator.utils import get_cached_session, fromstring, get_text_from_response, get_html_head_from_response, validator_store, parsed_bundle_cache, circuit_breaker, CircuitOpenError, LRUCache, RedisSingleFlight
 
 DEBUG = True
 
+# Results of extract_local_translations_url in this process (serialized, so each caller gets its own copy
+# and can modify it). Each one is stored with the generation of the app at that moment: whenever the
+# downloader finds a change in the app, it changes the generation (see invalidate_local_translations_cache),
+# so the results of all processes are discarded.
+_LOCAL_TRANSLATIONS_CACHE = LRUCache(max_items = 500, ttl = 5 * 60)
+_TRANSLATIONS_SINGLE_FLIGHT = RedisSingleFlight('appcomposer:fast-cache:lock:')
+
+def _fast_cache_key(app_url):
+    return 'appcomposer:fast-cache:{}'.format(app_url)
+
+def _fast_cache_generation_key(app_url):
+    return 'appcomposer:fast-cache:generation:{}'.format(app_url)
+
+def invalidate_local_translations_cache(app_url):
+    """The contents of the app changed: discard what extract_local_translations_url has cached"""
+    pipeline = redis_store.pipeline()
+    # A random token rather than a counter, so it never matches a value cached before Redis was emptied
+    pipeline.set(_fast_cache_generation_key(app_url), uuid.uuid4().hex)
+    pipeline.delete(_fast_cache_key(app_url))
+    pipeline.execute()
+
+def _load_local_translations(app_url, generation):
+    "Look for the result of extract_local_translations_url in a local cache in this process and then in Redis"
+    local = _LOCAL_TRANSLATIONS_CACHE.get(app_url)
+    if local is not None:
+        local_generation, serialized = local
+        if local_generation == generation:
+            return tuple(json.loads(serialized))
+
+    cached = redis_store.get(_fast_cache_key(app_url))
+    if cached:
+        translation_url, original_messages, metadata = json.loads(cached)
+        if isinstance(original_messages, basestring):
+            # Stored by a previous version, with each element encoded again
+            original_messages = json.loads(original_messages)
+            metadata = json.loads(metadata)
+            cached = json.dumps([ translation_url, original_messages, metadata ])
+
+        if metadata is not None:
+            _LOCAL_TRANSLATIONS_CACHE.set(app_url, (generation, cached))
+            return translation_url, original_messages, metadata
+
+    return None
+
 def extract_local_translations_url(app_url, force_local_cache = False):
-    redis_key = 'appcomposer:fast-cache:{}'.format(app_url)
+    generation = redis_store.get(_fast_cache_generation_key(app_url))
 
     if force_local_cache:
         # Under some situations (e.g., updating a single message), it is better to have a cache
         # than contacting the foreign server. Only if requested, this method will try to check
-        # in a local cache in Redis.
-        cached = redis_store.get(redis_key)
-        if cached:
-            translation_url, original_messages, metadata = json.loads(cached)
-            if metadata is not None:
-                original_messages_loaded = json.loads(original_messages)
-                metadata_loaded = json.loads(metadata)
-                return translation_url, original_messages_loaded, metadata_loaded
-
+        # the caches.
+        result = _load_local_translations(app_url, generation)
+        if result is not None:
+            return result
+
+    # When many users open the same app at the same time, only one of them downloads it. The
+    # rest wait and take the result from the cache.
+    return _TRANSLATIONS_SINGLE_FLIGHT.run(app_url,
+                lambda : _download_local_translations(app_url, generation),
+                lambda : _load_local_translations(app_url, generation))
+
+def _download_local_translations(app_url, generation):
+    redis_key = _fast_cache_key(app_url)
     cached_requests = get_cached_session()
 
     repository_app = db.session.query(RepositoryApp).filter_by(url=app_url).first()
@@ -90,16 +141,25 @@ def extract_local_translations_url(app_url, force_local_cache = False):
 
     redis_value = json.dumps([
         absolute_translation_url,
-        json.dumps(messages),
-        json.dumps(metadata)
+        messages,
+        metadata
     ])
     redis_store.setex(name=redis_key, time=10 * 60, value=redis_value) # For 10 minutes
+    _LOCAL_TRANSLATIONS_CACHE.set(app_url, (generation, redis_value))
     return absolute_translation_url, messages, metadata
 
-def extract_metadata_information(app_url, preview_link, cached_requests = None, force_reload = False, app_format=None):
+def extract_metadata_information(app_url, preview_link, cached_requests = None, force_reload = False, app_format=None, locale_cache = None):
+    """Download the app and all its locales. If a locale_cache (SingleFlight) is provided, the locales
+    already downloaded (or being downloaded) for other apps in the same cycle are reused."""
     if cached_requests is None:
         cached_requests = get_cached_session()
 
+    def retrieve_messages(messages_url):
+        if locale_cache is None:
+            return _retrieve_messages_from_relative_url(app_url, messages_url, cached_requests)
+        absolute_url = _get_absolute_translation_url(app_url, messages_url)
+        return locale_cache.get(absolute_url, lambda : _retrieve_messages_from_relative_url(app_url, messages_url, cached_requests))
+
     if not app_format or app_format == 'opensocial':
         app_information = _extract_information_opensocial(app_url, cached_requests)
     elif app_format == 'html':
@@ -109,7 +169,9 @@ def extract_metadata_information(app_url, preview_link, cached_requests = None,
 
     original_translations = {}
     original_translation_urls = {}
+    translation_digests = {}
     default_translations = {}
+    default_digest = 0
     default_translation_url = None
     default_metadata = {}
 
@@ -135,7 +197,7 @@ def extract_metadata_information(app_url, preview_link, cached_requests = None,
                     lang = '{}_ALL'.format(lang.split('_'))
 
                 try:
-                    absolute_url, messages, metadata, locale_contents = _retrieve_messages_from_relative_url(app_url, messages_url, cached_requests)
+                    absolute_url, messages, metadata, locale_contents = retrieve_messages(messages_url)
                 except TranslatorError as e:
                     logging.warning(u"Could not load %s translation for app URL: %s Reason: %s" % (lang, app_url, e), exc_info = True)
                     continue
@@ -146,6 +208,7 @@ def extract_metadata_information(app_url, preview_link, cached_requests = None,
                             new_messages[key] = value['text']
                     original_translations[lang] = new_messages
                     original_translation_urls[lang] = absolute_url
+                    translation_digests[lang] = _bundle_digests(messages, metadata)[0]
 
             if (lang is None or lang.lower() == 'all') and messages_url:
                 # Process this later. This way we can force we get the results for the default translation
@@ -153,10 +216,11 @@ def extract_metadata_information(app_url, preview_link, cached_requests = None,
 
         if default_locale is not None:
             messages_url = default_locale['messages']
-            absolute_url, messages, metadata, locale_contents = _retrieve_messages_from_relative_url(app_url, messages_url, cached_requests)
+            absolute_url, messages, metadata, locale_contents = retrieve_messages(messages_url)
             default_translations = messages
             default_translation_url = absolute_url
             default_metadata = metadata
+            default_text_digest, default_digest = _bundle_digests(messages, metadata)
 
             # No English? Default is always English!
             if 'en_ALL' not in original_translations:
@@ -168,6 +232,7 @@ def extract_metadata_information(app_url, preview_link, cached_requests = None,
 
                 original_translations[lang] = new_messages
                 original_translation_urls[lang] = absolute_url
+                translation_digests[lang] = default_text_digest
 
     check_urls = app_information.check_urls
     if preview_link:
@@ -186,12 +251,48 @@ def extract_metadata_information(app_url, preview_link, cached_requests = None,
         'default_metadata' : default_metadata,
     }
 
-    translation_hash, serialized = _calculate_translations_hash(original_translations, default_translations)
-    metadata['translation_hash'] = translation_hash
+    metadata['translation_hash'] = _calculate_translations_hash(translation_digests, default_digest)
     metadata['check_urls_hash'] = unicode(zlib.crc32(json.dumps(sorted(check_urls))))
     return metadata
 
-def _calculate_translations_hash(original_translations, default_translations):
+# translation_hash is the sum (modulo 2^64) of the digests of every message (see
+# extract_messages_from_translation), so it does not depend on the order of the
+# messages and it is calculated while parsing each bundle, without serializing
+# all the translations of the app again.
+TRANSLATIONS_HASH_VERSION = u'v2:'
+_DIGEST_MODULUS = 2 ** 64
+
+def _digest(*values):
+    return int(hashlib.md5(json.dumps(values)).hexdigest()[:16], 16)
+
+def _message_digests(key, message):
+    "Return the digest of the text of a message and the digest of the whole message"
+    return _digest(key, message['text']), _digest(key, sorted(message.items()))
+
+def _bundle_digests(messages, metadata):
+    "Return the (text, full) digests of a bundle, calculating them if it was parsed by an older version"
+    if metadata and 'digests' in metadata:
+        return int(metadata['digests']['text'], 16), int(metadata['digests']['full'], 16)
+
+    text_digest = full_digest = 0
+    for key, message in (messages or {}).iteritems():
+        message_text_digest, message_full_digest = _message_digests(key, message)
+        text_digest += message_text_digest
+        full_digest += message_full_digest
+    return text_digest % _DIGEST_MODULUS, full_digest % _DIGEST_MODULUS
+
+def _calculate_translations_hash(translation_digests, default_digest):
+    digest = _digest('default', default_digest)
+    for lang, text_digest in translation_digests.iteritems():
+        digest += _digest('lang', lang, text_digest)
+    return u'%s%016x' % (TRANSLATIONS_HASH_VERSION, digest % _DIGEST_MODULUS)
+
+def is_legacy_translations_hash(translation_hash):
+    return translation_hash is not None and not translation_hash.startswith(TRANSLATIONS_HASH_VERSION)
+
+def calculate_legacy_translations_hash(original_translations, default_translations):
+    """translation_hash as calculated before TRANSLATIONS_HASH_VERSION. Only used to migrate the
+    downloaded_hash of the apps that have not changed since then."""
     values = [
         # [
         #     lang,
@@ -209,26 +310,70 @@ def _calculate_translations_hash(original_translations, default_translations):
     values.sort(lambda (k1, v1), (k2, v2): cmp(k1, k2))
 
     contents = json.dumps(values)
-    return unicode(zlib.crc32(contents)), contents
+    return unicode(zlib.crc32(contents))
 
 
+def _iterparse_bundle(xml_contents):
+    """Parse a message bundle incrementally. It yields the root element first (only its attributes
+    are available) and then each <msg> element directly under it, with all its contents. Elements
+    are released once processed, so memory does not grow with the number of messages."""
+    depth = 0
+    try:
+        for event, element in lxml_etree.iterparse(StringIO.StringIO(xml_contents.encode('utf8')), events = ('start', 'end'), resolve_entities = False, huge_tree = True):
+            if event == 'start':
+                if depth == 0:
+                    yield element
+                depth += 1
+                continue
+
+            depth -= 1
+            if depth == 1:
+                if element.tag == 'msg':
+                    yield element
+
+                element.clear()
+                # Also drop the references of the root element to the elements already processed
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+    except lxml_etree.LxmlError as e:
+        logging.warning("Could not parse XML contents: %s" % e, exc_info = True)
+        raise TranslatorError("Could not XML contents: %s" % e)
+
+def _raw_msg_contents(xml_msg):
+    """Return whatever is between the <msg name='foo'> and </msg>, and the text of the msg, exactly as
+    ElementTree serializes and parses them (so the texts stored do not change). Only needed if there
+    are elements inside the msg, which is rare."""
+    et_msg = ET.fromstring(lxml_etree.tostring(xml_msg, with_tail = False))
+    try:
+        return ET.tostring(et_msg).split(">", 1)[1].rsplit("<", 1)[0], et_msg.text
+    except IndexError:
+        # If this ever happens, forget about it
+        return "", et_msg.text
+
 def extract_messages_from_translation(messages_absolute_url, xml_contents):
-    contents = fromstring(xml_contents)
+    bundle = _iterparse_bundle(xml_contents)
+    try:
+        contents = next(bundle)
+    except StopIteration:
+        raise TranslatorError("Could not XML contents: empty document")
+
     messages = {}
     attribs = dict(contents.attrib)
-    if 'namespace' in contents.attrib:
-        default_namespace = contents.attrib['namespace']
+    if 'namespace' in attribs:
+        default_namespace = attribs['namespace']
     else:
         default_namespace = None
 
-    if 'mails' in contents.attrib:
-        mails = [ mail.strip() for mail in contents.attrib['mails'].split(',') ]
+    if 'mails' in attribs:
+        mails = [ mail.strip() for mail in attribs['mails'].split(',') ]
     else:
         mails = []
 
-    automatic = contents.attrib.get('automatic', 'true').lower() == 'true'
+    automatic = attribs.get('automatic', 'true').lower() == 'true'
+
+    text_digest = full_digest = 0
 
-    for pos, xml_msg in enumerate(contents.findall('msg')):
+    for pos, xml_msg in enumerate(bundle):
         if 'name' not in xml_msg.attrib:
             raise TranslatorError("Invalid translation file: no name in msg tag")
 
@@ -268,13 +413,12 @@ def extract_messages_from_translation(messages_absolute_url, xml_contents):
             tool_id = None
 
         # Some people use things like <msg name='foo'>Press <i class=''></i> to ...</msg>
-        # This is invalid XML, but we want to support it too. So:
-        try:
-            # Get whatever is between the <msg name='foo'> and </msg>:
-            raw_msg_message = ET.tostring(xml_msg).split(">", 1)[1].rsplit("<", 1)[0]
-        except IndexError:
-            # If this ever happens, forget about it
-            raw_msg_message = ""
+        # This is invalid XML, but we want to support it too. So, only if there are
+        # elements inside (otherwise < and > are always escaped), take the raw contents:
+        if len(xml_msg):
+            raw_msg_message, msg_text = _raw_msg_contents(xml_msg)
+        else:
+            raw_msg_message, msg_text = "", xml_msg.text
 
         if '<' in raw_msg_message or '>' in raw_msg_message:
             xml_text = raw_msg_message
@@ -282,7 +426,13 @@ def extract_messages_from_translation(messages_absolute_url, xml_contents):
             # However, we also want to support people using &lt;i class=''&gt;, so the
             # code above is only used if < or > are present in the text. Otherwise we
             # trust the XML library
-            xml_text = xml_msg.text or ""
+            xml_text = msg_text or ""
+
+        if name in messages:
+            # Repeated messages: the last one wins
+            previous_text_digest, previous_full_digest = _message_digests(name, messages[name])
+            text_digest -= previous_text_digest
+            full_digest -= previous_full_digest
 
         messages[name] = {
             'text' : xml_text,
@@ -293,10 +443,18 @@ def extract_messages_from_translation(messages_absolute_url, xml_contents):
             'tool_id' : tool_id,
             'format': format,
         }
+        message_text_digest, message_full_digest = _message_digests(name, messages[name])
+        text_digest += message_text_digest
+        full_digest += message_full_digest
+
     metadata = {
         'mails' : mails,
         'automatic' : automatic,
         'attribs' : json.dumps(attribs),
+        'digests' : {
+            'text' : '%016x' % (text_digest % _DIGEST_MODULUS),
+            'full' : '%016x' % (full_digest % _DIGEST_MODULUS),
+        },
     }
     return messages, metadata
 
@@ -305,14 +463,39 @@ def _raise_for_status(url, response):
         raise requests.RequestException("URL: {0}: Expected response, returned None (probably in tests)".format(url))
     response.raise_for_status()
 
+def _conditional_get(cached_requests, url, kind, stream = False):
+    """Download url sending the validators stored last time it was processed as kind.
+
+    It returns the response and, if the server replied 304 Not Modified, the result stored
+    last time (otherwise, None). Use validator_store.store to store the new result.
+    """
+    headers, previous = validator_store.load(kind, url)
+    if stream:
+        response = cached_requests.get(url, timeout = 30, headers = headers, stream = True)
+    else:
+        response = cached_requests.get(url, timeout = 30, headers = headers)
+    if previous is not None and response is not None and response.status_code == 304:
+        return response, previous
+
+    try:
+        _raise_for_status(url, response)
+    except:
+        if response is not None:
+            response.close()
+        raise
+    return response, None
+
 class AppInformation(namedtuple("AppInformation", ['locales', 'check_urls', 'uses_proxy', 'offline'])):
     pass
 
 def _extract_information_opensocial(app_url, cached_requests):
     try:
-        response = cached_requests.get(app_url, timeout = 30)
-        _raise_for_status(app_url, response)
+        response, previous = _conditional_get(cached_requests, app_url, 'opensocial')
+        if previous is not None:
+            return AppInformation(**previous)
         xml_contents = get_text_from_response(response)
+    except CircuitOpenError:
+        raise
     except requests.RequestException as e:
         logging.warning(u"Could not load this app URL (%s): %s" % (app_url, e), exc_info = True)
         raise TranslatorError(u"Could not load this app URL: %s" % e)
@@ -356,22 +539,52 @@ def _extract_information_opensocial(app_url, cached_requests):
         }
         locales.append(locale)
     
-    return AppInformation(locales=locales, check_urls=check_urls, uses_proxy=uses_proxy, offline=offline)
+    app_information = AppInformation(locales=locales, check_urls=check_urls, uses_proxy=uses_proxy, offline=offline)
+    validator_store.store('opensocial', app_url, response, app_information._asdict())
+    return app_information
+
+class _HtmlMetaScanner(HTMLParser.HTMLParser):
+    """Collects the attributes of the <meta> tags of an HTML document"""
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+        self.metas = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'meta':
+            self.metas.append(dict(attrs))
+
+    def find_all(self, name):
+        return [ meta for meta in self.metas if meta.get('name') == name ]
+
+def _scan_html_metas(html_contents):
+    scanner = _HtmlMetaScanner()
+    try:
+        scanner.feed(html_contents)
+        scanner.close()
+    except HTMLParser.HTMLParseError as e:
+        # Keep those found so far
+        logging.warning(u"Invalid HTML: %s" % e)
+    return scanner
 
 def _extract_information_html(app_url, cached_requests):
     try:
-        response = cached_requests.get(app_url, timeout = 30)
-        _raise_for_status(app_url, response)
-        html_contents = get_text_from_response(response)
+        response, previous = _conditional_get(cached_requests, app_url, 'html', stream = True)
+        if previous is not None:
+            response.close()
+            return AppInformation(**previous)
+        # Only the <head> is read: the page itself might be huge
+        html_contents = get_html_head_from_response(response)
+    except CircuitOpenError:
+        raise
     except requests.RequestException as e:
         logging.warning(u"Could not load this app URL (%s): %s" % (app_url, e), exc_info = True)
         raise TranslatorError(u"Could not load this app URL: %s" % e)
 
-    soup = BeautifulSoup(html_contents, 'lxml')
+    metas = _scan_html_metas(html_contents)
 
     check_urls = [ app_url ] # The app_url itself is always a URL to check
 
-    for check_url_tag in soup.find_all('meta', attrs=dict(name='check-url')):
+    for check_url_tag in metas.find_all('check-url'):
         check_url = check_url_tag.get('value')
         if check_url:
             check_urls.append(check_url)
@@ -379,7 +592,7 @@ def _extract_information_html(app_url, cached_requests):
     check_urls.sort()
 
     locales = []
-    for translations_meta in soup.find_all('meta', attrs=dict(name='translations')):
+    for translations_meta in metas.find_all('translations'):
         locale = {
             'lang': translations_meta.get('lang'),
             'country': translations_meta.get('country'),
@@ -387,7 +600,7 @@ def _extract_information_html(app_url, cached_requests):
         }
         locales.append(locale)
 
-    uses_proxy_metas = soup.find_all('meta', attrs=dict(name='uses-proxy'))
+    uses_proxy_metas = metas.find_all('uses-proxy')
     if uses_proxy_metas:
         # If there is more than one, check just the last one
         uses_proxy = (uses_proxy_metas[-1].get('value') or '').lower() in ['1', 'true', 'yes']
@@ -395,7 +608,7 @@ def _extract_information_html(app_url, cached_requests):
         uses_proxy = False
 
     offline = False
-    offline_metas = soup.find_all('meta', attrs=dict(name='download'))
+    offline_metas = metas.find_all('download')
     if offline_metas:
         offline = True
     else:
@@ -407,19 +620,38 @@ def _extract_information_html(app_url, cached_requests):
         print(u"Invalid HTML document (%s): missing tags" % app_url)
         raise TranslatorError("Invalid HTML document: missing tags")
 
-    return AppInformation(locales=locales, check_urls=check_urls, uses_proxy=uses_proxy, offline=offline)
+    app_information = AppInformation(locales=locales, check_urls=check_urls, uses_proxy=uses_proxy, offline=offline)
+    validator_store.store('html', app_url, response, app_information._asdict())
+    return app_information
 
-def _retrieve_messages_from_relative_url(app_url, messages_url, cached_requests):
+def _get_absolute_translation_url(app_url, messages_url):
     if messages_url.startswith(('http://', 'https://', '//')):
-        absolute_translation_url = messages_url
-    else:
-        base_url = app_url.rsplit('/', 1)[0]
-        absolute_translation_url = '/'.join((base_url, messages_url))
+        return messages_url
+
+    base_url = app_url.rsplit('/', 1)[0]
+    return '/'.join((base_url, messages_url))
+
+def _retrieve_messages_from_relative_url(app_url, messages_url, cached_requests):
+    absolute_translation_url = _get_absolute_translation_url(app_url, messages_url)
 
     try:
-        translation_messages_response = cached_requests.get(absolute_translation_url, timeout = 30)
-        _raise_for_status(absolute_translation_url, translation_messages_response)
+        translation_messages_response, previous = _conditional_get(cached_requests, absolute_translation_url, 'locale')
+        if previous is not None:
+            # Not modified: only the hash of the parsed bundle was stored with the validators (or,
+            # before, the parsed bundle itself: then download it again)
+            parsed = parsed_bundle_cache.get_by_hash(previous) if isinstance(previous, basestring) else None
+            if parsed is not None:
+                # The contents themselves are not available, but nobody uses them
+                messages, metadata = parsed
+                return absolute_translation_url, messages, metadata, None
+
+            # The parsed bundle expired: download it again, without validators
+            validator_store.delete('locale', absolute_translation_url)
+            translation_messages_response, _ = _conditional_get(cached_requests, absolute_translation_url, 'locale')
         translation_messages_xml = get_text_from_response(translation_messages_response)
+    except CircuitOpenError:
+        # Do not process the app as if this locale was not there
+        raise
     except Exception as e:
         logging.warning("Could not reach locale URL: %s  Reason: %s" % (absolute_translation_url, e), exc_info = True)
         raise TranslatorError("Could not reach locale URL")
@@ -428,12 +660,22 @@ def _retrieve_messages_from_relative_url(app_url, messages_url, cached_requests)
     if absolute_translation_url.startswith('http://go-lab.gw.utwente.nl/production/'):
         translation_messages_xml = translation_messages_xml.replace("<messagebundle>", '<messagebundle mails="pablo.orduna@deusto.es">')
 
-    try:
-        messages, metadata = extract_messages_from_translation(absolute_translation_url, translation_messages_xml)
-    except TranslatorError as e:
-        logging.warning("Could not load XML contents from %s Reason: %s" % (absolute_translation_url, e), exc_info = True)
-        raise TranslatorError("Could not load XML in %s" % absolute_translation_url)
+    parsed = parsed_bundle_cache.get(absolute_translation_url, translation_messages_xml)
+    if parsed is not None:
+        # Downloaded again, but exactly the same contents as some time before
+        messages, metadata = parsed
+        parsed_hash = parsed_bundle_cache.hash(absolute_translation_url, translation_messages_xml)
+    else:
+        try:
+            messages, metadata = extract_messages_from_translation(absolute_translation_url, translation_messages_xml)
+        except TranslatorError as e:
+            logging.warning("Could not load XML contents from %s Reason: %s" % (absolute_translation_url, e), exc_info = True)
+            raise TranslatorError("Could not load XML in %s" % absolute_translation_url)
+
+        parsed_hash = parsed_bundle_cache.store(absolute_translation_url, translation_messages_xml, [ messages, metadata ])
 
+    # The parsed bundle is already in parsed_bundle_cache: do not store it twice
+    validator_store.store('locale', absolute_translation_url, translation_messages_response, parsed_hash)
     return absolute_translation_url, messages, metadata, translation_messages_xml
 
 def extract_check_url_metadata(url, uses_proxy):
@@ -451,8 +693,11 @@ def extract_check_url_metadata(url, uses_proxy):
         kwargs['verify'] = False
     
     try:
-        req = requests.get(url, allow_redirects=True, timeout=(15,15), headers=headers, **kwargs)
+        req = circuit_breaker.get(requests, url, allow_redirects=True, timeout=(15,15), headers=headers, **kwargs)
         req.raise_for_status()
+    except CircuitOpenError:
+        # The host has been failing: do not change the previous status
+        raise
     except Exception as err:
         failed = True
         error_message = str(err)
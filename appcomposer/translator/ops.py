@@ -1,23 +1,28 @@
 import time
 import zlib
+import uuid
 import json
 import urlparse
 import hashlib
 import datetime
+import threading
 import traceback
 
 from functools import wraps
 from collections import defaultdict
 
-from sqlalchemy import func, or_, and_
+from sqlalchemy import func, or_, and_, select, bindparam, event, inspect
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import joinedload_all, joinedload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
 
 from appcomposer import db, rlock, redis_store
 from appcomposer.application import app
+from appcomposer.exceptions import TranslatorError
 from appcomposer.languages import obtain_languages, obtain_groups
 from appcomposer.translator.suggestions import translate_texts
-from appcomposer.models import TranslatedApp, TranslationUrl, TranslationBundle, ActiveTranslationMessage, TranslationMessageHistory, TranslationKeySuggestion, TranslationValueSuggestion, GoLabOAuthUser, TranslationSyncLog, TranslationSubscription, TranslationNotificationRecipient, RepositoryApp
+from appcomposer.models import TranslatedApp, TranslationUrl, TranslationBundle, ActiveTranslationMessage, TranslationMessageHistory, TranslationKeySuggestion, TranslationValueSuggestion, GoLabOAuthUser, TranslationSyncLog, TranslationSubscription, TranslationNotificationRecipient, RepositoryApp, TranslationNamespaceIndex, TranslationBundleStats, TranslationBundleTool, TranslationSuggestionFlush
 
 DEBUG = False
 
@@ -44,10 +49,73 @@ def get_golab_default_user():
     return default_user
 
 
+# The contents_hash of each bundle is the sum (modulo 2^64) of the digests of its active messages,
+# updated on every write (see _bulk_replace_active_messages and _update_changed_bundles). The
+# contents_hash of the app combines those of its bundles.
+CONTENTS_HASH_VERSION = u'v2:'
+EMPTY_BUNDLE_HASH = u'%016x' % 0
+
+def _digest(*values):
+    return int(hashlib.md5(json.dumps(values)).hexdigest()[:16], 16)
+
+def _add_to_bundle_hash(db_bundle, digest_delta):
+    "Update the contents_hash of the bundle (or calculate it again when committing, if it is unknown)"
+    if db_bundle.contents_hash is None:
+        db.session.info.setdefault(_CHANGED_BUNDLES, defaultdict(set))['contents_hash'].add(db_bundle.id)
+    else:
+        db_bundle.contents_hash = u'%016x' % ((int(db_bundle.contents_hash, 16) + digest_delta) % 2 ** 64)
+
+def _calculate_bundle_hashes(bundle_ids):
+    "The contents_hash of these bundles ({bundle_id: contents_hash}), calculated from the active messages"
+    active_table = ActiveTranslationMessage.__table__
+    digests = dict([ (bundle_id, 0) for bundle_id in bundle_ids ])
+    for chunk in _chunks(bundle_ids):
+        for bundle_id, key, value in db.session.execute(select([ active_table.c.bundle_id, active_table.c.key, active_table.c.value ]).where(active_table.c.bundle_id.in_(chunk))):
+            digests[bundle_id] += _digest(key, value)
+    return dict([ (bundle_id, u'%016x' % (digest % 2 ** 64)) for bundle_id, digest in digests.iteritems() ])
+
+def _recalculate_bundle_hashes(bundle_ids):
+    "Store again the contents_hash of bundles whose messages were changed through the ORM"
+    bundles_table = TranslationBundle.__table__
+    for bundle_id, contents_hash in _calculate_bundle_hashes(bundle_ids).iteritems():
+        db.session.execute(bundles_table.update().where(bundles_table.c.id == bundle_id).values(contents_hash = contents_hash))
+        db_bundle = db.session.identity_map.get(identity_key(TranslationBundle, bundle_id))
+        if db_bundle is not None:
+            set_committed_value(db_bundle, 'contents_hash', contents_hash)
+
 def calculate_content_hash(app_url):
     """Given an App URL generate the hash of the values of the translations. This way, can quickly know if an app was changed or not in a single query, and not do the whole
-    expensive DB processing for those which have not changed."""
+    expensive DB processing for those which have not changed. It does not write anything."""
     
+    translated_app = db.session.query(TranslatedApp).filter_by(url=app_url).first()
+    if translated_app is None:
+        return
+
+    translation_url = translated_app.translation_url
+    if translation_url is None:
+        return
+
+    db_bundles = db.session.query(TranslationBundle).filter_by(translation_url = translation_url).all()
+
+    # The migration calculated the contents_hash of the existing bundles, so this should not happen
+    missing_hashes = _calculate_bundle_hashes([ db_bundle.id for db_bundle in db_bundles if db_bundle.contents_hash is None ])
+
+    digest = 0
+    for db_bundle in db_bundles:
+        contents_hash = missing_hashes.get(db_bundle.id, db_bundle.contents_hash)
+        # Like bundles without messages did not count before
+        if contents_hash != EMPTY_BUNDLE_HASH:
+            digest += _digest(db_bundle.language, db_bundle.target, contents_hash)
+
+    return u'%s%016x' % (CONTENTS_HASH_VERSION, digest % 2 ** 64)
+
+def is_legacy_content_hash(contents_hash):
+    return contents_hash is not None and not contents_hash.startswith(CONTENTS_HASH_VERSION)
+
+def calculate_legacy_content_hash(app_url):
+    """contents_hash as calculated before CONTENTS_HASH_VERSION. It is expensive (all the messages of
+    the app are loaded), and it is only used to migrate the contents_hash of the existing apps."""
+
     translated_app = db.session.query(TranslatedApp).filter_by(url=app_url).first()
     if translated_app is None:
         return
@@ -161,6 +229,7 @@ def _get_or_create_bundle(app_url, translation_url, metadata, language, target,
     db_translation_bundle = db.session.query(TranslationBundle).filter_by(translation_url = db_translation_url, language = language, target = target).first()
     if not db_translation_bundle:
         db_translation_bundle = TranslationBundle(language, target, db_translation_url, from_developer)
+        db_translation_bundle.contents_hash = EMPTY_BUNDLE_HASH
         db.session.add(db_translation_bundle)
     return db_translation_bundle
 
@@ -170,12 +239,16 @@ def get_bundles_by_key_namespaces(pairs):
     namespaces = [ pair['namespace'] for pair in pairs if pair['namespace'] ]
 
     pairs_found = {}
+    bundle_languages = {
+        # bundle_id: (language, target)
+    }
 
     if keys and namespaces:
-        for key, namespace, bundle_id in db.session.query(ActiveTranslationMessage.key, ActiveTranslationMessage.namespace, ActiveTranslationMessage.bundle_id).filter(ActiveTranslationMessage.key.in_(keys), ActiveTranslationMessage.namespace.in_(namespaces), ActiveTranslationMessage.taken_from_default == False).all():
+        for key, namespace, bundle_id, language, target in db.session.query(TranslationNamespaceIndex.key, TranslationNamespaceIndex.namespace, TranslationNamespaceIndex.bundle_id, TranslationNamespaceIndex.language, TranslationNamespaceIndex.target).filter(TranslationNamespaceIndex.key.in_(keys), TranslationNamespaceIndex.namespace.in_(namespaces), TranslationNamespaceIndex.taken_from_default == False).all():
             if (key, namespace) not in pairs_found:
                 pairs_found[key, namespace] = set()
             pairs_found[key, namespace].add(bundle_id)
+            bundle_languages[bundle_id] = (language, target)
 
     bundle_ids = set()
 
@@ -188,53 +261,702 @@ def get_bundles_by_key_namespaces(pairs):
 
     bundles = []
     existing_bundles = []
-    if bundle_ids:
-        for lang, target in db.session.query(TranslationBundle.language, TranslationBundle.target).filter(TranslationBundle.id.in_(bundle_ids)).all():
-            key = "%s@%s" % (target, lang)
-            if key not in existing_bundles:
-                existing_bundles.append(key)
-                bundles.append({
-                    'language' : lang,
-                    'target' : target,
-                })
+    for bundle_id in bundle_ids:
+        lang, target = bundle_languages[bundle_id]
+        key = "%s@%s" % (target, lang)
+        if key not in existing_bundles:
+            existing_bundles.append(key)
+            bundles.append({
+                'language' : lang,
+                'target' : target,
+            })
     return bundles
 
-def locking(func):
-    """Lock certain complex write operations"""
+def _chunks(values, size = 500):
+    values = list(values)
+    for position in xrange(0, len(values), size):
+        yield values[position:position + size]
 
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        lock_key = 'locks:{}'.format(func.__name__)
-        db.session.remove()
+def _new_message(key, value, user_id, parent_translation_id, taken_from_default, same_tool, tool_id, fmt, position, category, from_developer, namespace):
+    "A message to be stored with _bulk_replace_active_messages"
+    return {
+        'key' : key,
+        'value' : value,
+        'user_id' : user_id,
+        'parent_translation_id' : parent_translation_id,
+        'taken_from_default' : taken_from_default,
+        'same_tool' : same_tool,
+        'tool_id' : tool_id,
+        'fmt' : fmt,
+        'position' : position,
+        'category' : category,
+        'from_developer' : from_developer,
+        'namespace' : namespace,
+    }
 
-        counter = 10
-        import sys, time
+def _repository_namespace_translations(language, target, keys, namespaces):
+    """Query the namespace index for the messages with these keys and namespaces in the bundles with
+    the same language and target of the apps in the repository (ignore others)"""
+    repository_translation_urls = select([ TranslatedApp.translation_url_id ]).where(RepositoryApp.url == TranslatedApp.url)
+    return db.session.query(TranslationNamespaceIndex).filter(
+                TranslationNamespaceIndex.language == language,
+                TranslationNamespaceIndex.target == target,
+                TranslationNamespaceIndex.key.in_(keys),
+                TranslationNamespaceIndex.namespace.in_(namespaces),
+                TranslationNamespaceIndex.translation_url_id.in_(repository_translation_urls),
+            )
+
+_NAMESPACE_INDEX_COLUMNS = [ 'namespace', 'key', 'language', 'target', 'bundle_id', 'translation_url_id', 'value', 'taken_from_default', 'from_developer', 'user_id' ]
+
+def _namespace_index_select():
+    "The contents of the namespace index, calculated from the active messages"
+    return select([
+                ActiveTranslationMessage.namespace, ActiveTranslationMessage.key, TranslationBundle.language, TranslationBundle.target,
+                ActiveTranslationMessage.bundle_id, TranslationBundle.translation_url_id, ActiveTranslationMessage.value,
+                ActiveTranslationMessage.taken_from_default, ActiveTranslationMessage.from_developer, TranslationMessageHistory.user_id
+            ]).select_from(
+                ActiveTranslationMessage.__table__.join(TranslationBundle.__table__, ActiveTranslationMessage.bundle_id == TranslationBundle.id).outerjoin(TranslationMessageHistory.__table__, ActiveTranslationMessage.history_id == TranslationMessageHistory.id)
+            ).where(ActiveTranslationMessage.namespace != None)
+
+def _reindex_bundles_namespaces(bundle_ids):
+    "Calculate again the namespace index of bundles whose messages were changed through the ORM"
+    index_table = TranslationNamespaceIndex.__table__
+    for chunk in _chunks(bundle_ids):
+        db.session.execute(index_table.delete().where(index_table.c.bundle_id.in_(chunk)))
+        db.session.execute(index_table.insert().from_select(_NAMESPACE_INDEX_COLUMNS, _namespace_index_select().where(ActiveTranslationMessage.bundle_id.in_(chunk))))
+
+def rebuild_namespace_index():
+    "Calculate again the whole namespace index (it is maintained on every write, so this should not be needed)"
+    index_table = TranslationNamespaceIndex.__table__
+    db.session.execute(index_table.delete())
+    db.session.execute(index_table.insert().from_select(_NAMESPACE_INDEX_COLUMNS, _namespace_index_select()))
+    try:
+        db.session.commit()
+    except:
+        db.session.rollback()
+        raise
+
+def _counts_as_translated(taken_from_default, same_tool):
+    "Same condition as _get_all_results_from_translation_url"
+    return not taken_from_default and same_tool == True
+
+def _bundle_stats_rows(bundle_ids = None):
+    """The contents of the TranslationBundleStats and TranslationBundleTool of these bundles (all if None),
+    calculated from the active messages: ({bundle_id: stats row}, {bundle_id: set of tool ids})"""
+    active_table = ActiveTranslationMessage.__table__
+    bundles_table = TranslationBundle.__table__
+
+    bundles_query = select([ bundles_table.c.id, bundles_table.c.translation_url_id, bundles_table.c.language, bundles_table.c.target ])
+    counts_query = select([ active_table.c.bundle_id, func.count(func.distinct(active_table.c.key)), func.max(active_table.c.datetime), func.min(active_table.c.datetime) ]).where(and_(
+                            active_table.c.taken_from_default == False, active_table.c.same_tool == True)).group_by(active_table.c.bundle_id)
+    tools_query = select([ active_table.c.bundle_id, active_table.c.tool_id ]).where(and_(
+                            active_table.c.same_tool == True, active_table.c.tool_id != None)).group_by(active_table.c.bundle_id, active_table.c.tool_id)
+    if bundle_ids is not None:
+        bundles_query = bundles_query.where(bundles_table.c.id.in_(bundle_ids))
+        counts_query = counts_query.where(active_table.c.bundle_id.in_(bundle_ids))
+        tools_query = tools_query.where(active_table.c.bundle_id.in_(bundle_ids))
+
+    rows = {}
+    for bundle_id, translation_url_id, language, target in db.session.execute(bundles_query):
+        rows[bundle_id] = {
+            'bundle_id' : bundle_id,
+            'translation_url_id' : translation_url_id,
+            'language' : language,
+            'target' : target,
+            'translated' : 0,
+            'creation_date' : None,
+            'modification_date' : None,
+        }
+
+    for bundle_id, translated, modification_date, creation_date in db.session.execute(counts_query):
+        if bundle_id in rows:
+            rows[bundle_id].update(translated = translated, creation_date = creation_date, modification_date = modification_date)
+
+    tools = defaultdict(set)
+    for bundle_id, tool_id in db.session.execute(tools_query):
+        if bundle_id in rows:
+            tools[bundle_id].add(tool_id)
+
+    return rows, tools
+
+def _recalculate_bundle_stats(bundle_ids):
+    "Calculate again the stats of bundles whose messages were changed through the ORM"
+    stats_table = TranslationBundleStats.__table__
+    tools_table = TranslationBundleTool.__table__
+    for chunk in _chunks(bundle_ids):
+        db.session.execute(stats_table.delete().where(stats_table.c.bundle_id.in_(chunk)))
+        db.session.execute(tools_table.delete().where(tools_table.c.bundle_id.in_(chunk)))
+
+        rows, tools = _bundle_stats_rows(chunk)
+        if rows:
+            db.session.execute(stats_table.insert(), rows.values())
+        tool_rows = [ { 'bundle_id' : bundle_id, 'tool_id' : tool_id } for bundle_id, tool_ids in tools.iteritems() for tool_id in tool_ids ]
+        if tool_rows:
+            db.session.execute(tools_table.insert(), tool_rows)
+
+def _update_bundle_stats(db_bundle, removed, added):
+    """removed and added are lists of (taken_from_default, same_tool, tool_id, datetime) of the active
+    messages deleted and inserted in db_bundle. The stats are updated without counting the messages
+    again, unless the first or the last translation or a tool disappear (or there are no stats yet)."""
+    stats_table = TranslationBundleStats.__table__
+    tools_table = TranslationBundleTool.__table__
+    stats = db.session.execute(select([ stats_table.c.translated, stats_table.c.creation_date, stats_table.c.modification_date ]).where(stats_table.c.bundle_id == db_bundle.id)).first()
+    if stats is None:
+        _recalculate_bundle_stats([ db_bundle.id ])
+        return
+
+    translated, creation_date, modification_date = stats
+
+    removed_dates = [ message_datetime for taken_from_default, same_tool, tool_id, message_datetime in removed if _counts_as_translated(taken_from_default, same_tool) ]
+    added_dates = [ message_datetime for taken_from_default, same_tool, tool_id, message_datetime in added if _counts_as_translated(taken_from_default, same_tool) ]
+    added_tools = set([ tool_id for taken_from_default, same_tool, tool_id, message_datetime in added if same_tool == True and tool_id is not None ])
+    removed_tools = set([ tool_id for taken_from_default, same_tool, tool_id, message_datetime in removed if same_tool == True and tool_id is not None ]) - added_tools
+
+    for removed_date in removed_dates:
+        if removed_date is None or creation_date is None or removed_date <= creation_date or removed_date >= modification_date:
+            _recalculate_bundle_stats([ db_bundle.id ])
+            return
+
+    if removed_tools:
+        _recalculate_bundle_stats([ db_bundle.id ])
+        return
+
+    if added_tools:
+        tool_ids = set([ tool_id for tool_id, in db.session.execute(select([ tools_table.c.tool_id ]).where(tools_table.c.bundle_id == db_bundle.id)) ])
+        for tool_id in added_tools - tool_ids:
+            # Not found in Python, but the database might consider it the same tool (e.g., 'Tool' and 'tool')
+            if db.session.execute(select([ tools_table.c.id ]).where(and_(tools_table.c.bundle_id == db_bundle.id, tools_table.c.tool_id == tool_id))).first() is None:
+                db.session.execute(tools_table.insert(), { 'bundle_id' : db_bundle.id, 'tool_id' : tool_id })
+
+    if not removed_dates and not added_dates:
+        return
+
+    values = {
+        'translated' : translated + len(added_dates) - len(removed_dates),
+    }
+    if added_dates:
+        values['creation_date'] = min([ creation_date ] + added_dates) if creation_date is not None else min(added_dates)
+        values['modification_date'] = max([ modification_date ] + added_dates) if modification_date is not None else max(added_dates)
+    db.session.execute(stats_table.update().where(stats_table.c.bundle_id == db_bundle.id).values(**values))
+
+def repair_bundle_stats():
+    """Compare the stats of every bundle with a recount of its active messages, and calculate again
+    those which differ. They are maintained on every write, so this should not find anything. It
+    returns the number of bundles repaired."""
+    stats_table = TranslationBundleStats.__table__
+    tools_table = TranslationBundleTool.__table__
+
+    expected_rows, expected_tools = _bundle_stats_rows()
+
+    current_rows = {}
+    for row in db.session.execute(select([ stats_table.c.bundle_id, stats_table.c.translation_url_id, stats_table.c.language, stats_table.c.target,
+                                            stats_table.c.translated, stats_table.c.creation_date, stats_table.c.modification_date ])):
+        current_rows[row['bundle_id']] = dict(row)
+
+    current_tools = defaultdict(set)
+    for bundle_id, tool_id in db.session.execute(select([ tools_table.c.bundle_id, tools_table.c.tool_id ])):
+        current_tools[bundle_id].add(tool_id)
+
+    wrong_bundle_ids = []
+    for bundle_id in set(expected_rows).union(current_rows).union(current_tools):
+        if expected_rows.get(bundle_id) != current_rows.get(bundle_id) or expected_tools.get(bundle_id, set()) != current_tools.get(bundle_id, set()):
+            wrong_bundle_ids.append(bundle_id)
+    db.session.rollback()
+
+    # Each chunk is counted again in its own transaction, so messages written meanwhile are not lost
+    for chunk in _chunks(sorted(wrong_bundle_ids), size = 100):
+        _recalculate_bundle_stats(chunk)
+        try:
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+
+    return len(wrong_bundle_ids)
+
+# What is calculated again, at commit time, for the bundles whose active messages were changed
+# through the ORM (_bulk_replace_active_messages keeps them up to date by itself):
+# (name, attributes of ActiveTranslationMessage it depends on, function receiving the bundle ids)
+_BUNDLE_SUMMARIES = [
+    ('contents_hash', ('key', 'value'), _recalculate_bundle_hashes),
+    ('namespace_index', ('key', 'value', 'namespace', 'taken_from_default', 'from_developer', 'history_id', 'history'), _reindex_bundles_namespaces),
+    ('stats', ('key', 'taken_from_default', 'same_tool', 'tool_id', 'datetime'), _recalculate_bundle_stats),
+]
+
+_CHANGED_BUNDLES = 'translator_changed_bundles'
+
+def _changed_message_bundle_ids(db_message, attributes):
+    "The bundles of a dirty active message affected by the changes in these attributes"
+    state = inspect(db_message)
+    if not any([ state.attrs[attribute].history.has_changes() for attribute in attributes + ('bundle_id', 'bundle') ]):
+        return []
+
+    bundle_ids = [ db_message.bundle_id ]
+    # A blank history (the attribute was not loaded) has None instead of an empty tuple
+    bundle_ids.extend(state.attrs.bundle_id.history.deleted or ())
+    bundle_ids.extend([ db_bundle.id for db_bundle in (state.attrs.bundle.history.deleted or ()) if db_bundle is not None ])
+    return bundle_ids
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_changed_bundles(session, flush_context):
+    "Remember which bundles must be summarized again (the new, dirty and deleted lists are still those before the flush)"
+    changed_bundles = session.info.setdefault(_CHANGED_BUNDLES, defaultdict(set))
+    for name, attributes, update_func in _BUNDLE_SUMMARIES:
+        bundle_ids = changed_bundles[name]
+        for obj in session.new:
+            if isinstance(obj, ActiveTranslationMessage):
+                bundle_ids.add(obj.bundle_id)
+            elif isinstance(obj, TranslationBundle):
+                bundle_ids.add(obj.id)
+
+        for obj in session.deleted:
+            if isinstance(obj, ActiveTranslationMessage):
+                bundle_ids.add(inspect(obj).dict.get('bundle_id'))
+
+        for obj in session.dirty:
+            if isinstance(obj, ActiveTranslationMessage):
+                bundle_ids.update(_changed_message_bundle_ids(obj, attributes))
+
+@event.listens_for(db.session, 'before_commit')
+def _update_changed_bundles(session):
+    "Summarize again the bundles changed through the ORM, in the same transaction"
+    # The pending changes are flushed now (and collected), since commit flushes after this event
+    session.flush()
+    changed_bundles = session.info.pop(_CHANGED_BUNDLES, None)
+    if not changed_bundles:
+        return
+
+    for name, attributes, update_func in _BUNDLE_SUMMARIES:
+        bundle_ids = sorted(changed_bundles[name] - set([ None ]))
+        if bundle_ids:
+            update_func(bundle_ids)
+
+@event.listens_for(db.session, 'after_transaction_end')
+def _forget_changed_bundles(session, transaction):
+    "Rolled back or closed: there is nothing to summarize"
+    if transaction.parent is None:
+        session.info.pop(_CHANGED_BUNDLES, None)
+
+def _bulk_replace_active_messages(db_bundle, now, messages, deleted_keys = ()):
+    """Replace the active messages of db_bundle by messages (see _new_message), adding them to the
+    history, and delete the active messages of deleted_keys. This is equivalent to creating the
+    TranslationMessageHistory and ActiveTranslationMessage objects one by one, but the active messages
+    are deleted and inserted with a few multi-row statements, whatever the size of the bundle."""
+    keys = set(deleted_keys)
+    keys.update([ message['key'] for message in messages ])
+    if not keys:
+        return
+
+    _extend_locks()
+    db.session.flush()
+    bundle_id = db_bundle.id
+    active_table = ActiveTranslationMessage.__table__
+    history_table = TranslationMessageHistory.__table__
+    index_table = TranslationNamespaceIndex.__table__
+
+    digest_delta = 0
+    track_hash = db_bundle.contents_hash is not None
+    removed_stats = []
+    removed_ids = []
+
+    for chunk in _chunks(keys):
+        condition = and_(active_table.c.bundle_id == bundle_id, active_table.c.key.in_(chunk))
+        removed_query = select([ active_table.c.id, active_table.c.key, active_table.c.value, active_table.c.taken_from_default, active_table.c.same_tool, active_table.c.tool_id, active_table.c.datetime ]).where(condition)
+        for active_id, key, value, taken_from_default, same_tool, tool_id, message_datetime in db.session.execute(removed_query):
+            if track_hash:
+                digest_delta -= _digest(key, value)
+            removed_stats.append((taken_from_default, same_tool, tool_id, message_datetime))
+            removed_ids.append(active_id)
+        db.session.execute(active_table.delete().where(condition))
+        db.session.execute(index_table.delete().where(and_(index_table.c.bundle_id == bundle_id, index_table.c.key.in_(chunk))))
+
+    # The session must not keep (and later try to update) the deleted messages
+    for active_id in removed_ids:
+        obj = db.session.identity_map.get(identity_key(ActiveTranslationMessage, active_id))
+        if obj is not None:
+            db.session.expunge(obj)
+
+    if not messages:
+        _add_to_bundle_hash(db_bundle, digest_delta)
+        _update_bundle_stats(db_bundle, removed_stats, [])
+        return
+
+    # The history messages are inserted with one statement per chunk, and their ids are read back
+    # by key (the ids of a multi-row insert are not necessarily contiguous). MySQL might round the
+    # fractions of a second of now, and the newest history message of each key is the one just added
+    history_ids = {}
+    for chunk in _chunks(messages):
+        history_rows = []
+        for message in chunk:
+            history_row = dict(message, bundle_id = bundle_id, datetime = now)
+            # TranslationMessageHistory objects never stored same_tool
+            history_row.pop('same_tool')
+            history_rows.append(history_row)
+        db.session.execute(history_table.insert(), history_rows)
+
+        history_query = select([ func.max(history_table.c.id), history_table.c.key ]).where(and_(history_table.c.bundle_id == bundle_id,
+                                history_table.c.datetime >= now.replace(microsecond = 0), history_table.c.key.in_([ message['key'] for message in chunk ]))).group_by(history_table.c.key)
+        history_ids.update([ (key, history_id) for history_id, key in db.session.execute(history_query) ])
+
+    active_rows = []
+    for message in messages:
+        history_id = history_ids[message['key']]
+        category = message['category']
+        if message['namespace'] and not category:
+            category = message['namespace']
+
+        active_rows.append({
+            'bundle_id' : bundle_id,
+            'key' : message['key'],
+            'value' : message['value'] if message['value'] is not None else "",
+            'history_id' : history_id,
+            'datetime' : now,
+            'taken_from_default' : message['taken_from_default'],
+            'position' : message['position'],
+            'category' : category,
+            'from_developer' : message['from_developer'],
+            'namespace' : message['namespace'],
+            'tool_id' : message['tool_id'],
+            'same_tool' : message['same_tool'],
+            'fmt' : message['fmt'],
+        })
+        if track_hash:
+            digest_delta += _digest(message['key'], active_rows[-1]['value'])
+    db.session.execute(active_table.insert(), active_rows)
+    _add_to_bundle_hash(db_bundle, digest_delta)
+    _update_bundle_stats(db_bundle, removed_stats, [ (row['taken_from_default'], row['same_tool'], row['tool_id'], now) for row in active_rows ])
+
+    index_rows = []
+    for message, active_row in zip(messages, active_rows):
+        if message['namespace']:
+            index_rows.append({
+                'namespace' : message['namespace'],
+                'key' : message['key'],
+                'language' : db_bundle.language,
+                'target' : db_bundle.target,
+                'bundle_id' : bundle_id,
+                'translation_url_id' : db_bundle.translation_url_id,
+                'value' : active_row['value'],
+                'taken_from_default' : message['taken_from_default'],
+                'from_developer' : message['from_developer'],
+                'user_id' : message['user_id'],
+            })
+    if index_rows:
+        db.session.execute(index_table.insert(), index_rows)
+
+def _propagate_namespaced_messages(db_translation_bundle, namespaced_values, user_id, from_developer, now):
+    """namespaced_values is a dictionary {key: (namespace, value)}. Other translations out there in
+    other bundles (of apps in the repository) with the same language, target, key and namespace but
+    a different value are updated with this value and the current credentials.
+
+    Keys, namespaces and values are compared by the database (as when each key was queried on its
+    own), so with a case insensitive collation 'Hello' is not replaced by 'hello'."""
+    if not namespaced_values:
+        return
+
+    lowercase_keys = dict([ (key.lower(), key) for key in namespaced_values ])
+
+    wrong_keys_by_bundle = defaultdict(dict)
+    for chunk in _chunks(namespaced_values.keys(), size = 100):
+        conditions = []
+        for key in chunk:
+            namespace, value = namespaced_values[key]
+            conditions.append(and_(TranslationNamespaceIndex.key == key, TranslationNamespaceIndex.namespace == namespace, TranslationNamespaceIndex.value != value))
+
+        for indexed in _repository_namespace_translations(db_translation_bundle.language, db_translation_bundle.target, chunk, list(set([ namespaced_values[key][0] for key in chunk ]))).filter(
+                                                TranslationNamespaceIndex.bundle_id != db_translation_bundle.id,
+                                                or_(*conditions),
+                                    ).all():
+            # The stored key may differ from the translated one in the case (same key for the collation)
+            key = indexed.key if indexed.key in namespaced_values else lowercase_keys.get(indexed.key.lower())
+            if key is not None:
+                wrong_keys_by_bundle[indexed.bundle_id][indexed.key] = key
+
+    messages_by_bundle = defaultdict(list)
+    for bundle_id, wrong_keys in wrong_keys_by_bundle.iteritems():
+        for wrong_message in db.session.query(ActiveTranslationMessage).filter(ActiveTranslationMessage.bundle_id == bundle_id, ActiveTranslationMessage.key.in_(list(wrong_keys))).options(joinedload('bundle')).all():
+            key = wrong_keys.get(wrong_message.key)
+            if key is None:
+                continue
+            namespace, value = namespaced_values[key]
+
+            # wrong_message is a message for same language, target, key and namespace with a different value.
+            messages_by_bundle[wrong_message.bundle].append(_new_message(key, value, user_id, wrong_message.history_id, taken_from_default = False,
+                                                        same_tool = wrong_message.same_tool, tool_id = wrong_message.tool_id, fmt = wrong_message.fmt,
+                                                        position = wrong_message.position, category = wrong_message.category, from_developer = from_developer,
+                                                        namespace = namespace))
+
+    for wrong_message_bundle, messages in messages_by_bundle.iteritems():
+        _bulk_replace_active_messages(wrong_message_bundle, now, messages)
+
+# The suggestions are counted in Redis (HINCRBY) when the messages are stored, and
+# flush_suggestion_counters adds them to the database periodically
+SUGGESTION_COUNTERS = (
+    # model, column, Redis hash
+    (TranslationKeySuggestion, 'key', 'appcomposer:suggestions:counters:key'),
+    (TranslationValueSuggestion, 'human_key', 'appcomposer:suggestions:counters:value'),
+)
+
+def _buffer_suggestions(language, target, key_values, human_key_values):
+    """Count one more use of each (key, value) for TranslationKeySuggestion and of each (human_key, value)
+    for TranslationValueSuggestion"""
+    pipeline = redis_store.pipeline()
+    for (model, column_name, counters_key), pairs in zip(SUGGESTION_COUNTERS, (key_values, human_key_values)):
+        for name, value in pairs:
+            pipeline.hincrby(counters_key, json.dumps([ language, target, name, value ]), 1)
+    pipeline.execute()
+
+SUGGESTION_COUNTERS_LOCK = 'appcomposer:suggestions:counters:flushing'
+
+# The batch of each :processing hash is stored as another field (the others are JSON lists)
+SUGGESTION_COUNTERS_BATCH_FIELD = 'batch'
+
+# KEYS: lock. ARGV: token. The lock is only deleted if it is still ours.
+_RELEASE_LOCK_SCRIPT = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('del', KEYS[1])
+    end
+    return 0
+"""
+
+def flush_suggestion_counters():
+    """Add the suggestions counted in Redis to the database, with a single query to find the existing
+    ones and multi-row UPDATE and INSERT statements per language and target. It returns the number
+    of suggestions updated.
+
+    The counters are moved to a :processing hash with a batch identifier, and that identifier is
+    stored (TranslationSuggestionFlush) in the same transaction as the suggestions. If the worker
+    dies after committing but before deleting the :processing hash, the retry finds the batch
+    and does not count it twice."""
+    token = uuid.uuid4().hex
+    if not redis_store.set(SUGGESTION_COUNTERS_LOCK, token, nx = True, ex = 10 * 60):
+        # Another worker is doing it
+        return 0
+
+    flushed = 0
+    try:
+        for model, column_name, counters_key in SUGGESTION_COUNTERS:
+            # Those counted from now on go to a new hash. If the previous flush failed, retry it first.
+            processing_key = counters_key + ':processing'
+            if not redis_store.exists(processing_key):
+                if not redis_store.exists(counters_key):
+                    continue
+                pipeline = redis_store.pipeline()
+                pipeline.rename(counters_key, processing_key)
+                pipeline.hsetnx(processing_key, SUGGESTION_COUNTERS_BATCH_FIELD, uuid.uuid4().hex)
+                pipeline.execute()
+            else:
+                # Counters renamed by an old version, without batch
+                redis_store.hsetnx(processing_key, SUGGESTION_COUNTERS_BATCH_FIELD, uuid.uuid4().hex)
+
+            counters = redis_store.hgetall(processing_key)
+            batch = counters.pop(SUGGESTION_COUNTERS_BATCH_FIELD)
+
+            if db.session.query(TranslationSuggestionFlush).filter_by(batch = batch).first() is None:
+                increments_by_bundle = defaultdict(dict)
+                for field, increment in counters.iteritems():
+                    language, target, name, value = json.loads(field)
+                    increments_by_bundle[language, target][name, value] = int(increment)
+
+                batch_flushed = 0
+                for (language, target), increments in increments_by_bundle.iteritems():
+                    _bulk_increment_suggestions(model, column_name, language, target, increments)
+                    batch_flushed += len(increments)
+
+                now = datetime.datetime.utcnow()
+                db.session.add(TranslationSuggestionFlush(batch, now))
+                db.session.query(TranslationSuggestionFlush).filter(TranslationSuggestionFlush.datetime < now - datetime.timedelta(days = 7)).delete(synchronize_session = False)
 
-        while True: 
-            # Maximum: lock for 15 seconds
-            lock_obj = rlock.lock(lock_key, 15 * 1000)
-            if lock_obj and lock_obj.resource:
-                # print '[{}] {} {}'.format(time.asctime(), "Entering", lock_key, lock_obj)
-                sys.stdout.flush()
                 try:
-                    return func(*args, **kwargs)
-                finally:
-                    # print '[{}] {} {}'.format(time.asctime(), "Exiting", lock_key, lock_obj)
-                    sys.stdout.flush()
-                    try:
-                        rlock.unlock(lock_obj)
-                    except:
-                        raise Exception("Unable to lock")
+                    db.session.commit()
+                except IntegrityError:
+                    # Another worker (which took over after our lock expired) added this batch
+                    db.session.rollback()
+                    continue
+                except:
+                    db.session.rollback()
+                    raise
+                flushed += batch_flushed
+
+            redis_store.delete(processing_key)
+    finally:
+        redis_store.eval(_RELEASE_LOCK_SCRIPT, 1, SUGGESTION_COUNTERS_LOCK, token)
+
+    return flushed
+
+def _bulk_increment_suggestions(model, column_name, language, target, increments):
+    """increments is a dictionary {(name, value): increment} where name is the key or human_key. The
+    existing suggestions are found with a single query; those not found there are looked up one by
+    one, since the database might consider them equal to an existing one (e.g., 'Hello' and 'hello')."""
+    table = model.__table__
+    column = table.c[column_name]
+
+    existing_ids = {}
+    for chunk in _chunks(set([ name for name, value in increments ])):
+        suggestions_query = select([ table.c.id, column, table.c.value ]).where(and_(table.c.language == language, table.c.target == target, column.in_(chunk)))
+        for suggestion_id, name, value in db.session.execute(suggestions_query):
+            existing_ids.setdefault((name, value), suggestion_id)
+
+    updates = []
+    for (name, value), increment in increments.iteritems():
+        suggestion_id = existing_ids.get((name, value))
+        if suggestion_id is None:
+            # Inserted right away, so the next ones which are equal for the database are counted there
+            suggestion_query = select([ table.c.id ]).where(and_(table.c.language == language, table.c.target == target, column == name, table.c.value == value)).limit(1)
+            suggestion_id = db.session.execute(suggestion_query).scalar()
+
+        if suggestion_id is None:
+            db.session.execute(table.insert(), { column_name : name, 'language' : language, 'target' : target, 'value' : value, 'number' : increment })
+        else:
+            updates.append({ 'suggestion_id' : suggestion_id, 'increment' : increment })
+
+    if updates:
+        db.session.execute(table.update().where(table.c.id == bindparam('suggestion_id')).values(number = table.c.number + bindparam('increment')), updates)
+
+LOCK_STATS_KEY = 'appcomposer:locks:stats'
+
+# The locks held by the current thread (see locking and _extend_locks)
+_held_locks = threading.local()
+
+# KEYS: lock. ARGV: token, ttl in milliseconds. The lock is only extended if it is still ours.
+_EXTEND_LOCK_SCRIPT = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('pexpire', KEYS[1], ARGV[2])
+    end
+    return 0
+"""
+
+def locking(lock_keys_func):
+    """Lock certain complex write operations. lock_keys_func receives the arguments of the
+    function and returns the names of the locks needed, so unrelated operations can run in
+    parallel. They are always acquired in the same (sorted) order to avoid deadlocks. The
+    time waiting for them is stored in LOCK_STATS_KEY.
+
+    The locks expire after TRANSLATOR_LOCK_TTL seconds, so long operations must call
+    _extend_locks while they write, and before committing."""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            lock_keys = sorted(set(lock_keys_func(*args, **kwargs)))
+            db.session.remove()
+
+            t0 = time.time()
+            lock_objs = _acquire_locks(lock_keys)
+            _record_lock_wait(func.__name__, time.time() - t0, acquired = lock_objs is not None)
+            if lock_objs is None:
+                raise Exception("Unable to lock")
+
+            previous_locks = getattr(_held_locks, 'lock_objs', None)
+            _held_locks.lock_objs = lock_objs
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _held_locks.lock_objs = previous_locks
+                _release_locks(lock_objs)
+
+        return wrapper
+    return decorator
+
+def _lock_ttl():
+    "Milliseconds before a lock expires"
+    return int(app.config.get('TRANSLATOR_LOCK_TTL', 15) * 1000)
+
+def _acquire_locks(lock_keys):
+    "Acquire all the locks (or none of them)"
+    lock_objs = []
+    for lock_key in lock_keys:
+        counter = 10
+        while True:
+            lock_obj = rlock.lock(lock_key, _lock_ttl())
+            if lock_obj and lock_obj.resource:
+                lock_objs.append(lock_obj)
+                break
+
             counter = counter - 1
             if counter < 0:
-                raise Exception("Unable to lock")
+                _release_locks(lock_objs)
+                return None
+    return lock_objs
+
+def _extend_locks():
+    """Extend the locks held by the current thread (see locking) for another TRANSLATOR_LOCK_TTL.
+    If any of them has already expired, somebody else might be writing the same messages, so it
+    raises an exception and the caller must not commit."""
+    lock_objs = getattr(_held_locks, 'lock_objs', None)
+    if not lock_objs:
+        return
+
+    ttl = _lock_ttl()
+    for lock_obj in lock_objs:
+        extended = 0
+        for server in rlock.servers:
+            try:
+                extended += server.eval(_EXTEND_LOCK_SCRIPT, 1, lock_obj.resource, lock_obj.key, ttl)
+            except Exception:
+                traceback.print_exc()
+
+        if extended < rlock.quorum:
+            raise Exception("Lock {0} expired".format(lock_obj.resource))
+
+def _release_locks(lock_objs):
+    for lock_obj in reversed(lock_objs):
+        try:
+            rlock.unlock(lock_obj)
+        except:
+            traceback.print_exc()
 
-    return wrapper
+def _record_lock_wait(name, elapsed, acquired):
+    try:
+        pipeline = redis_store.pipeline()
+        pipeline.hincrby(LOCK_STATS_KEY, '{0}:calls'.format(name), 1)
+        pipeline.hincrbyfloat(LOCK_STATS_KEY, '{0}:wait_seconds'.format(name), elapsed)
+        if elapsed > 1:
+            pipeline.hincrby(LOCK_STATS_KEY, '{0}:slow'.format(name), 1)
+        if not acquired:
+            pipeline.hincrby(LOCK_STATS_KEY, '{0}:failed'.format(name), 1)
+        pipeline.execute()
+    except Exception:
+        traceback.print_exc()
 
-@locking
-def add_full_translation_to_app(user_email, app_url, translation_url, app_metadata, language, target, translated_messages, original_messages, from_developer):
+def _bundle_lock_key(translation_url, language, target):
+    return u'locks:bundle:{0}:{1}:{2}'.format(language, target, translation_url)
+
+def _translation_url_lock_key(translation_url):
+    return u'locks:translation_url:{0}'.format(translation_url)
+
+def _translation_lock_keys(user_email, app_url, translation_url, app_metadata, language, target, translated_messages, original_messages, from_developer, expected_revisions = None):
+    """The bundle being written, and each namespace of its messages: messages are copied to (and from)
+    other bundles with the same language, target and namespace. The translation url is locked too, since
+    the rows shared by all its bundles (the url itself, the app, the subscriptions) might be created or
+    copied (see _get_or_create_app)."""
+    lock_keys = [ _translation_url_lock_key(translation_url), _bundle_lock_key(translation_url, language, target) ]
+    for namespace in set([ message.get('namespace') for message in (original_messages or {}).values() ]):
+        if namespace:
+            lock_keys.append(u'locks:namespace:{0}:{1}:{2}'.format(language, target, namespace))
+    return lock_keys
+
+@locking(_translation_lock_keys)
+def add_full_translation_to_app(user_email, app_url, translation_url, app_metadata, language, target, translated_messages, original_messages, from_developer, expected_revisions = None):
+    """Store translated_messages ({key: value}) in the bundle. If expected_revisions ({key: revision}, see
+    retrieve_stored) is provided, those messages whose revision has changed meanwhile are not stored.
+    It returns those conflicts as {key: current revision}."""
     user = db.session.query(GoLabOAuthUser).filter_by(email=user_email).first()
     db_translation_bundle = _get_or_create_bundle(app_url, translation_url, app_metadata, language, target, from_developer)
+
+    conflicts = {}
+    if expected_revisions and translated_messages is not None:
+        current_revisions = {}
+        for chunk in _chunks(expected_revisions.keys()):
+            current_revisions.update(db.session.query(ActiveTranslationMessage.key, ActiveTranslationMessage.history_id).filter(ActiveTranslationMessage.bundle == db_translation_bundle, ActiveTranslationMessage.key.in_(chunk)).all())
+
+        translated_messages = translated_messages.copy()
+        for key, revision in expected_revisions.iteritems():
+            if key in translated_messages and current_revisions.get(key) != revision:
+                # Somebody else changed it since the client retrieved it
+                conflicts[key] = current_revisions.get(key)
+                translated_messages.pop(key)
+
     # 
     # <NO SHIELD NEW BEHAVIOR>
     # 
@@ -366,84 +1088,56 @@ def add_full_translation_to_app(user_email, app_url, translation_url, app_metada
         # So I take the existing translations for that (namespace, key, bundle), and if they exist, I use them and delete the current message
         # 
         existing_namespace_translations = {}
-        _user_ids = set()
 
         if existing_namespace_keys:
-            for key, namespace, value, current_from_developer, existing_user_id in db.session.query(
-                    ActiveTranslationMessage.key,
-                    ActiveTranslationMessage.namespace,
-                    ActiveTranslationMessage.value,
-                    ActiveTranslationMessage.from_developer,
-                    TranslationMessageHistory.user_id
-                ).filter(
-                    ActiveTranslationMessage.history_id == TranslationMessageHistory.id,
-                    ActiveTranslationMessage.key.in_(list(existing_namespace_keys)),
-                    ActiveTranslationMessage.namespace.in_(list(existing_namespaces)),
-                    ActiveTranslationMessage.bundle_id == TranslationBundle.id,
-                    TranslationBundle.language == db_translation_bundle.language,
-                    TranslationBundle.target == db_translation_bundle.target,
-                    ActiveTranslationMessage.bundle_id != db_translation_bundle.id,
-                    ActiveTranslationMessage.taken_from_default == False,
-                    # And make sure it's in the repository (ignore others)
-                    TranslationBundle.translation_url_id == TranslatedApp.translation_url_id,
-                    RepositoryApp.url == TranslatedApp.url
+            for indexed in _repository_namespace_translations(db_translation_bundle.language, db_translation_bundle.target, list(existing_namespace_keys), list(existing_namespaces)).filter(
+                    TranslationNamespaceIndex.bundle_id != db_translation_bundle.id,
+                    TranslationNamespaceIndex.taken_from_default == False,
                 ).all():
 
-                existing_namespace_translations[key, namespace] = (value, current_from_developer, existing_user_id)
-                _user_ids.add(existing_user_id)
-
-        existing_users = {}
-        if _user_ids:
-            for user in db.session.query(GoLabOAuthUser).filter(GoLabOAuthUser.id.in_(list(_user_ids))).all():
-                existing_users[user.id] = user
+                existing_namespace_translations[indexed.key, indexed.namespace] = (indexed.value, indexed.from_developer, indexed.user_id)
 
+        now = datetime.datetime.utcnow()
+        fixed_messages = []
         for wrong_message in existing_active_translations_with_namespace_with_default_value:
-            now = datetime.datetime.utcnow()
             pack = existing_namespace_translations.get((wrong_message.key, wrong_message.namespace))
             if pack:
                 value, current_from_developer, existing_user_id = pack
-                existing_user = existing_users[existing_user_id]
-                key = wrong_message.key
-                wrong_history = wrong_message.history
-                wrong_history_parent_id = wrong_history.id
-                wrong_message_position = wrong_message.position
-                wrong_message_category = wrong_message.category
-                wrong_message_tool_id = wrong_message.tool_id
-                wrong_message_same_tool = wrong_message.same_tool
-                wrong_message_fmt = wrong_message.fmt
-
-                # 1st) Delete the current translation message
-                db.session.delete(wrong_message)
-
-                # 2nd) Create a new historic translation message
-                new_db_history = TranslationMessageHistory(db_translation_bundle, key, value, existing_user, now, wrong_history_parent_id, 
-                                    taken_from_default = False, same_tool = wrong_message_same_tool, tool_id = wrong_message_tool_id, fmt = wrong_message_fmt, 
-                                    position = wrong_message_position, category = wrong_message_category, from_developer = current_from_developer, namespace = wrong_message.namespace)
-                db.session.add(new_db_history)
-
-                # 3rd) Create a new active translation message
-                db.session.query(ActiveTranslationMessage).filter_by(bundle=db_translation_bundle, key=key).delete()
-                new_db_active_translation_message = ActiveTranslationMessage(db_translation_bundle, key, value, new_db_history, now, False, wrong_message_position, wrong_message_category, current_from_developer, namespace, wrong_message_tool_id, wrong_message_same_tool, wrong_message_fmt)
-                db.session.add(new_db_active_translation_message)
+                # Replace the current translation message by a new one (with its history)
+                fixed_messages.append(_new_message(wrong_message.key, value, existing_user_id, wrong_message.history_id, taken_from_default = False,
+                                    same_tool = wrong_message.same_tool, tool_id = wrong_message.tool_id, fmt = wrong_message.fmt,
+                                    position = wrong_message.position, category = wrong_message.category, from_developer = current_from_developer, namespace = wrong_message.namespace))
+
+        _bulk_replace_active_messages(db_translation_bundle, now, fixed_messages)
+
+    user_id = user.id if user is not None else None
+    key_suggestions = []
+    value_suggestions = []
 
     if translated_messages is not None:
-        # Delete active translations that are going to be replaced
+        # Find active translations that are going to be replaced
         # Store which were the parents of those translations and
         # what existing translations don't need to be replaced
-        unchanged = []
+        unchanged = set()
         parent_translation_ids = {}
+        replaced_keys = []
 
         for existing_active_translation in db.session.query(ActiveTranslationMessage).filter_by(bundle = db_translation_bundle).all():
             key = existing_active_translation.key
             if key in translated_messages:
                 if (translated_messages[key] and existing_active_translation.value != translated_messages[key]) or (not from_developer and existing_active_translation.taken_from_default):
-                    parent_translation_ids[key] = existing_active_translation.history.id
-                    db.session.delete(existing_active_translation)
+                    parent_translation_ids[key] = existing_active_translation.history_id
+                    replaced_keys.append(key)
                 else:
-                    unchanged.append(key)
+                    unchanged.add(key)
 
         # For each translation message
         now = datetime.datetime.utcnow()
+        new_messages = []
+        namespaced_values = {
+            # key: (namespace, value)
+        }
+
         for key, value in translated_messages.iteritems():
             if value is None:
                 value = ""
@@ -465,18 +1159,10 @@ def add_full_translation_to_app(user_email, app_url, translation_url, app_metada
                 else:
                     taken_from_default = False
 
-                # Create a new history message
+                # Create a new history message, and a new active message pointing to it
                 parent_translation_id = parent_translation_ids.get(key, None)
-                db_history = TranslationMessageHistory(db_translation_bundle, key, value, user, now, parent_translation_id, taken_from_default = taken_from_default,
-                                        same_tool = same_tool, tool_id = tool_id, fmt = fmt, position = position, category = category, from_developer = from_developer, namespace = namespace)
-                db.session.add(db_history)
-
-                # Establish that thew new active message points to this history message
-
-                # We are going to add a new message: delete the one existing if any
-                db.session.query(ActiveTranslationMessage).filter_by(bundle=db_translation_bundle, key=key).delete()
-                db_active_translation_message = ActiveTranslationMessage(db_translation_bundle, key, value, db_history, now, taken_from_default, position, category, from_developer, namespace, tool_id, same_tool, fmt)
-                db.session.add(db_active_translation_message)
+                new_messages.append(_new_message(key, value, user_id, parent_translation_id, taken_from_default = taken_from_default,
+                                        same_tool = same_tool, tool_id = tool_id, fmt = fmt, position = position, category = category, from_developer = from_developer, namespace = namespace))
 
                 if same_text:
                     # If the message in the original language is the same as in the target language or the value is empty and it shouldn't, then
@@ -488,109 +1174,34 @@ def add_full_translation_to_app(user_email, app_url, translation_url, app_metada
                     # Given that the original language will be a suggestion anyway, it's better to avoid storing this message as suggestion
                     continue
 
-
                 if namespace:
-                    # 
-                    # If namespace, maybe this key is present in other translations. Therefore, I search for other translations
-                    # out there in other bundles but with same language and target and the same namespace, where they are not from developer
-                    # and I copy my translation to them.
-                    # 
-                    for wrong_message in db.session.query(ActiveTranslationMessage).filter(
-                                                        ActiveTranslationMessage.key == key, 
-                                                        ActiveTranslationMessage.namespace == namespace, 
-                                                        ActiveTranslationMessage.value != value, 
-                                                        ActiveTranslationMessage.bundle_id == TranslationBundle.id, 
-                                                        TranslationBundle.language == db_translation_bundle.language, 
-                                                        TranslationBundle.target == db_translation_bundle.target, 
-                                                        TranslationBundle.id != db_translation_bundle.id,
-                                                        # And make sure it's in the repository (ignore others)
-                                                        TranslationBundle.translation_url_id == TranslatedApp.translation_url_id,
-                                                        RepositoryApp.url == TranslatedApp.url
-                                            ).options(joinedload_all('bundle')).all():
-                        # wrong_message is a message for same language, target, key and namespace with a different value.
-                        # We must update it with the current credentials
-                        wrong_history = wrong_message.history
-                        wrong_history_parent_id = wrong_history.id
-                        wrong_message_position = wrong_message.position
-                        wrong_message_category = wrong_message.category
-                        wrong_message_bundle = wrong_message.bundle
-                        wrong_message_tool_id = wrong_message.tool_id
-                        wrong_message_same_tool = wrong_message.same_tool
-                        wrong_message_fmt = wrong_message.fmt
-
-                        # 1st) Delete the current translation message
-                        db.session.delete(wrong_message)
-
-                        # 2nd) Create a new historic translation message
-                        new_db_history = TranslationMessageHistory(wrong_message_bundle, key, value, user, now, wrong_history_parent_id, taken_from_default = False,    
-                                                                    same_tool = wrong_message_same_tool, tool_id = wrong_message_tool_id, fmt = wrong_message_fmt, 
-                                                                    position = wrong_message_position, category = wrong_message_category, from_developer = from_developer, 
-                                                                    namespace = namespace)
-                        db.session.add(new_db_history)
-
-                        # 3rd) Create a new active translation message
-                        db.session.query(ActiveTranslationMessage).filter_by(bundle=wrong_message_bundle, key=key).delete()
-                        new_db_active_translation_message = ActiveTranslationMessage(wrong_message_bundle, key, value, new_db_history, now, False, wrong_message_position, wrong_message_category, from_developer, namespace, wrong_message_tool_id, wrong_message_same_tool, wrong_message_fmt)
-                        db.session.add(new_db_active_translation_message)
-                
+                    namespaced_values[key] = (namespace, value)
+
                 # Create a suggestion based on the key
-                db_existing_key_suggestion = db.session.query(TranslationKeySuggestion).filter_by(key = key, value = value, language = language, target = target).first()
-                if db_existing_key_suggestion:
-                    db_existing_key_suggestion.number += 1
-                    db.session.add(db_existing_key_suggestion)
-                else:
-                    db_key_suggestion = TranslationKeySuggestion(key = key, language = language, target = target, value = value, number = 1)
-                    db.session.add(db_key_suggestion)
+                key_suggestions.append((key, value))
 
                 # Create a suggestion based on the value
                 if original_messages is not None and key in original_messages:
                     human_key = original_messages[key]['text'][:255]
+                    value_suggestions.append((human_key, value))
 
-                    db_existing_human_key_suggestion = db.session.query(TranslationValueSuggestion).filter_by(human_key = human_key, value = value, language = language, target = target).first()
-                    if db_existing_human_key_suggestion:
-                        db_existing_human_key_suggestion.number += 1
-                        db.session.add(db_existing_human_key_suggestion)
-                    else:
-                        db_human_key_suggestion = TranslationValueSuggestion(human_key = human_key, language = language, target = target, value = value, number = 1)
-                        db.session.add(db_human_key_suggestion)
+        # Replaced messages which are not in original_messages are just deleted
+        _bulk_replace_active_messages(db_translation_bundle, now, new_messages, deleted_keys = replaced_keys)
+        _propagate_namespaced_messages(db_translation_bundle, namespaced_values, user_id, from_developer, now)
 
     now = datetime.datetime.utcnow()
-    existing_keys = [ key for key, in db.session.query(ActiveTranslationMessage.key).filter_by(bundle = db_translation_bundle).all() ]
+    existing_keys = set([ key for key, in db.session.query(ActiveTranslationMessage.key).filter_by(bundle = db_translation_bundle).all() ])
 
     namespaces = [ v['namespace'] for k, v in original_messages.iteritems() if k not in existing_keys and v['namespace'] ]
+    existing_namespaces = {}
     if namespaces:
-        existing_namespaces = {}
-        _user_ids = set()
         if original_messages and namespaces:
-            for key, namespace, value, current_from_developer, existing_user_id in db.session.query(
-                                    ActiveTranslationMessage.key, 
-                                    ActiveTranslationMessage.namespace, 
-                                    ActiveTranslationMessage.value, 
-                                    ActiveTranslationMessage.from_developer, 
-                                    TranslationMessageHistory.user_id
-                                ).filter(
-                                    ActiveTranslationMessage.history_id == TranslationMessageHistory.id, 
-                                    ActiveTranslationMessage.key.in_(original_messages.keys()), 
-                                    ActiveTranslationMessage.namespace.in_(list(namespaces)), 
-                                    ActiveTranslationMessage.bundle_id == TranslationBundle.id, 
-                                    TranslationBundle.language == db_translation_bundle.language, 
-                                    TranslationBundle.target == db_translation_bundle.target, 
-                                    ActiveTranslationMessage.taken_from_default == False,
-                                    # Only if it is in the repo
-                                    TranslationBundle.translation_url_id == TranslatedApp.translation_url_id,
-                                    RepositoryApp.url == TranslatedApp.url,
+            for indexed in _repository_namespace_translations(db_translation_bundle.language, db_translation_bundle.target, original_messages.keys(), list(set(namespaces))).filter(
+                                    TranslationNamespaceIndex.taken_from_default == False,
                                 ).all():
-                existing_namespaces[key, namespace] = (value, current_from_developer, existing_user_id)
-                _user_ids.add(existing_user_id)
-
-        existing_users = {}
-        if _user_ids:
-            for user in db.session.query(GoLabOAuthUser).filter(GoLabOAuthUser.id.in_(list(_user_ids))).all():
-                existing_users[user.id] = user
-    else:
-        existing_namespaces = {}
-        existing_users = {}
+                existing_namespaces[indexed.key, indexed.namespace] = (indexed.value, indexed.from_developer, indexed.user_id)
 
+    default_messages = []
     for key, original_message_pack in original_messages.iteritems():
         if key not in existing_keys:
             value = original_message_pack['text'] or ''
@@ -606,30 +1217,21 @@ def add_full_translation_to_app(user_email, app_url, translation_url, app_metada
             
             # If there is a namespace, try to get the value from other namespaces, and override the current value
             current_from_developer = False
-            existing_user = user
+            existing_user_id = user_id
             if namespace:
                 pack = existing_namespaces.get((key, namespace), None)
                 if pack is not None:
                     value, current_from_developer, existing_user_id = pack
-                    existing_user = existing_users[existing_user_id]
                     taken_from_default = False
 
             # Create a new translation establishing that it was generated with the default value (and therefore it should be changed)
-            db_history = TranslationMessageHistory(db_translation_bundle, key, value, existing_user, now, None, taken_from_default = taken_from_default,
+            default_messages.append(_new_message(key, value, existing_user_id, None, taken_from_default = taken_from_default,
                                                     same_tool = same_tool, tool_id = tool_id, fmt = fmt, position = position, category = category, 
-                                                    from_developer = current_from_developer, namespace = namespace)
-            db.session.add(db_history)
-            
-            # Establish that thew new active message points to this history message
-            db.session.query(ActiveTranslationMessage).filter_by(bundle=db_translation_bundle, key=key).delete()
-            db_active_translation_message = ActiveTranslationMessage(db_translation_bundle, key, value, db_history, now, taken_from_default = taken_from_default, position = position, category = category, from_developer = current_from_developer, namespace = namespace, tool_id = tool_id, same_tool = same_tool, fmt = fmt)
-            db.session.add(db_active_translation_message)
+                                                    from_developer = current_from_developer, namespace = namespace))
 
-    for existing_key in existing_keys:
-        if existing_key not in original_messages:
-            old_translations = db.session.query(ActiveTranslationMessage).filter_by(bundle = db_translation_bundle, key = existing_key).all()
-            for old_translation in old_translations:
-                db.session.delete(old_translation)
+    # Messages which are not in the original bundle anymore are deleted
+    old_keys = [ existing_key for existing_key in existing_keys if existing_key not in original_messages ]
+    _bulk_replace_active_messages(db_translation_bundle, now, default_messages, deleted_keys = old_keys)
 
     for key, namespace in db.session.query(ActiveTranslationMessage.key, ActiveTranslationMessage.namespace).filter_by(bundle = db_translation_bundle).group_by(ActiveTranslationMessage.key, ActiveTranslationMessage.namespace).having(func.count(ActiveTranslationMessage.key) > 1).all():
         best_chance = None
@@ -646,16 +1248,28 @@ def add_full_translation_to_app(user_email, app_url, translation_url, app_metada
             if chance != best_chance:
                 db.session.delete(chance)
 
-    # Commit!
+    # Commit! (unless the locks expired meanwhile)
     try:
+        _extend_locks()
         db.session.commit()
     except IntegrityError:
         # Somebody else did this
         db.session.rollback()
+        if not from_developer:
+            # The synchronization will try again, but the user must know that the changes were not stored
+            raise TranslatorError("The translation could not be stored, please try again", 409)
     except:
         db.session.rollback()
         raise
-    
+    else:
+        _buffer_suggestions(language, target, key_suggestions, value_suggestions)
+
+    return conflicts
+
+def _register_app_lock_keys(app_url, translation_url, metadata):
+    return [ _translation_url_lock_key(translation_url) ]
+
+@locking(_register_app_lock_keys)
 def register_app_url(app_url, translation_url, metadata):
     _get_or_create_app(app_url, translation_url, metadata)
     try:
@@ -692,6 +1306,8 @@ def retrieve_stored(translation_url, language, target):
             'from_developer' : message.from_developer,
             'same_tool': message.same_tool,
             'tool_id': message.tool_id,
+            # Changes every time the message is changed
+            'revision': message.history_id,
         }
     return response, bundle.from_developer, db_translation_url.automatic
 
@@ -782,6 +1398,16 @@ def _get_all_results_from_translation_url(translation_url, keys):
             ).group_by(TranslationBundle.language, TranslationBundle.target).all()
     return results
 
+def _get_stored_results_from_translation_url(translation_url):
+    """Same as _get_all_results_from_translation_url for all the keys of the bundles, but read from
+    TranslationBundleStats. Once the app has been synchronized, the keys of its bundles are the ones
+    of the original messages."""
+    return db.session.query(TranslationBundleStats.translated, TranslationBundleStats.modification_date, TranslationBundleStats.creation_date, TranslationBundleStats.language, TranslationBundleStats.target).filter(
+                TranslationBundleStats.translated > 0,
+                TranslationBundleStats.translation_url_id == TranslationUrl.id,
+                TranslationUrl.url == translation_url,
+            ).all()
+
 
 def retrieve_translations_stats(translation_url, original_messages):
     filtered_messages = {
@@ -802,11 +1428,15 @@ def retrieve_translations_stats(translation_url, original_messages):
                 other_tools[properties['tool_id']].append(key)
 
     items = len(filtered_messages)
-    results = _get_all_results_from_translation_url(translation_url, list(filtered_messages))
-
     if items == 0:
         return {}, []
 
+    results = _get_stored_results_from_translation_url(translation_url)
+    if any([ count > items for count, modification_date, creation_date, lang, target in results ]):
+        # The stored stats count the keys of the bundles, which are not these original messages
+        # (e.g., they changed and the app has not been synchronized yet): count only these keys
+        results = _get_all_results_from_translation_url(translation_url, list(filtered_messages))
+
     dependencies_data = {
         # (language, target) : [
         #      {
@@ -834,10 +1464,9 @@ def retrieve_translations_stats(translation_url, original_messages):
         tool_translation_urls = db.session.query(TranslationUrl.url).filter(
             tool_domain_condition,
             TranslationBundle.translation_url_id == TranslationUrl.id,
-            ActiveTranslationMessage.bundle_id == TranslationBundle.id,
-            ActiveTranslationMessage.tool_id == tool_used,
-            ActiveTranslationMessage.same_tool == True,
-        ).group_by(TranslationUrl.url).all()
+            TranslationBundleTool.bundle_id == TranslationBundle.id,
+            TranslationBundleTool.tool_id == tool_used,
+        ).group_by(TranslationUrl.url).order_by(TranslationUrl.url).all()
 
         tool_translation_urls = [ url for url, in tool_translation_urls ]
         if tool_translation_urls:
@@ -869,6 +1498,8 @@ def retrieve_translations_stats(translation_url, original_messages):
                     'app_url': tool_app_url,
                 })
 
+                # Not read from TranslationBundleStats: the app only uses some of the messages of the tool
+                # (tool_keys), and the stats of the bundles of the tool count all of them
                 tool_results = _get_all_results_from_translation_url(tool_translation_url, tool_keys)
                 
                 for count, modification_date, creation_date, lang, target in tool_results:
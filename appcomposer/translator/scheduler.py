@@ -0,0 +1,122 @@
+"""
+Most of the apps of the repository do not change for months, so there is no need to download
+all of them every few minutes. This module keeps in Redis when each app must be checked again:
+
+ * A sorted set (app id -> timestamp of the next check). download_repository_apps(only_due=True)
+   only downloads those apps whose timestamp has passed.
+ * The current interval of each app. Every time an app is checked and nothing has changed, the
+   interval is doubled (up to max_interval). When it changes, it goes back to min_interval.
+   The first interval of an app is estimated from how long ago it changed for the last time.
+ * The number of consecutive failures of each app. Failing apps back off on their own schedule
+   (failing_min_interval, doubled on each failure up to failing_max_interval), without losing
+   the interval they had when working.
+
+New apps are due immediately. A full run (only_due=False) checks every app anyway and updates
+the schedule the same way.
+"""
+import time
+import random
+import datetime
+
+from appcomposer import redis_store
+
+class RecheckScheduler(object):
+    def __init__(self, prefix = 'appcomposer:downloader:schedule', min_interval = 4 * 60, max_interval = 24 * 3600,
+                        failing_min_interval = 10 * 60, failing_max_interval = 6 * 3600, jitter = 0.1):
+        self.key = prefix
+        self.intervals_key = prefix + ':intervals'
+        self.failures_key = prefix + ':failures'
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.failing_min_interval = failing_min_interval
+        self.failing_max_interval = failing_max_interval
+        self.jitter = jitter
+
+    def sync(self, app_ids):
+        """Make sure that exactly these apps are scheduled. New ones are due immediately."""
+        app_ids = set(unicode(app_id) for app_id in app_ids)
+        scheduled = set(unicode(app_id) for app_id in redis_store.zrange(self.key, 0, -1))
+
+        pipeline = redis_store.pipeline()
+        new_ids = app_ids - scheduled
+        if new_ids:
+            pipeline.zadd(self.key, dict( (app_id, 0) for app_id in new_ids ), nx = True)
+
+        removed_ids = list(scheduled - app_ids)
+        if removed_ids:
+            pipeline.zrem(self.key, *removed_ids)
+            pipeline.hdel(self.intervals_key, *removed_ids)
+            pipeline.hdel(self.failures_key, *removed_ids)
+        pipeline.execute()
+
+    def due(self, now = None):
+        """Return the set of app ids whose next check time has passed"""
+        if now is None:
+            now = time.time()
+        return set(int(app_id) for app_id in redis_store.zrangebyscore(self.key, '-inf', now))
+
+    def record(self, results, now = None):
+        """results is a list of (app_id, changed, failed, last_download_change)"""
+        if not results:
+            return
+
+        if now is None:
+            now = time.time()
+
+        app_ids = [ unicode(app_id) for app_id, _, _, _ in results ]
+        intervals = redis_store.hmget(self.intervals_key, app_ids)
+        failures = redis_store.hmget(self.failures_key, app_ids)
+
+        next_checks = {}
+        new_intervals = {}
+        new_failures = {}
+        recovered = []
+
+        for (app_id, changed, failed, last_download_change), interval, failure_count in zip(results, intervals, failures):
+            app_id = unicode(app_id)
+            if interval is None:
+                interval = self._initial_interval(last_download_change)
+            else:
+                interval = int(interval)
+
+            if failed:
+                failure_count = int(failure_count or 0) + 1
+                delay = min(self.failing_min_interval * 2 ** (failure_count - 1), self.failing_max_interval)
+                new_failures[app_id] = failure_count
+            else:
+                if failure_count is not None:
+                    recovered.append(app_id)
+
+                if changed:
+                    interval = self.min_interval
+                else:
+                    interval = min(interval * 2, self.max_interval)
+                delay = interval
+
+            new_intervals[app_id] = interval
+            next_checks[app_id] = now + delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+        pipeline = redis_store.pipeline()
+        pipeline.zadd(self.key, next_checks)
+        pipeline.hmset(self.intervals_key, new_intervals)
+        if new_failures:
+            pipeline.hmset(self.failures_key, new_failures)
+        if recovered:
+            pipeline.hdel(self.failures_key, *recovered)
+        pipeline.execute()
+
+    def _initial_interval(self, last_download_change):
+        """The longer an app has been stable, the less often it is checked"""
+        if last_download_change is None:
+            return self.min_interval
+        age = (datetime.datetime.utcnow() - last_download_change).total_seconds()
+        return int(max(self.min_interval, min(age / 8, self.max_interval)))
+
+    def stats(self, now = None):
+        if now is None:
+            now = time.time()
+        return {
+            'scheduled': redis_store.zcard(self.key),
+            'due': redis_store.zcount(self.key, '-inf', now),
+            'failing': redis_store.hlen(self.failures_key),
+        }
@@ -1,5 +1,6 @@
 import os
 import sys
+import time
 import datetime
 from celery.schedules import crontab
 
@@ -14,13 +15,13 @@ if cwd.endswith(path):
 
 sys.path.insert(0, cwd)
 
-from appcomposer import app as my_app, db
+from appcomposer import app as my_app, db, redis_store
 from appcomposer.translator.translation_listing import synchronize_apps_cache, synchronize_apps_no_cache, synchronize_single_app_no_cached
 from appcomposer.translator.suggestions import load_all_google_suggestions, load_all_deepl_suggestions, load_all_microsoft_suggestions
 from appcomposer.translator.mongodb_pusher import sync_mongodb_all, sync_mongodb_last_hour
 from appcomposer.translator.notifications import run_notifications, run_update_notifications
 from appcomposer.translator.downloader import sync_repo_apps, download_repository_apps, download_repository_single_app, update_content_hash, update_check_urls_status
-from appcomposer.translator.ops import start_synchronization, end_synchronization
+from appcomposer.translator.ops import start_synchronization, end_synchronization, flush_suggestion_counters, rebuild_namespace_index, repair_bundle_stats
 
 
 GOLAB_REPO = u'golabz'
@@ -64,7 +65,8 @@ cel.conf.update(
         'download_repository_apps': { # This triggers synchronize_apps_cache too, but only if a change in the original contents
             'task': 'download_repository_apps',
             'schedule': datetime.timedelta(minutes=4),
-            'args': ()
+            'args': (),
+            'kwargs': { 'only_due': True }, # Only those apps which are due (see appcomposer.translator.scheduler)
         },
         'sync_repo_apps_cached': { # This triggers download_repository_apps too, but only if a change in the golabz repo
             'task' : 'sync_repo_apps_cached',
@@ -78,11 +80,26 @@ cel.conf.update(
             'schedule' : crontab(hour=3, minute=30),
             'args' : ()
         },
+        'flush_suggestion_counters': {
+            'task': 'flush_suggestion_counters',
+            'schedule': datetime.timedelta(minutes = 1),
+            'args': ()
+        },
+        'download_repository_apps_all': {
+            'task': 'download_repository_apps',
+            'schedule': crontab(hour=3, minute=0),
+            'args': ('nightly-down',)
+        },
         'synchronize_apps_no_cache': {
             'task': 'synchronize_apps_no_cache',
             'schedule': crontab(hour=4, minute=0),
             'args': ()
         },
+        'repair_bundle_stats': {
+            'task': 'repair_bundle_stats',
+            'schedule': crontab(hour=5, minute=0),
+            'args': ()
+        },
         'load_google_suggestions' : {
             'task' : 'load_google_suggestions',
             'schedule' : crontab(hour='*/12', minute=0),
@@ -131,6 +148,9 @@ cel.conf.update(
         'sync_mongodb_recent' : {
             'queue': CRITICAL_INDEPENDENT_TASKS,
         },
+        'flush_suggestion_counters' : {
+            'queue': CRITICAL_INDEPENDENT_TASKS,
+        },
         'sync_repo_apps_cached': {
             'queue': CRITICAL_INDEPENDENT_TASKS,
         },
@@ -152,6 +172,12 @@ cel.conf.update(
         'download_repository_apps': {
             'queue': SLOW_INDEPENDENT_TASKS,
         },
+        'rebuild_namespace_index': {   # Only called from outside
+            'queue': SLOW_INDEPENDENT_TASKS,
+        },
+        'repair_bundle_stats': {
+            'queue': SLOW_INDEPENDENT_TASKS,
+        },
 
         # The following are tasks which can only be run in a single queue
         'synchronize_apps_cache': {
@@ -163,6 +189,9 @@ cel.conf.update(
         'synchronize_single_app': {
             'queue': SINGLE_SYNC_TASKS,
         },
+        'synchronize_single_app_debounced': {
+            'queue': SINGLE_SYNC_TASKS,
+        },
     }
 )
 
@@ -216,6 +245,67 @@ def task_synchronize_single_app(self, source = None, single_app_url = None):
     task_sync_mongodb_recent.delay()
     return result
 
+def _debounce_keys(single_app_url):
+    prefix = u'appcomposer:sync:debounce:{}'.format(single_app_url)
+    return prefix + u':dirty', prefix + u':first-dirty', prefix + u':pending'
+
+def _debounce_periods():
+    quiet_period = my_app.config.get('TRANSLATOR_SYNC_QUIET_PERIOD', 10)
+    max_delay = my_app.config.get('TRANSLATOR_SYNC_MAX_DELAY', 60)
+    return quiet_period, max_delay
+
+def schedule_single_app_synchronization(source, single_app_url):
+    """Synchronize the app once it has not been changed for TRANSLATOR_SYNC_QUIET_PERIOD seconds (but
+    no later than TRANSLATOR_SYNC_MAX_DELAY seconds after the first change). This way, a translator
+    saving one message after another causes a single synchronization rather than one per message."""
+    quiet_period, max_delay = _debounce_periods()
+    dirty_key, first_dirty_key, pending_key = _debounce_keys(single_app_url)
+    # If the task is lost, the keys expire so it is eventually enqueued again
+    expiration = int(max_delay + 2 * quiet_period + 60)
+    now = time.time()
+
+    pipeline = redis_store.pipeline()
+    pipeline.set(dirty_key, now, ex = expiration)
+    pipeline.set(first_dirty_key, now, ex = expiration, nx = True)
+    pipeline.set(pending_key, source, ex = expiration, nx = True)
+    _, _, enqueue = pipeline.execute()
+
+    if enqueue:
+        task_synchronize_single_app_debounced.apply_async((source, single_app_url), countdown = quiet_period)
+
+@cel.task(name='synchronize_single_app_debounced', bind=True)
+def task_synchronize_single_app_debounced(self, source, single_app_url):
+    quiet_period, max_delay = _debounce_periods()
+    dirty_key, first_dirty_key, pending_key = _debounce_keys(single_app_url)
+
+    last_change, first_change = redis_store.mget([ dirty_key, first_dirty_key ])
+    if last_change is not None and first_change is not None:
+        now = time.time()
+        remaining = min(float(last_change) + quiet_period - now, float(first_change) + max_delay - now)
+        if remaining > 0:
+            # Still being changed: wait a bit more
+            task_synchronize_single_app_debounced.apply_async((source, single_app_url), countdown = remaining)
+            return
+
+    # Changes from now on will enqueue a new synchronization
+    redis_store.delete(dirty_key, first_dirty_key, pending_key)
+    return task_synchronize_single_app(source = source, single_app_url = single_app_url)
+
+@cel.task(name='flush_suggestion_counters', bind=True)
+def task_flush_suggestion_counters(self):
+    with my_app.app_context():
+        return flush_suggestion_counters()
+
+@cel.task(name='rebuild_namespace_index', bind=True)
+def task_rebuild_namespace_index(self):
+    with my_app.app_context():
+        rebuild_namespace_index()
+
+@cel.task(name='repair_bundle_stats', bind=True)
+def task_repair_bundle_stats(self):
+    with my_app.app_context():
+        return repair_bundle_stats()
+
 @cel.task(name="sync_mongodb_recent", bind=True)
 def task_sync_mongodb_recent(self):
     return sync_mongodb_last_hour(self)
@@ -264,7 +354,7 @@ def task_download_repository_single_app(self, app_url):
             task_sync_mongodb_recent.delay()
 
 @cel.task(name='download_repository_apps', bind=True)
-def task_download_repository_apps(self, source = None):
+def task_download_repository_apps(self, source = None, only_due = False):
     if source is None:
         source = 'sched-down'
 
@@ -273,7 +363,7 @@ def task_download_repository_apps(self, source = None):
 
     try:
         with my_app.app_context():
-            changes = download_repository_apps()
+            changes = download_repository_apps(only_due = only_due)
             if changes:
                 synchronize_apps_cache_wrapper.delay()
     finally:
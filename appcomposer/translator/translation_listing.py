@@ -24,8 +24,7 @@ def _generic_synchronize_apps(source, cached, provided_apps, single_app_url, ful
             download_repository_apps()
             provided_apps = retrieve_all_translatable_apps()
 
-        _sync_translations(provided_apps, force_reload = not cached)
-        number = len(provided_apps)
+        number = _sync_translations(provided_apps, force_reload = not cached)
     except:
         traceback.print_exc()
     finally:
@@ -49,10 +48,10 @@ def synchronize_single_app_no_cached(source, single_app_url):
 
 
 def _sync_translations(apps_to_check, force_reload):
-    if not apps_to_check:
-        return
-
+    """apps_to_check may be a generator (see downloader._retrieve_translatable_apps). Returns the number of apps processed."""
+    number = 0
     for app_metadata in apps_to_check:
+        number += 1
 
         # Make sure each request starts with a fresh database session
         db.session.remove()
@@ -62,6 +61,7 @@ def _sync_translations(apps_to_check, force_reload):
         except Exception as e:
             logger.warning("Error processing {}: {}".format(app_metadata['app_url'], e), exc_info=True)
 
+    return number
 
 def _add_or_update_app(app_url, metadata_information, repo_app_id, force_reload):
     if DEBUG:
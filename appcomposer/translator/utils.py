@@ -1,20 +1,30 @@
+import sys
+import uuid
+import zlib
 import time
 import json
+import codecs
+import hashlib
 import logging
 import calendar
+import urlparse
 import StringIO
+import threading
 import traceback
 from collections import OrderedDict
 import xml.etree.ElementTree as ET
 from email.utils import parsedate, parsedate_tz
 
+import redis
 import requests
+from flask import current_app, has_app_context
 import requests.packages.urllib3 as urllib3
 urllib3.disable_warnings()
-from cachecontrol import CacheControl
-from cachecontrol.caches import FileCache
+from cachecontrol.adapter import CacheControlAdapter
+from cachecontrol.cache import BaseCache
 from cachecontrol.heuristics import LastModified, TIME_FMT
 
+from appcomposer import redis_store
 from appcomposer.exceptions import TranslatorError
 from appcomposer.cdata import CDATA
 
@@ -79,14 +89,544 @@ class _LastModifiedNoDate(LastModified):
     def warning(self, resp):
         return None
 
+class BoundedRedisCache(BaseCache):
+    """CacheControl backend shared by all the processes through Redis. Each response is stored in its own key,
+    and the total size is kept below max_bytes by evicting the least recently used ones. Hits, misses and
+    evictions are counted in appcomposer:http:cache:stats.
+
+    The size of each response, the LRU and the total size are always updated together in a Lua script,
+    so concurrent workers do not make the total drift."""
+
+    # KEYS: response, sizes, lru, bytes. ARGV: url hash, response, timestamp. Returns the new total size.
+    SET_SCRIPT = """
+        local previous_size = tonumber(redis.call('hget', KEYS[2], ARGV[1]) or '0')
+        redis.call('set', KEYS[1], ARGV[2])
+        redis.call('hset', KEYS[2], ARGV[1], string.len(ARGV[2]))
+        redis.call('zadd', KEYS[3], ARGV[3], ARGV[1])
+        return redis.call('incrby', KEYS[4], string.len(ARGV[2]) - previous_size)
+    """
+
+    # KEYS: sizes, lru, bytes, and the response of each url hash. ARGV: url hashes. Returns the new total size.
+    REMOVE_SCRIPT = """
+        local removed_size = 0
+        for position, url_hash in ipairs(ARGV) do
+            local size = redis.call('hget', KEYS[1], url_hash)
+            if size then
+                removed_size = removed_size + tonumber(size)
+                redis.call('hdel', KEYS[1], url_hash)
+            end
+            redis.call('zrem', KEYS[2], url_hash)
+            redis.call('del', KEYS[position + 3])
+        end
+        return redis.call('decrby', KEYS[3], removed_size)
+    """
+
+    def __init__(self, prefix = 'appcomposer:http:cache', max_bytes = 256 * 1024 * 1024):
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.lru_key = prefix + ':lru'       # sorted set: url hash -> last access
+        self.sizes_key = prefix + ':sizes'   # hash: url hash -> bytes
+        self.bytes_key = prefix + ':bytes'   # total bytes
+        self.stats_key = prefix + ':stats'   # hash: hits, misses, evictions
+        self._set_script = redis_store.register_script(self.SET_SCRIPT)
+        self._remove_script = redis_store.register_script(self.REMOVE_SCRIPT)
+
+    def _hash(self, key):
+        return hashlib.sha1(key.encode('utf8') if isinstance(key, unicode) else key).hexdigest()
+
+    def _key(self, key_hash):
+        return u'{}:{}'.format(self.prefix, key_hash)
+
+    def get(self, key):
+        key_hash = self._hash(key)
+        value = redis_store.get(self._key(key_hash))
+
+        pipeline = redis_store.pipeline()
+        if value is None:
+            pipeline.hincrby(self.stats_key, 'misses', 1)
+        else:
+            pipeline.hincrby(self.stats_key, 'hits', 1)
+            pipeline.zadd(self.lru_key, { key_hash: time.time() }, xx = True)
+        pipeline.execute()
+        return value
+
+    def set(self, key, value):
+        key_hash = self._hash(key)
+        total_bytes = self._set_script(keys = [ self._key(key_hash), self.sizes_key, self.lru_key, self.bytes_key ], args = [ key_hash, value, time.time() ])
+        if total_bytes > self.max_bytes:
+            self._evict()
+
+    def delete(self, key):
+        self._remove([ self._hash(key) ])
+
+    def _remove(self, key_hashes):
+        keys = [ self.sizes_key, self.lru_key, self.bytes_key ] + [ self._key(key_hash) for key_hash in key_hashes ]
+        return self._remove_script(keys = keys, args = key_hashes)
+
+    def _evict(self):
+        """Remove the least recently used responses until the cache is below 90% of max_bytes. Only
+        as many responses as needed are removed (checking again, since other workers add and remove
+        responses meanwhile)."""
+        while True:
+            excess = int(redis_store.get(self.bytes_key) or 0) - int(self.max_bytes * 0.9)
+            if excess <= 0:
+                break
+
+            oldest = redis_store.zrange(self.lru_key, 0, 49)
+            if not oldest:
+                redis_store.set(self.bytes_key, 0)
+                break
+
+            evicted = []
+            evicted_bytes = 0
+            for key_hash, size in zip(oldest, redis_store.hmget(self.sizes_key, oldest)):
+                if evicted_bytes >= excess:
+                    break
+                evicted.append(key_hash)
+                evicted_bytes += int(size or 0)
+
+            self._remove(evicted)
+            redis_store.hincrby(self.stats_key, 'evictions', len(evicted))
+
+    def stats(self):
+        stats = redis_store.hgetall(self.stats_key)
+        return {
+            'hits': int(stats.get('hits') or 0),
+            'misses': int(stats.get('misses') or 0),
+            'evictions': int(stats.get('evictions') or 0),
+            'bytes': int(redis_store.get(self.bytes_key) or 0),
+            'responses': redis_store.zcard(self.lru_key),
+            'max_bytes': self.max_bytes,
+        }
+
+_http_cache = None
+_http_cache_lock = threading.Lock()
+
+def get_http_cache():
+    """Return the HTTP cache configured in HTTP_CACHE_BACKEND (shared by all the sessions of the process), or None"""
+    global _http_cache
+
+    if not has_app_context():
+        return None
+
+    backend = current_app.config.get('HTTP_CACHE_BACKEND')
+    if not backend:
+        return None
+
+    with _http_cache_lock:
+        if _http_cache is None:
+            if backend == 'redis':
+                _http_cache = BoundedRedisCache(max_bytes = current_app.config.get('HTTP_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+            else:
+                raise ValueError("Unknown HTTP_CACHE_BACKEND: {0!r}".format(backend))
+        return _http_cache
+
+def create_http_adapter(caching = True, **kwargs):
+    """HTTPAdapter (kwargs are passed to it) caching the responses if an HTTP cache is configured"""
+    cache = get_http_cache() if caching else None
+    if cache is None:
+        return requests.adapters.HTTPAdapter(**kwargs)
+    return CacheControlAdapter(cache = cache, heuristic = _LastModifiedNoDate(require_date = False), **kwargs)
+
 def get_cached_session(caching = True):
-    if not caching:
-        return requests.Session()
-    return requests.Session() # For some reason, in concurrent environments CacheControl works quite bad.
+    session = requests.Session()
+    # By default there is no HTTP cache (the previous FileCache was not shared among processes and
+    # it grew forever). See HTTP_CACHE_BACKEND in config.py.dist
+    if caching and get_http_cache() is not None:
+        adapter = create_http_adapter()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+    return session
+
+def url_host(url):
+    return urlparse.urlparse(url).netloc.lower()
+
+def _release_when_closed(response, release):
+    """Call release (only once) when the connection of a streamed response is released: when
+    the response is read until the end, or when it is closed"""
+    lock = threading.Lock()
+    released = []
+
+    def release_once():
+        with lock:
+            if released:
+                return
+            released.append(True)
+        release()
+
+    original_close = response.close
+    def close():
+        try:
+            original_close()
+        finally:
+            release_once()
+    response.close = close
+
+    original_release_conn = getattr(response.raw, 'release_conn', None)
+    if original_release_conn is not None:
+        def release_conn():
+            try:
+                original_release_conn()
+            finally:
+                release_once()
+        response.raw.release_conn = release_conn
+
+class HostSessions(object):
+    """Session-like object (only get is supported) to be shared by many threads downloading
+    contents from a few hosts. It keeps a single keep-alive session per host (so connections
+    are reused across apps), and it never allows more than per_host requests in flight for
+    the same host. A request with stream=True is in flight until its response is read or
+    closed, so those responses must always be closed."""
+    def __init__(self, per_host = 4, caching = True):
+        self.per_host = per_host
+        self.caching = caching
+        self._lock = threading.Lock()
+        self._sessions = {
+            # host: (session, semaphore)
+        }
+
+    def _get_session(self, host):
+        with self._lock:
+            if host not in self._sessions:
+                session = requests.Session()
+                adapter = create_http_adapter(caching = self.caching, pool_connections = 1, pool_maxsize = self.per_host)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[host] = (session, threading.BoundedSemaphore(self.per_host))
+            return self._sessions[host]
+
+    def get(self, url, **kwargs):
+        session, semaphore = self._get_session(url_host(url))
+        semaphore.acquire()
+        try:
+            response = circuit_breaker.get(session, url, **kwargs)
+        except:
+            semaphore.release()
+            raise
+
+        if kwargs.get('stream') and response is not None:
+            _release_when_closed(response, semaphore.release)
+        else:
+            semaphore.release()
+        return response
+
+    def close(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+
+        for session, semaphore in sessions:
+            try:
+                session.close()
+            except Exception:
+                traceback.print_exc()
+
+class _SingleFlightCall(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+class SingleFlight(object):
+    """In-memory cache shared by the threads of a single download cycle. The first caller of get
+    for a key runs func, while concurrent (or later) callers of the same key wait for it and reuse
+    its result (or its exception). The number of calls to func saved is kept in saved."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {
+            # key: _SingleFlightCall
+        }
+        self.saved = 0
+
+    def get(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _SingleFlightCall()
+            else:
+                self.saved += 1
+
+        if leader:
+            try:
+                call.result = func()
+            except Exception:
+                call.exc_info = sys.exc_info()
+            finally:
+                call.event.set()
+        else:
+            call.event.wait()
+
+        if call.exc_info is not None:
+            raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+        return call.result
+
+class RedisSingleFlight(object):
+    """Like SingleFlight, but shared by all the processes through a lock in Redis. The first caller
+    of run for a key runs func, which must store its result somewhere load can find it. Those who
+    arrive while it is running wait until it finishes and then call load. If the first caller fails
+    (or load finds nothing), the next waiter takes the lock and tries again. If waiting takes longer
+    than wait_timeout seconds, the caller runs func on its own."""
+    def __init__(self, prefix, lock_timeout = 60, wait_timeout = 30, poll_interval = 0.05, done_timeout = 5):
+        self.prefix = prefix
+        self.lock_timeout = lock_timeout
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.done_timeout = done_timeout
+
+    def run(self, key, func, load):
+        lock_key = self.prefix + key
+        token = uuid.uuid4().hex
+        deadline = time.time() + self.wait_timeout
+        waited = False
+
+        while time.time() < deadline:
+            current = redis_store.get(lock_key)
+            if current is None:
+                acquired = redis_store.set(lock_key, token, nx = True, ex = self.lock_timeout)
+            elif current == 'done' and not waited:
+                # Finished before we arrived: its result might be older than we need
+                acquired = self._compare_and_set(lock_key, 'done', token, self.lock_timeout)
+            elif current == 'done':
+                result = load()
+                if result is not None:
+                    return result
+                acquired = self._compare_and_set(lock_key, 'done', token, self.lock_timeout)
+            else:
+                waited = True
+                time.sleep(self.poll_interval)
+                continue
+
+            if acquired:
+                try:
+                    result = func()
+                except:
+                    self._compare_and_set(lock_key, token, None)
+                    raise
+                # Tell the waiters that the result is ready
+                self._compare_and_set(lock_key, token, 'done', self.done_timeout)
+                return result
+
+        return func()
+
+    def _compare_and_set(self, lock_key, expected, new_value, timeout = None):
+        "Set (or delete, if new_value is None) lock_key only if it is still expected"
+        with redis_store.pipeline() as pipeline:
+            try:
+                pipeline.watch(lock_key)
+                if pipeline.get(lock_key) != expected:
+                    return False
+                pipeline.multi()
+                if new_value is None:
+                    pipeline.delete(lock_key)
+                else:
+                    pipeline.set(lock_key, new_value, ex = timeout)
+                pipeline.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+class ValidatorStore(object):
+    """Stores in Redis the validators (ETag and Last-Modified) of the downloaded URLs, together with
+    the result of processing their contents. This way, all the requests can be conditional (even
+    when the HTTP cache is not used) and, whenever the server replies 304 Not Modified, the previous
+    result can be used without downloading or parsing anything.
+
+    The kind of processing (e.g., 'opensocial', 'html', 'locale') is part of the key, since the same
+    URL could be processed in different ways.
+    """
+    def __init__(self, prefix = 'appcomposer:http:validators', expiration = 7 * 24 * 3600):
+        self.prefix = prefix
+        self.expiration = expiration
+
+    def _key(self, kind, url):
+        return u'{}:{}:{}'.format(self.prefix, kind, url)
+
+    def load(self, kind, url):
+        """Returns the headers to be sent in the request and the previous result (or {} and None)"""
+        stored = redis_store.hgetall(self._key(kind, url))
+        if not stored or not stored.get('parsed'):
+            return {}, None
+
+        headers = {}
+        if stored.get('etag'):
+            headers['If-None-Match'] = stored['etag']
+        if stored.get('last_modified'):
+            headers['If-Modified-Since'] = stored['last_modified']
+
+        if not headers:
+            return {}, None
+
+        return headers, json.loads(stored['parsed'])
+
+    def delete(self, kind, url):
+        redis_store.delete(self._key(kind, url))
+
+    def store(self, kind, url, response, parsed):
+        key = self._key(kind, url)
+        etag = response.headers.get('etag')
+        last_modified = response.headers.get('last-modified')
+        if not etag and not last_modified:
+            redis_store.delete(key)
+            return
+
+        pipeline = redis_store.pipeline()
+        pipeline.delete(key)
+        pipeline.hmset(key, {
+            'etag': etag or '',
+            'last_modified': last_modified or '',
+            'parsed': json.dumps(parsed),
+        })
+        pipeline.expire(key, self.expiration)
+        pipeline.execute()
+
+validator_store = ValidatorStore()
+
+class CircuitOpenError(requests.ConnectionError):
+    """The host failed too many times recently, so the request was not even sent"""
+
+class CircuitBreaker(object):
+    """Per-host circuit breaker, shared in Redis by all the processes and threads downloading contents.
+
+    After max_failures consecutive failures (connection errors, timeouts or 5xx) of a host, the
+    circuit is open: requests to that host fail immediately with CircuitOpenError (and are counted
+    as skipped) during cooldown seconds. After that, a single request is allowed as a probe: if it
+    works, the circuit is closed; if it fails, it is open again for another cooldown.
+    """
+    def __init__(self, prefix = 'appcomposer:http:circuit', max_failures = 5, cooldown = 15 * 60):
+        self.prefix = prefix
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+
+    def _key(self, host):
+        return u'{}:{}'.format(self.prefix, host)
+
+    def before(self, host):
+        """Raise CircuitOpenError if no request should be sent to host right now"""
+        failures, open_until = redis_store.hmget(self._key(host), ['failures', 'open_until'])
+        if not open_until:
+            return
+
+        if time.time() < float(open_until) or not redis_store.set(self._key(host) + ':probe', '1', nx = True, ex = self.cooldown):
+            pipeline = redis_store.pipeline()
+            pipeline.hincrby(self._key(host), 'skipped', 1)
+            pipeline.hincrby('appcomposer:downloader:stats', 'circuit_skips', 1)
+            pipeline.execute()
+            raise CircuitOpenError("Host {0} failed {1} times in a row; skipped".format(host, failures))
+
+    def success(self, host):
+        redis_store.delete(self._key(host), self._key(host) + ':probe')
+
+    def failure(self, host):
+        key = self._key(host)
+        failures = redis_store.hincrby(key, 'failures', 1)
+        pipeline = redis_store.pipeline()
+        if failures >= self.max_failures:
+            logging.warning("Host %s failed %s times in a row; skipping it for %s seconds" % (host, failures, self.cooldown))
+            pipeline.hset(key, 'open_until', time.time() + self.cooldown)
+            pipeline.delete(key + ':probe')
+        pipeline.expire(key, 24 * 3600)
+        pipeline.execute()
+
+    def get(self, session, url, **kwargs):
+        """session.get(url, **kwargs), unless the circuit of the host of url is open"""
+        host = url_host(url)
+        self.before(host)
+        try:
+            response = session.get(url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            self.failure(host)
+            raise
 
-    CACHE_DIR = 'web_cache'
-    return CacheControl(requests.Session(),
-                    cache=FileCache(CACHE_DIR), heuristic=_LastModifiedNoDate(require_date=False))
+        if response is not None and response.status_code is not None and response.status_code >= 500:
+            self.failure(host)
+        else:
+            self.success(host)
+        return response
+
+circuit_breaker = CircuitBreaker()
+
+class LRUCache(object):
+    """Thread-safe in-process cache of at most max_items elements. The least recently used ones are
+    evicted first. If ttl is provided, elements older than ttl seconds are ignored."""
+    def __init__(self, max_items = 1000, ttl = None):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+    def get(self, key, default = None):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return default
+
+            stored, value = item
+            if self.ttl is not None and time.time() - stored > self.ttl:
+                return default
+
+            # Move it to the end (most recently used)
+            self._items[key] = item
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (time.time(), value)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last = False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+class ParsedBundleCache(object):
+    """Content-addressed cache of parsed message bundles: it maps the hash of the URL and the XML of a
+    bundle to the result of parsing it, so identical bundles are not parsed again even if they had to
+    be downloaded again (e.g., the server does not support conditional requests).
+
+    It is kept in memory (bounded, LRU) and in Redis (compressed, expiring if not used in expiration
+    seconds) so it is shared among processes. Results must be JSON-serializable. Other stores (e.g., the
+    ValidatorStore) can keep just the hash returned by store, and get the result with get_by_hash."""
+    def __init__(self, prefix = 'appcomposer:bundles:parsed', max_items = 2000, expiration = 7 * 24 * 3600):
+        self.prefix = prefix
+        self.expiration = expiration
+        self.local = LRUCache(max_items = max_items)
+
+    def hash(self, url, contents):
+        return hashlib.sha1(url.encode('utf8') + '\0' + contents.encode('utf8')).hexdigest()
+
+    def get(self, url, contents):
+        """Return the result stored for that url and contents, or None"""
+        return self.get_by_hash(self.hash(url, contents))
+
+    def get_by_hash(self, content_hash):
+        """Return the result stored with that hash (see store), or None"""
+        # Serialized, so callers never share (and modify) the same objects
+        serialized = self.local.get(content_hash)
+        if serialized is None:
+            key = u'{}:{}'.format(self.prefix, content_hash)
+            pipeline = redis_store.pipeline()
+            pipeline.get(key)
+            pipeline.expire(key, self.expiration)
+            stored, _ = pipeline.execute()
+            if stored is None:
+                return None
+
+            serialized = zlib.decompress(stored)
+            self.local.set(content_hash, serialized)
+
+        return json.loads(serialized)
+
+    def store(self, url, contents, result):
+        "Store the result, returning its hash"
+        content_hash = self.hash(url, contents)
+        serialized = json.dumps(result)
+        self.local.set(content_hash, serialized)
+        redis_store.setex(u'{}:{}'.format(self.prefix, content_hash), self.expiration, zlib.compress(serialized))
+        return content_hash
+
+parsed_bundle_cache = ParsedBundleCache()
 
 def fromstring(xml_contents):
     try:
@@ -111,6 +651,43 @@ def get_text_from_response(response):
             response.encoding = 'utf8'
     return response.text
 
+def get_html_head_from_response(response, budget = 256 * 1024):
+    """Same as get_text_from_response, but for HTML documents of which only the <head> is needed: it reads
+    the response incrementally (if it was requested with stream=True) and stops at the end of the <head>,
+    at the beginning of the <body>, or after budget bytes. The response is closed."""
+    if response.raw is None:
+        # Already in memory (e.g., in tests)
+        chunks = iter([ response.content or '' ])
+    else:
+        chunks = response.iter_content(chunk_size = 8192)
+
+    data = ''
+    try:
+        for chunk in chunks:
+            searched_from = max(0, len(data) - len('</head'))
+            data += chunk
+            lowered = data[searched_from:].lower()
+            if '</head' in lowered or '<body' in lowered or len(data) >= budget:
+                break
+    finally:
+        response.close()
+
+    data = data[:budget]
+    encoding = response.encoding
+    if encoding == 'ISO-8859-1':
+        try:
+            # final=False: the last character might have been cut
+            return codecs.getincrementaldecoder('utf8')().decode(data, False)
+        except UnicodeDecodeError:
+            pass
+    elif encoding is None:
+        encoding = 'utf8'
+
+    try:
+        return codecs.getincrementaldecoder(encoding)(errors = 'replace').decode(data, False)
+    except LookupError:
+        return codecs.getincrementaldecoder('utf8')(errors = 'replace').decode(data, False)
+
 
 def indent(elem, level=0):
     i = "\n" + level*"  "
@@ -309,11 +309,86 @@ def bundle_update(language, target):
     translated_messages = { key : value }
 
     add_full_translation_to_app(user.email, app_url, translation_url, metadata, language, target, translated_messages, original_messages, from_developer = False)
-    from appcomposer.translator.tasks import task_synchronize_single_app
-    task_synchronize_single_app.delay("update", app_url)
+    from appcomposer.translator.tasks import schedule_single_app_synchronization
+    schedule_single_app_synchronization("update", app_url)
 
     return jsonify(**{"result": "success"})
 
+
+@translator_api_blueprint.route("/apps/bundles/<language>/<target>/updateMessages", methods=["PUT", "POST"])
+@requires_golab_api_login
+@cross_origin()
+@api
+def bundle_update_batch(language, target):
+    """Like updateMessage, but with many messages at once (e.g., pasting a whole translation):
+
+        { "messages": [ { "key": "...", "value": "...", "revision": 1234 }, ... ] }
+
+    The revision (as returned by the translate API) is optional. If it is provided and the message
+    has been changed by somebody else since then, that message is not stored and it is returned in
+    conflicts, with its current value and revision. The revisions of the stored messages are
+    returned too."""
+    if language == 'en_ALL':
+        # Don't allow to translate texts in English
+        return jsonify(result="error")
+
+    app_url = request.values.get('app_url')
+    try:
+        request_data = request.get_json(force=True, silent=True) or {}
+    except ValueError:
+        request_data = {}
+
+    messages = request_data.get("messages")
+    if not isinstance(messages, list) or not messages:
+        return jsonify(**{"result": "error"})
+
+    translated_messages = {}
+    expected_revisions = {}
+    for message in messages:
+        if not isinstance(message, dict):
+            return jsonify(**{"result": "error"})
+
+        key = message.get("key")
+        value = message.get("value")
+        if key is None or value is None:
+            return jsonify(**{"result": "error"})
+
+        translated_messages[key] = value
+        if 'revision' in message:
+            # Revisions are compared with the ids of the history, so "1234" must be 1234 (null means
+            # that there was no message yet)
+            revision = message['revision']
+            if revision is not None:
+                try:
+                    revision = int(revision)
+                except (TypeError, ValueError):
+                    return jsonify(**{"result": "error"})
+            expected_revisions[key] = revision
+
+    user = current_golab_user()
+
+    translation_url, original_messages, metadata = extract_local_translations_url(app_url, force_local_cache = True)
+
+    conflicts = add_full_translation_to_app(user.email, app_url, translation_url, metadata, language, target, translated_messages, original_messages, from_developer = False, expected_revisions = expected_revisions)
+    from appcomposer.translator.tasks import schedule_single_app_synchronization
+    schedule_single_app_synchronization("update", app_url)
+
+    stored_translations, _, _ = retrieve_stored(translation_url, language, target)
+    revisions = {}
+    for key in translated_messages:
+        if key not in conflicts:
+            revisions[key] = stored_translations.get(key, {}).get('revision')
+
+    current_conflicts = {}
+    for key in conflicts:
+        stored = stored_translations.get(key, {})
+        current_conflicts[key] = {
+            'value': stored.get('value'),
+            'revision': stored.get('revision'),
+        }
+
+    return jsonify(**{"result": "conflict" if current_conflicts else "success", "revisions": revisions, "conflicts": current_conflicts})
+
 @translator_api_blueprint.route('/apps')
 @public
 @cross_origin()
@@ -370,7 +445,10 @@ def api_translate(language, target):
     if errors:
         return '; '.join(errors), 400
 
-    translation_url, original_messages, metadata = extract_local_translations_url(app_url)
+    # The cache is invalidated whenever the downloader finds a change in the app, but the downloader
+    # only checks the apps of the repository: other apps are always downloaded (conditionally) again
+    in_repository = db.session.query(RepositoryApp.id).filter_by(url = app_url).first() is not None
+    translation_url, original_messages, metadata = extract_local_translations_url(app_url, force_local_cache = in_repository)
     translation = {}
 
     stored_translations, from_developer, automatic = retrieve_stored(translation_url, language, target)
@@ -399,6 +477,7 @@ def api_translate(language, target):
                 'suggestions' : current_suggestions,
                 'can_edit' : can_edit,
                 'format': original_message_pack.get('format', 'plain'),
+                'revision': stored.get('revision'),
             }
 
     app_thumb = None
@@ -21,6 +21,7 @@ from wtforms.fields.html5 import URLField
 from wtforms.validators import url, required
 
 from appcomposer.db import db
+from appcomposer.exceptions import TranslatorError
 from appcomposer.models import TranslatedApp, TranslationUrl, TranslationBundle, RepositoryApp, ActiveTranslationMessage, TranslationMessageHistory
 from appcomposer.login import requires_golab_login, current_golab_user
 from appcomposer.translator.mongodb_pusher import retrieve_mongodb_contents, retrieve_mongodb_apps, retrieve_mongodb_urls, retrieve_mongodb_app, retrieve_mongodb_translation_url
@@ -306,10 +307,14 @@ def translation_upload():
         if not errors:
             language = form.language.data
             target = form.target.data
-            add_full_translation_to_app(current_golab_user().email, app_url, translation_url, metadata, language, target, translated_messages, original_messages, from_developer = False)
-            from appcomposer.translator.tasks import synchronize_apps_cache_wrapper
-            synchronize_apps_cache_wrapper.delay("upload")
-            flash("Contents successfully added")
+            try:
+                add_full_translation_to_app(current_golab_user().email, app_url, translation_url, metadata, language, target, translated_messages, original_messages, from_developer = False)
+            except TranslatorError as e:
+                form.opensocial_xml.errors = [unicode(e.args[0])]
+            else:
+                from appcomposer.translator.tasks import synchronize_apps_cache_wrapper
+                synchronize_apps_cache_wrapper.delay("upload")
+                flash("Contents successfully added")
 
     return render_template('translator/translations_upload.html', form=form)
 
@@ -14,6 +14,7 @@ from sqlalchemy.orm import joinedload
 
 from flask import Blueprint, render_template, request, url_for, jsonify
 
+from appcomposer import redis_store
 from appcomposer.db import db
 from appcomposer.models import TranslatedApp, TranslationUrl, TranslationBundle, RepositoryApp, GoLabOAuthUser, ActiveTranslationMessage, TranslationMessageHistory
 from appcomposer.models import TranslationExternalSuggestion, RepositoryAppCheckUrl
@@ -22,6 +23,8 @@ from appcomposer.login import requires_golab_login
 from appcomposer.utils import public
 from appcomposer.languages import LANGUAGE_NAMES_PER_CODE, LANGUAGE_THRESHOLD, ALL_LANGUAGES, get_locale_english_name
 from appcomposer.translator.suggestions import microsoft_translator, google_translator, deepl_translator
+from appcomposer.translator.utils import get_http_cache
+from appcomposer.translator.ops import LOCK_STATS_KEY
 
 translator_stats_blueprint = Blueprint('translator_stats', __name__, static_folder = '../../translator3/dist/', static_url_path = '/web')
 
@@ -319,6 +322,15 @@ def suggestions():
 
     return render_template("translator/stats_suggestions.html", data_per_engine=data_per_engine, supported=supported, english_stats=english_stats, languages=languages, engines=engines, data_per_language=data_per_language, dates_by_engine=dates_by_engine)
 
+@translator_stats_blueprint.route('/downloader.json')
+def downloader_status():
+    http_cache = get_http_cache()
+    return jsonify(downloader=redis_store.hgetall('appcomposer:downloader:stats'), http_cache=http_cache.stats() if http_cache is not None else None)
+
+@translator_stats_blueprint.route('/locks.json')
+def locks_status():
+    return jsonify(locks=redis_store.hgetall(LOCK_STATS_KEY))
+
 @translator_stats_blueprint.route('/status.json')
 def apps_status():
     flash = set([])
@@ -0,0 +1,10 @@
+#!/usr/bin/python
+# Same as run_celery_slow_independent.py, but monkey-patched so the downloader can
+# use the gevent engine (DOWNLOADER_ENGINE = 'gevent' in config.py)
+from gevent import monkey
+monkey.patch_all()
+
+from appcomposer.translator.tasks import cel
+import sys
+
+cel.worker_main(sys.argv + ['--pool=gevent', '--concurrency=4', '--queues=slow-independent-tasks'])
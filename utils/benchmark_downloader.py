@@ -0,0 +1,135 @@
+#!/usr/bin/python
+"""
+Synthetic benchmark of the downloader executors.
+
+It starts a few local HTTP servers (each one playing the role of a different host) which
+answer every request after --delay seconds, and downloads --apps gadgets (plus --locales
+message bundles each) from them, as download_repository_apps does.
+
+    python utils/benchmark_downloader.py --engine threads
+    python utils/benchmark_downloader.py --engine gevent
+
+By default, it uses the per-host limit configured for the engine (DOWNLOADER_PER_HOST or
+DOWNLOADER_GEVENT_PER_HOST in config.py, if present, or their defaults). Use --per-host 0
+to measure it without any limit.
+"""
+import sys
+import argparse
+
+parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--engine', choices = ['threads', 'gevent'], default = 'threads')
+parser.add_argument('--apps', type = int, default = 5000)
+parser.add_argument('--locales', type = int, default = 2, help = "Locale files downloaded per app")
+parser.add_argument('--hosts', type = int, default = 10)
+parser.add_argument('--delay', type = float, default = 0.2, help = "Seconds each request takes")
+parser.add_argument('--workers', type = int, default = 15)
+parser.add_argument('--greenlets', type = int, default = 1000)
+parser.add_argument('--per-host', type = int, default = None, help = "Requests in flight per host (default: the configured one; 0: unlimited)")
+args = parser.parse_args()
+
+if args.engine == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+import os
+import time
+import threading
+import BaseHTTPServer
+import SocketServer
+
+import requests
+from requests.adapters import HTTPAdapter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from appcomposer.translator.executor import FetchTask, create_executor
+
+def configured_per_host(engine):
+    "Same as the downloader (see _per_host in appcomposer.translator.downloader)"
+    try:
+        import config
+    except ImportError:
+        config = None
+
+    if engine == 'gevent':
+        return getattr(config, 'DOWNLOADER_GEVENT_PER_HOST', 50)
+    return getattr(config, 'DOWNLOADER_PER_HOST', 4)
+
+class SlowHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        time.sleep(args.delay)
+        body = '<messagebundle><msg name="hello">Hello</msg></messagebundle>'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class SlowServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+def start_servers():
+    hosts = []
+    for _ in xrange(args.hosts):
+        server = SlowServer(('127.0.0.1', 0), SlowHandler)
+        thread = threading.Thread(target = server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        hosts.append('127.0.0.1:{0}'.format(server.server_address[1]))
+    return hosts
+
+class AppTask(FetchTask):
+    def __init__(self, host, app_id, session):
+        self.host = host
+        self.app_id = app_id
+        self.session = session
+        self.failed = False
+
+    def fetch(self):
+        base_url = 'http://{0}/apps/{1}/'.format(self.host, self.app_id)
+        self.session.get(base_url + 'gadget.xml', timeout = 60).raise_for_status()
+        for locale in xrange(args.locales):
+            self.session.get(base_url + 'languages/{0}_ALL.xml'.format(locale), timeout = 60).raise_for_status()
+
+    def on_failure(self, reason, exc_info = None):
+        self.failed = True
+
+def main():
+    if args.per_host is None:
+        per_host = configured_per_host(args.engine)
+    else:
+        per_host = args.per_host or None
+
+    hosts = start_servers()
+    pool_size = max(args.workers, args.greenlets if args.engine == 'gevent' else 0)
+
+    sessions = {}
+    for host in hosts:
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(pool_connections = 1, pool_maxsize = pool_size))
+        sessions[host] = session
+
+    tasks = []
+    for app_id in xrange(args.apps):
+        host = hosts[app_id % len(hosts)]
+        tasks.append(AppTask(host, app_id, sessions[host]))
+
+    executor = create_executor(args.engine, 'benchmark', workers = args.workers, greenlets = args.greenlets, per_host = per_host)
+
+    t0 = time.time()
+    executor.run(tasks)
+    elapsed = time.time() - t0
+
+    failed = len([ task for task in tasks if task.failed ])
+    requests_done = args.apps * (1 + args.locales)
+    print "Engine: {0} ({1}), per host: {2}".format(args.engine, type(executor).__name__, per_host or 'unlimited')
+    print "{0} apps ({1} requests, {2} failed apps) in {3:.2f} seconds: {4:.1f} requests/second".format(args.apps, requests_done, failed, elapsed, requests_done / elapsed)
+
+if __name__ == '__main__':
+    main()
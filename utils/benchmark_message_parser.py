@@ -0,0 +1,79 @@
+#!/usr/bin/python
+"""
+Micro-benchmark of extract_messages_from_translation on large message bundles, compared with
+the previous ElementTree-based parser. It also checks that both return exactly the same.
+
+    python utils/benchmark_message_parser.py --messages 50000
+
+It must be run from the root of the project (it imports the appcomposer package, so config.py
+is needed).
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from appcomposer.translator.extractors import extract_messages_from_translation
+
+def legacy_extract_messages(xml_contents):
+    contents = ET.fromstring(xml_contents.encode('utf8'))
+    messages = {}
+    for pos, xml_msg in enumerate(contents.findall('msg')):
+        try:
+            raw_msg_message = ET.tostring(xml_msg).split(">", 1)[1].rsplit("<", 1)[0]
+        except IndexError:
+            raw_msg_message = ""
+
+        if '<' in raw_msg_message or '>' in raw_msg_message:
+            xml_text = raw_msg_message
+        else:
+            xml_text = xml_msg.text or ""
+
+        messages[xml_msg.attrib['name']] = xml_text
+    return messages, json.dumps(dict(contents.attrib))
+
+def generate_bundle(number, markup_every):
+    lines = [ u'<?xml version="1.0" encoding="UTF-8"?>', u'<messagebundle mails="a@example.com" automatic="true">' ]
+    for pos in xrange(number):
+        if markup_every and pos % markup_every == 0:
+            lines.append(u'  <msg name="message_{0}">Press <i class="icon"></i> to continue ({0}) &amp; wait</msg>'.format(pos))
+        else:
+            lines.append(u'  <msg name="message_{0}">This is the message n\xfamero {0} with &lt;escaped&gt; text</msg>'.format(pos))
+    lines.append(u'</messagebundle>')
+    return u'\n'.join(lines)
+
+def measure(func, repetitions):
+    best = None
+    for _ in xrange(repetitions):
+        t0 = time.time()
+        result = func()
+        elapsed = time.time() - t0
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type = int, default = 50000)
+    parser.add_argument('--markup-every', type = int, default = 50, help = "One in N messages contains HTML markup (0 for none)")
+    parser.add_argument('--repetitions', type = int, default = 3)
+    args = parser.parse_args()
+
+    xml_contents = generate_bundle(args.messages, args.markup_every)
+    print "Bundle: {0} messages, {1:.1f} MB".format(args.messages, len(xml_contents.encode('utf8')) / 1024.0 / 1024.0)
+
+    url = 'http://localhost/languages/en_ALL.xml'
+    legacy_time, (legacy_messages, legacy_attribs) = measure(lambda : legacy_extract_messages(xml_contents), args.repetitions)
+    current_time, (messages, metadata) = measure(lambda : extract_messages_from_translation(url, xml_contents), args.repetitions)
+
+    same_texts = legacy_messages == dict( (key, value['text']) for key, value in messages.iteritems() )
+    print "ElementTree (previous): {0:.3f} seconds".format(legacy_time)
+    print "lxml iterparse:         {0:.3f} seconds".format(current_time)
+    print "Same results: {0}".format(same_texts and legacy_attribs == metadata['attribs'])
+
+if __name__ == '__main__':
+    main()